@@ -0,0 +1,164 @@
+import json, time, itertools
+import threading
+
+from model_cache import get_cache
+from sweep import CONV_TYPES, build_jobs, order_by_prefix, generate_job
+
+# Offline sweeps through the Gemini Batch API: every assistant prompt ConversationSimulatorFull would send is
+# collected up front, submitted as batch jobs, and the responses are fed back through ConversationSimulatorFull.finish()
+# so extraction, evaluation and logging are the same as for online runs.
+
+DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+def build_batch_request(input_prompt, temperature, max_tokens, stop=None, thinking_budget=None):
+    """One inline request in the Batch API format (same contents/config as GeminiModel.generate)."""
+    config = {"temperature": temperature}
+    if max_tokens is not None:
+        config["max_output_tokens"] = max_tokens
+    if stop:
+        config["stop_sequences"] = list(stop)
+    if thinking_budget is not None:
+        config["thinking_config"] = {"thinking_budget": thinking_budget}
+    return {"contents": [{"role": "user", "parts": [{"text": input_prompt}]}], "config": config}
+
+class GeminiBatchClient:
+    """Thin wrapper over the genai Batch API using inline requests."""
+    def __init__(self, key_index=0):
+        from model_genai import get_model
+        self.client = get_model().clients[key_index]
+
+    def submit(self, model, requests, display_name):
+        job = self.client.batches.create(model=model, src=requests, config={"display_name": display_name})
+        return job.name
+
+    def poll(self, job_name):
+        return self.client.batches.get(name=job_name).state.name
+
+    def results(self, job_name):
+        """Returns one (text, error) pair per request, in submission order."""
+        job = self.client.batches.get(name=job_name)
+        results = []
+        for inline_response in job.dest.inlined_responses:
+            if inline_response.response is not None:
+                results.append((inline_response.response.text, None))
+            else:
+                results.append((None, str(inline_response.error)))
+        return results
+
+class FakeBatchClient:
+    """
+    Local stand-in for the Batch API so batch sweeps can be run and debugged offline.
+    Jobs "complete" after latency seconds; responder(request) -> str produces each response.
+    """
+    def __init__(self, responder=None, latency=1.0):
+        self.responder = responder or (lambda request: "Sagot: A")
+        self.latency = latency
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def submit(self, model, requests, display_name):
+        with self.lock:
+            job_name = f"batches/fake-{next(self.job_ids)}"
+            self.jobs[job_name] = {"requests": requests, "submitted": time.time()}
+        return job_name
+
+    def poll(self, job_name):
+        job = self.jobs[job_name]
+        return "JOB_STATE_SUCCEEDED" if time.time() - job["submitted"] >= self.latency else "JOB_STATE_RUNNING"
+
+    def results(self, job_name):
+        results = []
+        for request in self.jobs[job_name]["requests"]:
+            try:
+                results.append((self.responder(request), None))
+            except Exception as e:
+                results.append((None, repr(e)))
+        return results
+
+def run_batch_sweep(samples, assistant_model, system_model, batch_client, conv_types=CONV_TYPES, is_base_model=False, temperature=1.0,
+                    dataset_fn=None, log_folder="logs", max_requests_per_job=1000, poll_interval=30, verbose=False):
+    """
+    Runs every (sample, conversation type) pair with the assistant calls served by batch jobs.
+    Requests that fail inside a batch are retried online with the same prompt (sweep.generate_job).
+    Returns a list of (task_id, conv_type, is_correct, score).
+    """
+    # 1. collect every assistant prompt, prefix-ordered so shared prefixes land in the same job
+    jobs = order_by_prefix(build_jobs(samples, assistant_model, system_model, conv_types=conv_types, is_base_model=is_base_model,
+                                      temperature=temperature, dataset_fn=dataset_fn, log_folder=log_folder))
+    pending = [(job, build_batch_request(job["input_prompt"], temperature, job["max_tokens"], job["stop"], job["simulator"].thinking_budget)) for job in jobs]
+    print(f"[batch] Collected {len(pending)} assistant prompts")
+
+    # 2. submit in chunks
+    jobs = []
+    for start in range(0, len(pending), max_requests_per_job):
+        chunk = pending[start:start + max_requests_per_job]
+        job_name = batch_client.submit(assistant_model, [request for _, request in chunk], display_name=f"lic-sweep-{start // max_requests_per_job}")
+        print(f"[batch] Submitted {job_name} ({len(chunk)} requests)")
+        jobs.append((job_name, chunk))
+
+    # 3. poll until every job is done, then feed results back through the normal path
+    results = []
+    remaining = list(jobs)
+    while remaining:
+        still_running = []
+        for job_name, chunk in remaining:
+            state = batch_client.poll(job_name)
+            if state not in DONE_STATES:
+                still_running.append((job_name, chunk))
+                continue
+
+            print(f"[batch] {job_name} finished with {state}")
+            job_results = batch_client.results(job_name) if state == "JOB_STATE_SUCCEEDED" else [(None, state)] * len(chunk)
+            for (job, _), (text, error) in zip(chunk, job_results):
+                simulator, log_conv_type, input_prompt = job["simulator"], job["conv_type"], job["input_prompt"]
+                try:
+                    if text is None:
+                        # the prompt that was submitted, not a rebuilt one (shuffle-concat would reshuffle)
+                        print(f"[batch] {simulator.sample['task_id']} ({log_conv_type}) failed in batch ({error}); retrying online")
+                        text = generate_job(job)[0]
+                    is_correct, score = simulator.finish(log_conv_type, input_prompt, text, verbose=verbose)
+                except Exception as e:
+                    # one failed conversation is recorded as unfinished (is_correct=None) instead of ending the sweep
+                    print(f"[batch] {simulator.sample['task_id']} ({log_conv_type}) failed: {e.__class__.__name__}: {str(e)[:200]}")
+                    is_correct, score = None, None
+                results.append((simulator.sample["task_id"], log_conv_type, is_correct, score))
+
+        remaining = still_running
+        if remaining:
+            time.sleep(poll_interval)
+
+    return results
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_fn", type=str, default="data/sharded_instructions.json")
+    parser.add_argument("--task", type=str, default="all")
+    parser.add_argument("--assistant_model", type=str, default="gemini-2.5-flash")
+    parser.add_argument("--system_model", type=str, default="gemini-2.5-flash")
+    parser.add_argument("--conv_types", type=str, nargs="+", default=CONV_TYPES, choices=CONV_TYPES)
+    parser.add_argument("--is_base_model", action="store_true")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--max_requests_per_job", type=int, default=1000)
+    parser.add_argument("--poll_interval", type=int, default=30)
+    parser.add_argument("--log_folder", type=str, default="logs")
+    parser.add_argument("--fake", action="store_true", help="Use the local fake batch endpoint instead of the Gemini Batch API")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.dataset_fn, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data = [d for d in data if (d["task"] == args.task or args.task == "all")]
+
+    batch_client = FakeBatchClient(latency=1.0) if args.fake else GeminiBatchClient()
+    results = run_batch_sweep(data, args.assistant_model, args.system_model, batch_client, conv_types=args.conv_types,
+                              is_base_model=args.is_base_model, temperature=args.temperature, dataset_fn=args.dataset_fn,
+                              log_folder=args.log_folder, max_requests_per_job=args.max_requests_per_job,
+                              poll_interval=1 if args.fake else args.poll_interval, verbose=args.verbose)
+
+    num_correct = sum(1 for _, _, is_correct, _ in results if is_correct)
+    num_failed = sum(1 for _, _, is_correct, _ in results if is_correct is None)
+    print(f"[batch] {num_correct}/{len(results)} correct ({num_failed} failed)")
+    get_cache().report()
@@ -0,0 +1,100 @@
+import time, asyncio
+import threading
+
+from config import config
+
+def is_overload_error(e):
+    """True for 429 / 503 / "overloaded" style errors, i.e. the server telling us to back off."""
+    error_message = str(e)
+    code = getattr(e, "code", None) or getattr(e, "status_code", None)
+    return (
+        code in [429, 503] or
+        "429" in error_message or
+        "503" in error_message or
+        "RESOURCE_EXHAUSTED" in error_message or
+        "UNAVAILABLE" in error_message or
+        "overloaded" in error_message.lower() or
+        "server busy" in error_message.lower()
+    )
+
+def is_connection_error(e):
+    """True when the server itself is unreachable or dropped the connection (as opposed to rejecting the request)."""
+    error_message = str(e).lower()
+    return (
+        isinstance(e, (ConnectionError, TimeoutError)) or
+        type(e).__name__ in ("ConnectError", "ConnectTimeout", "ReadTimeout", "RemoteProtocolError") or
+        "failed to connect" in error_message or
+        "connection refused" in error_message or
+        "server disconnected" in error_message
+    )
+
+class AIMDController:
+    """
+    Adaptive limit on in-flight requests (additive increase, multiplicative decrease).
+    Every success raises the limit by increase / limit, i.e. about +increase per window of successful calls;
+    an overload signal cuts it by decrease_factor, at most once per cooldown_s so one burst of 429s counts once.
+    Any other failure (connection refused, timeout, 500) is neutral: it frees the slot and leaves the limit alone.
+    """
+    def __init__(self, name, initial=4, min_limit=1, max_limit=64, increase=1.0, decrease_factor=0.5, cooldown_s=5.0):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.cooldown_s = cooldown_s
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        # shared with threads, so poll rather than wait on an asyncio primitive
+        while not self.try_acquire():
+            await asyncio.sleep(0.05)
+
+    def release(self, overloaded=False, succeeded=True):
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                now = time.monotonic()
+                if now - self.last_decrease >= self.cooldown_s:
+                    old_limit = self.limit
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+                    print(f"[aimd] {self.name}: overloaded, concurrency {old_limit:.1f} -> {self.limit:.1f}")
+            elif succeeded:
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            self.condition.notify_all()
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+def get_controller(backend, model):
+    """Returns the shared controller for a (backend, model) pair, creating it from config["aimd"] on first use."""
+    with _controllers_lock:
+        key = (backend, model)
+        if key not in _controllers:
+            settings = dict(config["aimd"]["default"])
+            # per-host controllers ("ollama@http://host:11434", ollama_pool.py) take their backend's settings
+            settings.update(config["aimd"].get(backend.split("@", 1)[0], {}))
+            settings.update(config["aimd"].get(backend, {}))
+            _controllers[key] = AIMDController(f"{backend}/{model}", **settings)
+        return _controllers[key]
+
+def report_controllers():
+    with _controllers_lock:
+        for controller in _controllers.values():
+            print(f"[aimd] {controller.name}: concurrency limit {controller.limit:.1f} ({controller.in_flight} in flight)")
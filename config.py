@@ -60,6 +60,110 @@ config = {
     # do we need this?
     "model": "sailor2:1b",
     "ollama_host": "http://localhost:11434",
+    "ollama_keep_alive": "30m", # how long Ollama keeps a model loaded after its last request (sent with every call)
+    "ollama_load_event_s": 0.5, # a response whose load_duration exceeds this counts as a model load
+    "ollama_latency_alpha": 0.2, # smoothing of the per-model request latency used for routing
+    "ollama_profiles_dir": os.path.join(BASE_DIR, ".cache", "ollama_profiles"), # per-model CPU settings written by ollama_tune.py
+    "ollama_use_profiles": True, # apply a model's tuned profile automatically when one exists
+    # OpenAI-compatible local server (model_openai_compat.py), e.g. `llama-server -m model.gguf --parallel 16 --cont-batching`
+    # models named "local/<name>" are sent to it as "<name>"
+    "openai_compat_base_url": "http://localhost:8080/v1",
+    "openai_compat_api_key": None,
+    "openai_compat_prefix": "local/",
+    "openai_compat_max_connections": 128,
+
+    # several Ollama servers (ollama_pool.py), e.g. ["http://localhost:11434", "http://gpu-box:11434"]; empty = ollama_host only
+    "ollama_hosts": [],
+    "ollama_pool": {
+        "eject_after": 3, # consecutive connection errors before a host is taken out of rotation
+        "health_interval_s": 10, # how often ejected hosts are checked (ollama ps)
+        "health_timeout_s": 2,
+        "default_latency_s": 5.0, # assumed request latency for a model not yet measured on a host
+        "default_load_s": 10.0, # assumed load time for a model never loaded on a host
+    },
     "max_retries": 3,
     "temperature": 1.0,
+
+    # backend routing by model-name prefix (model_registry.py); anything unmatched goes to default_backend
+    "backend_routes": [
+        ("gemini-", "genai"),
+        ("local/", "openai_compat"),
+    ],
+    "default_backend": "ollama",
+
+    # response cache (model_cache.py) - shared by the genai and ollama backends
+    "cache_enabled": True,
+    "cache_path": os.path.join(BASE_DIR, ".cache", "responses.sqlite"),
+    "cache_max_bytes": 512 * 1024 * 1024,
+
+    # models that think before answering; their thinking counts against the output budget (Task.get_max_output_tokens)
+    "reasoning_models": ["o1", "o3", "deepseek-r1", "gemini-2.5"],
+    "reasoning_output_allowance": 15000,
+
+    # Ollama context sizing (OllamaModel._pick_num_ctx): the smallest bucket that fits prompt + output budget.
+    # A fixed set keeps num_ctx stable across requests, since changing it makes the server reload the model.
+    "ollama_num_ctx_buckets": [2048, 4096, 8192, 16384, 32768],
+    "ollama_default_output_tokens": 1024, # output budget assumed when a call sets no max_tokens
+    "ollama_max_ctx": {}, # model -> max context, for models whose `ollama show` info lacks it
+
+    # thinking budgets (tokens) per call role for thinking models (config["reasoning_models"]; applied on Gemini 2.5).
+    # None = the model's default (dynamic) thinking, 0 = off. "tasks" overrides a role for one task, e.g. {"asu": {"assistant": 1024}}
+    "thinking_budgets": {
+        "assistant": None,
+        "answer_extraction": 0,
+        "turn_categorization": 0,
+        "tasks": {},
+    },
+    "thinking_min_budget": {"gemini-2.5-pro": 128}, # models that cannot turn thinking off
+
+    # deadlines and retries (deadlines.py): every call must finish within call_timeout_s (None = no deadline), and retries
+    # draw on one budget for the whole run - a retry spends a token, a successful call earns `ratio`, capped at max_tokens
+    "call_timeout_s": 300,
+    "retry_budget": {"initial": 20, "ratio": 0.1, "max_tokens": 100},
+    "sweep_max_requeues": 2, # times sweep.py re-queues a job whose call ran out of time before giving up on it
+
+    # system-model cascade (system_agent.py): this local model (e.g. "qwen2.5:3b" on Ollama) handles answer extraction and
+    # turn categorization first; only calls that fail schema validation or the extractive check escalate to the system model.
+    # None = off, every call goes straight to the system model
+    "system_cascade_model": None,
+    # batched answer extraction (system_agent.extract_answers_batch, used by sweep.py): "gen" extractions packed into one
+    # system-model call, capped by item count and by response characters; 1 = one call per conversation
+    "system_extraction_batch_size": 16,
+    "system_extraction_batch_chars": 32000,
+    # rule-based answer extraction for closed-label "gen" tasks (Task.rule_extract_answer): the LLM extractor only sees
+    # responses the rules find ambiguous or answer below this confidence (marker 1.0, lone label 0.95, "titik B" 0.85, label word 0.8)
+    "rule_extraction_enabled": True,
+    "rule_extraction_min_confidence": 0.8,
+
+    # max in-flight requests per backend for the async API (agenerate / agenerate_json)
+    "genai_max_concurrency": 16,
+    "ollama_max_concurrency": 4,
+
+    # adaptive (AIMD) in-flight limits per backend and model (concurrency.py); per-backend entries override "default"
+    "aimd": {
+        "default": {"initial": 4, "min_limit": 1, "max_limit": 64, "increase": 1.0, "decrease_factor": 0.5, "cooldown_s": 5.0},
+        "genai": {"initial": 8, "max_limit": 64},
+        "ollama": {"initial": 2, "max_limit": 8},
+        "openai_compat": {"initial": 16, "max_limit": 128}, # continuous batching: throughput grows with requests in flight
+    },
+
+    # per-key quotas enforced client-side by GeminiModel (rate_limiter.py); None disables that limit
+    # defaults are the free-tier limits - raise them for paid keys
+    "gemini_rate_limits": {
+        "default": {"rpm": 10, "tpm": 250000, "rpd": 250},
+        "gemini-2.5-flash": {"rpm": 10, "tpm": 250000, "rpd": 250},
+        "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250000, "rpd": 1000},
+        "gemini-2.5-pro": {"rpm": 5, "tpm": 250000, "rpd": 100},
+    },
+    "genai_key_error_threshold": 3, # consecutive failures before a key is set aside
+    "genai_key_cooldown": 60, # seconds an erroring key sits out
+    "genai_max_candidates": 8, # candidate_count cap per request for multi-candidate runs (generate_n)
+    # per-key daily usage and exhaustion on disk (quota_ledger.py), read at startup and on every key choice
+    "quota_ledger_enabled": True,
+    "quota_ledger_path": os.path.join(BASE_DIR, ".cache", "quota_ledger.sqlite"),
+    "quota_ledger_refresh_s": 10, # how often buffered request counts are written and other processes' updates read
+    # hedged requests (hedging.py): a call still running past the model's live latency percentile gets a duplicate on another key
+    # auto-enabled only up to max_temperature, where a duplicate answer is harmless; generate(hedge=True/False) overrides
+    "genai_hedging": {"enabled": True, "percentile": 0.95, "min_samples": 20, "window": 200, "min_delay_s": 2.0, "max_temperature": 0.0},
+    "chars_per_token": 3.0, # local prompt-size estimate; Filipino text tokenizes denser than English
 }
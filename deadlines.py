@@ -0,0 +1,84 @@
+import time
+import threading
+
+from config import config
+
+# Absolute call deadlines and a retry budget shared by every call in the run.
+# A deadline is a time.time() timestamp; a call that cannot finish (or cannot wait out a backoff) before it raises
+# CallDeadlineExceeded, so the caller can re-queue the work instead of parking a worker in time.sleep.
+# The budget caps retries across the whole run: successes earn retry credit, retries spend it, so a burst of
+# failures cannot turn every call into a 10-retry stall.
+
+class CallDeadlineExceeded(Exception):
+    """Raised when a call's deadline passes, or a retry would have to wait past it."""
+    pass
+
+def make_deadline(timeout_s=None):
+    """Absolute deadline timeout_s from now (default config["call_timeout_s"]); None if there is no timeout."""
+    timeout_s = config["call_timeout_s"] if timeout_s is None else timeout_s
+    if timeout_s is None:
+        return None
+    return time.time() + timeout_s
+
+def time_left(deadline):
+    """Seconds until deadline (None = no deadline)."""
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+def check_deadline(deadline, wait_time=0.0, what="call"):
+    """Raises CallDeadlineExceeded if waiting wait_time seconds would run past deadline."""
+    remaining = time_left(deadline)
+    if remaining is not None and wait_time >= remaining:
+        raise CallDeadlineExceeded(f"[deadline] {what} needs {wait_time:.1f}s but only {max(remaining, 0.0):.1f}s are left")
+
+class RetryBudget:
+    """
+    Retry credit shared by every call in the run (token bucket): each retry spends one token,
+    each successful call earns ratio tokens, capped at max_tokens.
+    """
+    def __init__(self, initial=20, ratio=0.1, max_tokens=100):
+        self.tokens = float(initial)
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.spent = 0
+        self.denied = 0
+        self.lock = threading.Lock()
+
+    def try_spend(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.spent += 1
+                return True
+            self.denied += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def report(self):
+        with self.lock:
+            print(f"[retry-budget] {self.spent} retries spent, {self.denied} denied, {self.tokens:.1f} left")
+
+_budget = None
+_budget_lock = threading.Lock()
+
+def get_retry_budget():
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = RetryBudget(**config["retry_budget"])
+        return _budget
+
+def spend_retry(deadline, wait_time, what="retry"):
+    """
+    Checks a retry against the deadline and the run's retry budget. Raises CallDeadlineExceeded if the wait does not fit
+    before the deadline; returns False if the budget is spent (the caller then gives up with its last error).
+    """
+    check_deadline(deadline, wait_time, what)
+    if not get_retry_budget().try_spend():
+        print(f"[retry-budget] Retry budget exhausted; not retrying ({what})")
+        return False
+    return True
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from config import config
+
+# Request hedging: once a call has been outstanding longer than the model's live latency percentile, a duplicate
+# request goes out and whichever answers first wins. The threshold comes from the latencies of recent successful calls
+# of the same kind (e.g. "gemini-2.5-flash/json" for system-model extraction vs "gemini-2.5-flash/text" for long
+# assistant calls), so one kind's latency doesn't set the other's threshold.
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per model and call kind, plus how often hedges fired and won."""
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.hedges = defaultdict(lambda: {"fired": 0, "won": 0})
+        self.lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self.lock:
+            self.samples[key].append(seconds)
+
+    def percentile(self, key, q):
+        """Latency at quantile q for this model/call kind, or None until min_samples calls have been seen."""
+        with self.lock:
+            values = sorted(self.samples[key])
+        if len(values) < self.min_samples:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def record_hedge(self, key, won):
+        with self.lock:
+            self.hedges[key]["fired"] += 1
+            self.hedges[key]["won"] += int(won)
+
+    def report(self):
+        with self.lock:
+            models = list(self.samples)
+        for model in models:
+            p50 = self.percentile(model, 0.5)
+            p95 = self.percentile(model, 0.95)
+            hedges = self.hedges[model]
+            print(f"[hedge] {model}: calls={len(self.samples[model])} p50={p50 and round(p50, 2)}s p95={p95 and round(p95, 2)}s "
+                  f"hedges={hedges['fired']} hedge_wins={hedges['won']}")
+
+_tracker = None
+_lock = threading.Lock()
+
+def get_latency_tracker():
+    global _tracker
+    with _lock:
+        if _tracker is None:
+            settings = config["genai_hedging"]
+            _tracker = LatencyTracker(window=settings["window"], min_samples=settings["min_samples"])
+        return _tracker
+
+def _start(fn, name):
+    """Runs fn on a thread of its own right away and returns its Future. A shared pool would make requests queue behind
+    each other under load, and that queueing would count toward the hedge delay as if the request were slow."""
+    future = Future()
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future
+
+def hedge_delay(key):
+    """Seconds to wait on a call of this model/call kind before hedging it, or None while there is too little latency data."""
+    settings = config["genai_hedging"]
+    threshold = get_latency_tracker().percentile(key, settings["percentile"])
+    if threshold is None:
+        return None
+    return max(threshold, settings["min_delay_s"])
+
+def hedged_call(model, primary, make_hedge, delay):
+    """
+    Runs primary(); if it has not returned after delay seconds, calls make_hedge() for a duplicate request
+    (or None when no duplicate can be sent) and returns whichever succeeds first.
+    The losing request cannot be cancelled mid-flight in the sync client, so its result is simply ignored.
+    If both fail, the primary's exception is raised. The primary starts immediately on its own thread; the caller's
+    thread stays free to hand back whichever result arrives first.
+    """
+    primary_future = _start(primary, "hedge-primary")
+    try:
+        return primary_future.result(timeout=delay)
+    except FutureTimeoutError:
+        pass
+
+    hedge = make_hedge()
+    if hedge is None:
+        return primary_future.result()
+    hedge_future = _start(hedge, "hedge")
+
+    pending = {primary_future, hedge_future}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                get_latency_tracker().record_hedge(model, won=future is hedge_future)
+                return future.result()
+    get_latency_tracker().record_hedge(model, won=False)
+    raise primary_future.exception()
+
+async def ahedged_call(model, primary, make_hedge, delay):
+    """Async counterpart of hedged_call(); primary and the hedge are coroutine functions and the loser is cancelled."""
+    primary_task = asyncio.ensure_future(primary())
+    hedge_task = None
+    try:
+        done, _ = await asyncio.wait({primary_task}, timeout=delay)
+        if done:
+            return primary_task.result()
+
+        hedge = make_hedge()
+        if hedge is None:
+            return await primary_task
+        hedge_task = asyncio.ensure_future(hedge())
+
+        pending = {primary_task, hedge_task}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    get_latency_tracker().record_hedge(model, won=task is hedge_task)
+                    return task.result()
+        get_latency_tracker().record_hedge(model, won=False)
+        raise primary_task.exception()
+    finally:
+        for task in (primary_task, hedge_task):
+            if task is not None and not task.done():
+                task.cancel()
@@ -0,0 +1,135 @@
+import json, re
+from typing import Literal, get_args, get_origin
+
+# Typed schemas for generate_json(response_schema=...). A schema is written with Python types, e.g.
+#   {"answer": str}    {"response_type": Literal["answer_attempt", "clarification"]}    {"scores": [float]}
+# and converted to JSON Schema (Ollama's format=...) or Gemini's response_schema. Plain JSON-schema dicts are passed through.
+
+_TYPE_NAMES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+def is_json_schema(schema):
+    return isinstance(schema, dict) and isinstance(schema.get("type"), str)
+
+def to_json_schema(schema):
+    """Converts a typed schema to a JSON Schema dict (every object key is required, no extra keys)."""
+    if schema is None or is_json_schema(schema):
+        return schema
+    if isinstance(schema, type) and schema in _TYPE_NAMES:
+        return {"type": _TYPE_NAMES[schema]}
+    if get_origin(schema) is Literal:
+        values = list(get_args(schema))
+        return {"type": _TYPE_NAMES[type(values[0])], "enum": values}
+    if isinstance(schema, list):
+        return {"type": "array", "items": to_json_schema(schema[0])}
+    if get_origin(schema) is list:
+        return {"type": "array", "items": to_json_schema(get_args(schema)[0])}
+    if isinstance(schema, dict):
+        return {
+            "type": "object",
+            "properties": {key: to_json_schema(value) for key, value in schema.items()},
+            "required": list(schema),
+            "additionalProperties": False,
+        }
+    raise TypeError(f"[json] Unsupported schema type: {schema!r}")
+
+def to_gemini_schema(schema):
+    """JSON Schema -> the OpenAPI subset Gemini's response_schema accepts (no additionalProperties)."""
+    schema = to_json_schema(schema)
+    if schema is None:
+        return None
+    converted = {key: value for key, value in schema.items() if key not in ("additionalProperties", "properties", "items")}
+    if "properties" in schema:
+        converted["properties"] = {key: to_gemini_schema(value) for key, value in schema["properties"].items()}
+    if "items" in schema:
+        converted["items"] = to_gemini_schema(schema["items"])
+    return converted
+
+def _close_truncated(text):
+    """Closes the strings/brackets left open by a response cut off mid-JSON (e.g. by max_output_tokens)."""
+    stack = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+
+    if escaped:
+        text = text[:-1]
+    if in_string:
+        text += '"'
+    text = re.sub(r",\s*$", "", text) # a dangling comma before the closing bracket
+    if re.search(r'[{,]\s*"[^"]*"\s*:?\s*$', text): # a key with no value yet - drop it
+        text = re.sub(r',?\s*"[^"]*"\s*:?\s*$', "", text)
+    return text + "".join(reversed(stack))
+
+def repair_json(text):
+    """
+    Parses model output as JSON, tolerating the usual failure modes: ```json fences, prose before or after the
+    object, and output truncated mid-object. Raises ValueError if nothing parseable is found.
+    """
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise ValueError(f"Model did not return valid JSON: {text}")
+    candidate = text[min(starts):]
+
+    # prefixed / suffixed (this also covers fences): decode the first complete value and ignore the rest
+    try:
+        return json.JSONDecoder().raw_decode(candidate)[0]
+    except json.JSONDecodeError:
+        pass
+
+    candidate = re.sub(r"\s*```\s*$", "", candidate)
+    try:
+        return json.loads(_close_truncated(candidate))
+    except json.JSONDecodeError:
+        raise ValueError(f"Model did not return valid JSON: {text}")
+
+def validate(value, schema, path="$"):
+    """
+    Checks a parsed value against a typed or JSON schema and returns it, coercing scalars to strings where a
+    string is expected (models often answer {"answer": 2} for "2"). Raises ValueError on a mismatch.
+    """
+    schema = to_json_schema(schema)
+    if schema is None:
+        return value
+
+    expected = schema["type"]
+    if expected == "object":
+        if not isinstance(value, dict):
+            raise ValueError(f"[json] {path}: expected an object, got {value!r}")
+        missing = [key for key in schema.get("required", []) if key not in value]
+        if missing:
+            raise ValueError(f"[json] {path}: missing keys {missing}")
+        return {key: validate(item, schema["properties"][key], f"{path}.{key}") if key in schema.get("properties", {}) else item
+                for key, item in value.items()}
+    if expected == "array":
+        if not isinstance(value, list):
+            raise ValueError(f"[json] {path}: expected an array, got {value!r}")
+        return [validate(item, schema.get("items"), f"{path}[{i}]") for i, item in enumerate(value)]
+    if expected == "string" and isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    python_types = {"string": str, "integer": int, "number": (int, float), "boolean": bool}
+    if expected in python_types and not isinstance(value, python_types[expected]):
+        raise ValueError(f"[json] {path}: expected {expected}, got {value!r}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise ValueError(f"[json] {path}: {value!r} is not one of {schema['enum']}")
+    return value
+
+def parse_json(text, schema=None):
+    """repair_json() followed by validate()."""
+    return validate(repair_json(text), schema)
@@ -0,0 +1,205 @@
+import os, json, time, hashlib, sqlite3
+import threading
+import asyncio
+
+from config import config
+
+_MISS = object()
+
+class _InFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = _MISS
+        self.error = None
+
+class ResponseCache:
+    """
+    Disk-backed, content-addressed cache for model responses (SQLite).
+    Entries are keyed on a hash of the full request and evicted least-recently-used once the db grows past max_bytes.
+    Identical requests that are in flight at the same time are coalesced into a single model call.
+    """
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path or config["cache_path"]
+        self.max_bytes = max_bytes if max_bytes is not None else config["cache_max_bytes"]
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        self.in_flight = {}
+        self.async_in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(backend, model, messages, temperature, max_tokens=None, is_json=False, response_schema=None, stop=None, **extra):
+        """
+        Hashes everything that can change the response: backend, model, the fully formatted messages and the generation settings.
+        Extra keyword arguments (e.g. backend-specific options) are folded into the key as well.
+        """
+        if response_schema is not None and hasattr(response_schema, "model_json_schema"):
+            response_schema = response_schema.model_json_schema() # pydantic model
+        payload = {
+            "backend": backend,
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "is_json": is_json,
+            "response_schema": response_schema,
+            "extra": extra,
+        }
+        if stop:
+            payload["stop"] = list(stop) # only when set, so keys for calls without stop sequences are unchanged
+        payload_str = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload_str.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return _MISS
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        if value is None:
+            return # e.g. blocked responses; not worth remembering
+        value_str = json.dumps(value, ensure_ascii=False)
+        size = len(value_str.encode("utf-8")) + len(key)
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)", (key, value_str, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # other processes may share the db, so re-read the real size before evicting
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while self.total_bytes > target:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                evicted += 1
+                if self.total_bytes <= target:
+                    break
+        print(f"[cache] Evicted {evicted} entries ({self.total_bytes} bytes remaining)")
+
+    def get_or_compute(self, key, compute_fn):
+        """
+        Returns the cached value for key, or calls compute_fn() once and caches the result.
+        Concurrent callers with the same key wait for the first call instead of repeating it.
+        """
+        value = self.get(key)
+        if value is not _MISS:
+            with self.lock:
+                self.hits += 1
+            return value
+
+        with self.lock:
+            entry = self.in_flight.get(key)
+            is_owner = entry is None
+            if is_owner:
+                entry = _InFlight()
+                self.in_flight[key] = entry
+            else:
+                self.coalesced += 1
+
+        if not is_owner:
+            entry.event.wait()
+            if entry.error is not None:
+                raise entry.error
+            return entry.value
+
+        with self.lock:
+            self.misses += 1
+        try:
+            entry.value = compute_fn()
+            self.put(key, entry.value)
+            return entry.value
+        except Exception as e:
+            entry.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            entry.event.set()
+
+    async def aget_or_compute(self, key, coro_fn):
+        """
+        Async version of get_or_compute(); coro_fn() must return an awaitable.
+        Coalescing is per event loop: concurrent coroutines with the same key await one shared future.
+        """
+        value = self.get(key)
+        if value is not _MISS:
+            with self.lock:
+                self.hits += 1
+            return value
+
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        future = self.async_in_flight.get(flight_key)
+        if future is not None:
+            with self.lock:
+                self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = loop.create_future()
+        self.async_in_flight[flight_key] = future
+        with self.lock:
+            self.misses += 1
+        try:
+            value = await coro_fn()
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() # mark as retrieved so an unawaited failure doesn't warn
+            raise
+        finally:
+            del self.async_in_flight[flight_key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size_bytes": self.total_bytes,
+            }
+
+    def report(self):
+        s = self.stats()
+        print(f"[cache] hits={s['hits']} misses={s['misses']} coalesced={s['coalesced']} hit_rate={s['hit_rate']:.1%} size={s['size_bytes'] / 1e6:.1f}MB")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Returns the process-wide response cache, opening it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
+
+def cache_enabled(use_cache=True):
+    return use_cache and config["cache_enabled"]
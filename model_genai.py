@@ -1,12 +1,24 @@
-import os, json, time, re, random, copy
+import os, time, re, random
 import threading
+import asyncio
 from google.api_core.exceptions import ResourceExhausted, InternalServerError, Aborted, DeadlineExceeded
 from google.genai.errors import ClientError, ServerError  
 from dotenv import load_dotenv
 from google import genai
-from google.genai.types import GenerateContentConfig
+from google.genai.types import GenerateContentConfig, ThinkingConfig, HttpOptions
 import httpx
 
+from config import config
+from model_cache import ResponseCache, get_cache, cache_enabled
+from rate_limiter import KeyRateLimiter, estimate_tokens, get_rate_limits
+from streaming import consume_stream
+from concurrency import get_controller, is_overload_error
+from prompt_template import fill_variables
+from json_schema import to_json_schema, to_gemini_schema, parse_json
+from hedging import get_latency_tracker, hedge_delay, hedged_call, ahedged_call
+from quota_ledger import QuotaLedger, get_ledger
+from deadlines import CallDeadlineExceeded, make_deadline, time_left, check_deadline, spend_retry, get_retry_budget
+
 # Load .env
 load_dotenv()
 
@@ -15,30 +27,16 @@ def format_messages(messages, variables={}):
     Formats the messages list, substituting variables in the last user message.
     System messages are separated and returned.
     """
-    last_user_msg = [msg for msg in messages if msg["role"] == "user"][-1]
-
-    for k, v in variables.items():
-        key_string = f"[[{k}]]"
-        if key_string not in last_user_msg["content"]:
-            print(f"[prompt] Key {k} not found in prompt; effectively ignored")
-        assert isinstance(v, str), f"[prompt] Variable {k} is not a string"
-        last_user_msg["content"] = last_user_msg["content"].replace(key_string, v)
-
-    keys_still_in_prompt = re.findall(r"\[\[([^\]]+)\]\]", last_user_msg["content"])
-    if keys_still_in_prompt:
-        print(f"[prompt] The following keys were not replaced: {keys_still_in_prompt}")
-
-    # Separate system messages from the main conversation history - for genai api
-    genai_messages = copy.deepcopy(messages)
+    messages = fill_variables(messages, variables)
 
     system_message = None
-    for msg in genai_messages:
+    for msg in messages:
         if msg["role"] == "system":
             system_message = msg["content"]
             break
     
     # Filter out system messages from the conversation history passed to the API
-    genai_messages = [{"role": "model" if msg["role"] == "assistant" else msg["role"], "parts": [{"text": msg["content"]}]} for msg in genai_messages if msg["role"] != "system"]
+    genai_messages = [{"role": "model" if msg["role"] == "assistant" else msg["role"], "parts": [{"text": msg["content"]}]} for msg in messages if msg["role"] != "system"]
 
     return genai_messages, system_message
 
@@ -49,26 +47,150 @@ class GeminiModel:
         if not self.api_keys:
             raise ValueError("No API keys found. Set GEMINI_API_KEYS in .env")
 
-        self.current_key_index = 0
-        self.client = self._new_client(self.api_keys[self.current_key_index])
-        self.rotation_lock = threading.Lock()
+        # one persistent client per key; calls are spread over every healthy key instead of one active key
+        self.clients = [self._new_client(key) for key in self.api_keys]
+        self.pool_lock = threading.Lock()
+        self.disabled_keys = set() # invalid / revoked keys, never used again this run
+        self.key_failures = [0] * len(self.api_keys) # consecutive failures per key
+        self.key_cooldown_until = [0.0] * len(self.api_keys) # erroring keys are set aside until then
+        self.key_requests = [0] * len(self.api_keys)
+        # per-key daily usage survives restarts (quota_ledger.py), so exhausted keys are skipped without another 429
+        self.ledger = get_ledger()
+        self.key_ids = [QuotaLedger.key_id(key) for key in self.api_keys]
+        if self.ledger is not None:
+            self.ledger.report(self.key_ids)
+
+        self.semaphore = None
+        self.semaphore_loop = None
+        self.limiters = {} # (key index, model) -> KeyRateLimiter
+        self.limiter_lock = threading.Lock()
+        self.usage = {} # (model, thinking budget) -> token counts and latency, to weigh thinking against its cost
+        self.usage_lock = threading.Lock()
 
     def _new_client(self, key):
         return genai.Client(api_key=key)
 
-    def _rotate_key(self):
-        with self.rotation_lock:
-            self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-            self.client = self._new_client(self.api_keys[self.current_key_index])
-            print(f"[rotation] Switched to key index {self.current_key_index}")
+    def _get_limiter(self, key_index, model):
+        with self.limiter_lock:
+            limiter = self.limiters.get((key_index, model))
+            if limiter is None:
+                limiter = KeyRateLimiter(**get_rate_limits(model))
+                if self.ledger is not None:
+                    limiter.restore(*self.ledger.lookup(self.key_ids[key_index], model))
+                self.limiters[(key_index, model)] = limiter
+            return limiter
 
-    def _handle_api_exception(self, e, attempt, max_retries):
+    def _sync_ledger(self, model):
+        # exhaustion recorded by another process (or before a restart) takes effect on the next key choice
+        if self.ledger is None:
+            return
+        for i in range(len(self.api_keys)):
+            _, exhausted_until = self.ledger.lookup(self.key_ids[i], model)
+            if exhausted_until > time.time():
+                self._get_limiter(i, model).restore(exhausted_until=exhausted_until)
+
+    def _estimate_prompt_tokens(self, genai_messages, kwargs):
+        text = kwargs.get("system_instruction") or ""
+        for msg in genai_messages:
+            text += "".join(part["text"] for part in msg["parts"])
+        return estimate_tokens(text)
+
+    def _usable_keys(self, model):
+        return [i for i in range(len(self.api_keys)) if i not in self.disabled_keys and not self._get_limiter(i, model).is_exhausted()]
+
+    def _acquire_key(self, model, est_tokens, exclude=()):
         """
-        Handles API-related exceptions and determines the next action (retry/wait/rotate/raise).
-        Returns True if the process should continue (retry), False if it should stop (re-raise).
+        Picks the healthy key with the most quota headroom for this model and reserves one request on it.
+        Returns (key index, seconds to wait before sending), or (None, seconds) when every usable key is cooling down.
+        Raises once no key has daily quota left. Keys in exclude are never picked (used for hedges).
+        """
+        with self.pool_lock:
+            self._sync_ledger(model)
+            while True:
+                usable = self._usable_keys(model)
+                if not usable:
+                    raise RuntimeError(f"Daily limit reached for {model} on all {len(self.api_keys)} key(s).")
+
+                now = time.time()
+                ready = [i for i in usable if self.key_cooldown_until[i] <= now and i not in exclude]
+                if not ready:
+                    return None, max(0.0, min(self.key_cooldown_until[i] for i in usable) - now)
+
+                key_index = max(ready, key=lambda i: (self._get_limiter(i, model).headroom(), random.random()))
+                wait_time = self._get_limiter(key_index, model).reserve(est_tokens)
+                if wait_time is None:
+                    continue # hit the daily cap just now; pick again
+                self.key_requests[key_index] += 1
+                if self.ledger is not None:
+                    self.ledger.record_request(self.key_ids[key_index], model, self._get_limiter(key_index, model).day_reset)
+                if wait_time > 1:
+                    print(f"[rate-limit] Pacing key index {key_index} for {model}: waiting {wait_time:.1f}s")
+                return key_index, wait_time
+
+    def _release_key(self, key_index, model, est_tokens):
+        """Undoes _acquire_key() for a request that is not going to be sent: its quota goes back to the key and the ledger."""
+        limiter = self._get_limiter(key_index, model)
+        day_reset = limiter.day_reset
+        limiter.refund(est_tokens, day_reset)
+        with self.pool_lock:
+            self.key_requests[key_index] -= 1
+        if self.ledger is not None:
+            self.ledger.unrecord_request(self.key_ids[key_index], model, day_reset)
+
+    def _check_reserved(self, deadline, wait_time, key_index, model, est_tokens, what):
+        """check_deadline() for a request that already holds a key reservation; an abort returns the reservation first."""
+        try:
+            check_deadline(deadline, wait_time, what)
+        except CallDeadlineExceeded:
+            self._release_key(key_index, model, est_tokens)
+            raise
+
+    def _key_succeeded(self, key_index):
+        with self.pool_lock:
+            self.key_failures[key_index] = 0
+
+    def _key_failed(self, key_index):
+        with self.pool_lock:
+            self.key_failures[key_index] += 1
+            if self.key_failures[key_index] >= config["genai_key_error_threshold"]:
+                self.key_cooldown_until[key_index] = time.time() + config["genai_key_cooldown"]
+                self.key_failures[key_index] = 0
+                print(f"[pool] Key index {key_index} keeps failing. Setting it aside for {config['genai_key_cooldown']}s")
+
+    def _disable_key(self, key_index):
+        with self.pool_lock:
+            self.disabled_keys.add(key_index)
+            print(f"[pool] Key index {key_index} disabled ({len(self.api_keys) - len(self.disabled_keys)} key(s) left)")
+
+    def report_keys(self):
+        for i in range(len(self.api_keys)):
+            status = "disabled" if i in self.disabled_keys else ("cooling down" if self.key_cooldown_until[i] > time.time() else "ok")
+            print(f"[pool] key index {i}: {self.key_requests[i]} requests ({status})")
+
+    def _retry_delay(self, e, attempt, max_retries, model=None, key_index=None):
+        """
+        Classifies an API exception and decides the next action (retry/wait/rotate/raise).
+        Returns the number of seconds to wait before retrying, or None if the error should be re-raised.
+        The wait itself is left to the caller so the sync and async paths share the same policy.
         """
         error_message = str(e)
         error_code = getattr(e, 'code', None)
+
+        # 0. Handle invalid/revoked keys - drop the key from the pool and retry on another one
+        is_key_error = (
+            error_code in [401, 403] or
+            "API_KEY_INVALID" in error_message or
+            "API key not valid" in error_message or
+            "PERMISSION_DENIED" in error_message
+        )
+
+        if is_key_error and key_index is not None:
+            print(f"[Key Error] Key index {key_index}: {error_message[:100]}")
+            self._disable_key(key_index)
+            if len(self.disabled_keys) < len(self.api_keys):
+                return 0
+            print("No usable API keys left.")
+            return None
         
         # 1. Handle Rate Limit (429 RESOURCE_EXHAUSTED)
         is_rate_limit = (
@@ -89,21 +211,25 @@ class GeminiModel:
             
             if "per minute" in error_message.lower() or "perminute" in error_message.lower():
                 print(f"[rate-limit] Per-minute limit. Waiting {retry_delay}s...")
-                time.sleep(retry_delay)
-                return True
+                if model is not None and key_index is not None:
+                    self._get_limiter(key_index, model).penalize()
+                return retry_delay
 
             if "per day" in error_message.lower() or "perday" in error_message.lower():
-                if len(self.api_keys) > 1:
-                    print("[rate-limit] Daily limit hit. Rotating key...")
-                    self._rotate_key()
-                    return True
+                if model is not None and key_index is not None:
+                    limiter = self._get_limiter(key_index, model)
+                    limiter.mark_exhausted()
+                    if self.ledger is not None:
+                        self.ledger.mark_exhausted(self.key_ids[key_index], model, limiter.exhausted_until)
+                if model is not None and self._usable_keys(model):
+                    print("[rate-limit] Daily limit hit. Retrying on another key...")
+                    return 0
                 else:
                     print("Daily limit reached and no backup keys available.")
-                    return False
+                    return None
             
             print(f"[rate-limit] Waiting {retry_delay}s before retry...")
-            time.sleep(retry_delay)
-            return True
+            return retry_delay
         
         # 2. Handle Server Errors (500, 503 UNAVAILABLE) - ADD THIS
         is_server_error = (
@@ -119,8 +245,7 @@ class GeminiModel:
             wait_time = min((2 ** attempt) * 10, 120)  # Exponential backoff, max 2 min
             print(f"[Server Error] Attempt {attempt}/{max_retries}: {error_message[:100]}")
             print(f"[Server Error] Model overloaded. Waiting {wait_time}s before retry...")
-            time.sleep(wait_time)
-            return True
+            return wait_time
         
         # 3. Handle Network/Connection Errors (RemoteProtocolError, etc.) 
         is_network_error = (
@@ -132,63 +257,244 @@ class GeminiModel:
             "Connection" in error_message
         )
         
+        # transport failures may be the key's (or its route's) fault, so they count toward setting the key aside. Server
+        # errors are model-wide, auth and quota errors are handled per key above, and bad requests / unusable model output
+        # (ValueError from parse_json) say nothing about the key.
+        is_transient = isinstance(e, (Aborted, DeadlineExceeded))
+        if (is_network_error or is_transient) and key_index is not None:
+            self._key_failed(key_index)
+
         if is_network_error:
             wait_time = (2 ** attempt) + random.uniform(0, 1)
             print(f"[Network Error] Attempt {attempt}/{max_retries}. Waiting {wait_time:.1f}s...")
-            time.sleep(wait_time)
-            return True
+            return wait_time
 
         # 4. Handle Transient Errors (Aborted, DeadlineExceeded)
-        elif isinstance(e, (Aborted, DeadlineExceeded)):
+        elif is_transient:
             wait_time = (2**attempt) + random.uniform(0, 1)
             print(f"[Transient Error] {e.__class__.__name__}. Waiting {wait_time:.1f}s...")
-            time.sleep(wait_time)
-            return True
+            return wait_time
             
         # 4. Non-retryable
         else:
             print(f"[Non-Retryable Error] Attempt {attempt+1}/{max_retries}: {e.__class__.__name__}")
             print(f"  Message: {error_message[:200]}")
-            return False
+            return None
 
-    def generate(self, messages, model="gemini-2.5-flash", max_retries=10, temperature=1.0, is_json=False, response_schema=None, max_tokens=None, variables={}):
+    def _handle_api_exception(self, e, attempt, max_retries, model=None, key_index=None, deadline=None):
         """
-        Generates content from the model with retry logic.
-        Handles both text and JSON (via is_json/response_schema) generation.
+        Handles API-related exceptions and determines the next action (retry/wait/rotate/raise).
+        Returns True if the process should continue (retry), False if it should stop (re-raise).
+        Retries that wait spend the run's retry budget; raises CallDeadlineExceeded if the wait would run past the deadline.
         """
-        # Format messages and extract system instructions
-        genai_messages, system_message = format_messages(messages, variables)
+        wait_time = self._retry_delay(e, attempt, max_retries, model, key_index)
+        if wait_time is None:
+            return False
+        if wait_time > 0 and not spend_retry(deadline, wait_time, f"{model} retry {attempt}"): # moving to another key is free
+            return False
+        time.sleep(wait_time)
+        return True
 
-        # Configure the request
+    async def _ahandle_api_exception(self, e, attempt, max_retries, model=None, key_index=None, deadline=None):
+        """Async counterpart of _handle_api_exception(); waits with asyncio.sleep instead of blocking the thread."""
+        wait_time = self._retry_delay(e, attempt, max_retries, model, key_index)
+        if wait_time is None:
+            return False
+        if wait_time > 0 and not spend_retry(deadline, wait_time, f"{model} retry {attempt}"):
+            return False
+        await asyncio.sleep(wait_time)
+        return True
+
+    def _with_timeout(self, kwargs, deadline):
+        """Request config for one attempt: the HTTP timeout is whatever is left until the deadline, so a stuck call is cut off."""
+        remaining = time_left(deadline)
+        if remaining is None:
+            return kwargs
+        check_deadline(deadline, 0.0, "request")
+        return dict(kwargs, http_options=HttpOptions(timeout=int(remaining * 1000)))
+
+    def _get_semaphore(self):
+        # asyncio primitives are bound to the loop they are first used on, so rebuild per loop
+        loop = asyncio.get_running_loop()
+        if self.semaphore_loop is not loop:
+            self.semaphore = asyncio.Semaphore(config["genai_max_concurrency"])
+            self.semaphore_loop = loop
+        return self.semaphore
+
+    def _build_config(self, system_message, temperature, is_json, response_schema, max_tokens, stop=None, model=None, thinking_budget=None, candidate_count=None):
         kwargs = {"temperature": temperature}
+        if candidate_count is not None and candidate_count > 1:
+            kwargs["candidate_count"] = candidate_count
         if system_message:
             kwargs["system_instruction"] = system_message
-        if is_json:
+        if is_json or response_schema:
             kwargs["response_mime_type"] = "application/json"
         if response_schema:
-            # Assuming response_schema is a pydantic model or dict/list structure (??)
-            kwargs["response_schema"] = response_schema
+            # typed schema (e.g. {"answer": str}) or JSON schema -> constrained decoding on Gemini's side
+            kwargs["response_schema"] = to_gemini_schema(response_schema)
         if max_tokens is not None:
             kwargs["max_output_tokens"] = max_tokens
+        if stop:
+            kwargs["stop_sequences"] = list(stop)
+        if thinking_budget is not None and model is not None and any(name in model for name in config["reasoning_models"]):
+            # 0 disables thinking, -1 is dynamic; some models (2.5-pro) have a floor
+            if thinking_budget >= 0:
+                thinking_budget = max(thinking_budget, config["thinking_min_budget"].get(model, 0))
+            kwargs["thinking_config"] = ThinkingConfig(thinking_budget=thinking_budget)
+        return kwargs
 
-        # thinking_config=types.ThinkingConfig(thinking_budget=0), # Disables thinking
+    def _record_usage(self, model, kwargs, usage_metadata, latency):
+        thinking_config = kwargs.get("thinking_config")
+        key = (model, thinking_config.thinking_budget if thinking_config is not None else None)
+        with self.usage_lock:
+            usage = self.usage.setdefault(key, {"calls": 0, "prompt_tokens": 0, "output_tokens": 0, "thinking_tokens": 0, "latency_s": 0.0})
+            usage["calls"] += 1
+            usage["latency_s"] += latency
+            if usage_metadata is not None:
+                usage["prompt_tokens"] += usage_metadata.prompt_token_count or 0
+                usage["output_tokens"] += usage_metadata.candidates_token_count or 0
+                usage["thinking_tokens"] += usage_metadata.thoughts_token_count or 0
 
-        attempt = 0
-        while attempt < max_retries:
-            try:
-                response = self.client.models.generate_content(
+    def report_usage(self):
+        with self.usage_lock:
+            for (model, budget), usage in self.usage.items():
+                calls = usage["calls"]
+                print(f"[usage] {model} (thinking budget {'default' if budget is None else budget}): {calls} calls, "
+                      f"avg {usage['prompt_tokens'] / calls:.0f} prompt / {usage['output_tokens'] / calls:.0f} output / "
+                      f"{usage['thinking_tokens'] / calls:.0f} thinking tokens, avg latency {usage['latency_s'] / calls:.2f}s")
+
+    def _call_api(self, key_index, model, genai_messages, kwargs):
+        # one request under the model's adaptive concurrency limit; 429/503s shrink the limit, successes grow it
+        controller = get_controller("genai", model)
+        controller.acquire()
+        overloaded = succeeded = False
+        try:
+            start = time.perf_counter()
+            response = self.clients[key_index].models.generate_content(
+                model=model,
+                contents=genai_messages,
+                config=GenerateContentConfig(**kwargs),
+            )
+            latency = time.perf_counter() - start
+            get_latency_tracker().record(self._latency_key(model, kwargs), latency)
+            self._record_usage(model, kwargs, response.usage_metadata, latency)
+            succeeded = True
+            return response
+        except Exception as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            controller.release(overloaded=overloaded, succeeded=succeeded)
+
+    async def _acall_api(self, key_index, model, genai_messages, kwargs):
+        controller = get_controller("genai", model)
+        await controller.aacquire()
+        overloaded = succeeded = False
+        try:
+            async with self._get_semaphore():
+                start = time.perf_counter()
+                response = await self.clients[key_index].aio.models.generate_content(
                     model=model,
                     contents=genai_messages,
                     config=GenerateContentConfig(**kwargs),
                 )
-                
-                if is_json:
-                    # If JSON generation, return the parsed object
-                    return json.loads(response.text)
+            latency = time.perf_counter() - start
+            get_latency_tracker().record(self._latency_key(model, kwargs), latency)
+            self._record_usage(model, kwargs, response.usage_metadata, latency)
+            succeeded = True
+            return response
+        except Exception as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            controller.release(overloaded=overloaded, succeeded=succeeded)
+
+    def _should_hedge(self, hedge, temperature):
+        # None = automatic: hedge only near-deterministic calls, where a duplicate answer is as good as the original
+        if hedge is not None:
+            return hedge
+        settings = config["genai_hedging"]
+        return settings["enabled"] and temperature <= settings["max_temperature"] and len(self.api_keys) > 1
+
+    def _latency_key(self, model, kwargs):
+        # JSON calls (system-model extraction, T=0) and text calls (assistant, long outputs) have very different latencies
+        return f"{model}/{'json' if kwargs.get('response_mime_type') else 'text'}"
+
+    def _acquire_hedge_key(self, model, est_tokens, key_index):
+        """Reserves a different key for a hedge, or returns None if none is ready right now (the hedge is then skipped)."""
+        try:
+            hedge_key, wait_time = self._acquire_key(model, est_tokens, exclude=(key_index,))
+        except RuntimeError:
+            return None
+        if hedge_key is None:
+            return None
+        if wait_time > 0:
+            self._release_key(hedge_key, model, est_tokens) # not sent, so it must not cost quota
+            return None
+        print(f"[hedge] {model} call on key index {key_index} is slow; hedging on key index {hedge_key}")
+        return hedge_key
+
+    def _call_api_hedged(self, key_index, model, genai_messages, kwargs, est_tokens):
+        """
+        _call_api() with hedging: past the model's live p95 latency a duplicate goes out on another key.
+        Returns (key index that answered, response).
+        """
+        latency_key = self._latency_key(model, kwargs)
+        delay = hedge_delay(latency_key)
+        if delay is None:
+            return key_index, self._call_api(key_index, model, genai_messages, kwargs)
+
+        def make_hedge():
+            hedge_key = self._acquire_hedge_key(model, est_tokens, key_index)
+            if hedge_key is None:
+                return None
+            return lambda: (hedge_key, self._call_api(hedge_key, model, genai_messages, kwargs))
+
+        return hedged_call(latency_key, lambda: (key_index, self._call_api(key_index, model, genai_messages, kwargs)), make_hedge, delay)
+
+    async def _acall_api_hedged(self, key_index, model, genai_messages, kwargs, est_tokens):
+        latency_key = self._latency_key(model, kwargs)
+        delay = hedge_delay(latency_key)
+        if delay is None:
+            return key_index, await self._acall_api(key_index, model, genai_messages, kwargs)
+
+        async def call(index):
+            return index, await self._acall_api(index, model, genai_messages, kwargs)
+
+        def make_hedge():
+            hedge_key = self._acquire_hedge_key(model, est_tokens, key_index)
+            if hedge_key is None:
+                return None
+            return lambda: call(hedge_key)
+
+        return await ahedged_call(latency_key, lambda: call(key_index), make_hedge, delay)
+
+    def _generate_with_retries(self, model, genai_messages, kwargs, is_json, max_retries, hedge=False, deadline=None):
+        est_tokens = self._estimate_prompt_tokens(genai_messages, kwargs)
+        attempt = 0
+        while attempt < max_retries:
+            # pace ourselves under the key's quota instead of waiting for a 429
+            key_index, wait_time = self._acquire_key(model, est_tokens)
+            while key_index is None:
+                check_deadline(deadline, wait_time, f"{model} key cooldown")
+                time.sleep(wait_time)
+                key_index, wait_time = self._acquire_key(model, est_tokens)
+            if wait_time > 0:
+                self._check_reserved(deadline, wait_time, key_index, model, est_tokens, f"{model} rate-limit pacing")
+                time.sleep(wait_time)
+            self._check_reserved(deadline, 0.0, key_index, model, est_tokens, "request")
+            try:
+                request_kwargs = self._with_timeout(kwargs, deadline)
+                if hedge:
+                    answered_key, response = self._call_api_hedged(key_index, model, genai_messages, request_kwargs, est_tokens)
                 else:
-                    # Otherwise, return the raw text
-                    return response.text
+                    answered_key, response = key_index, self._call_api(key_index, model, genai_messages, request_kwargs)
+                self._key_succeeded(answered_key)
+                get_retry_budget().record_success()
+                return self._response_value(response, kwargs, is_json)
 
+            except CallDeadlineExceeded:
+                raise
             except Exception as e:
                 # If max retries is hit, or the handler determines it's non-recoverable, raise
                 if attempt >= max_retries:
@@ -196,7 +502,7 @@ class GeminiModel:
 
                 attempt += 1
                 # Delegate error handling and decision making to the separate function
-                should_retry = self._handle_api_exception(e, attempt, max_retries)
+                should_retry = self._handle_api_exception(e, attempt, max_retries, model, key_index, deadline)
                 
                 if not should_retry:
                     # If handler says "stop," re-raise the original exception
@@ -204,7 +510,90 @@ class GeminiModel:
                 
         raise Exception(f"Failed to generate content from GenAI after {max_retries} attempts.")
 
-    def generate_json(self, messages, model="gemini-2.5-flash", max_retries=10, temperature=1.0, is_json=True, response_schema=None, max_tokens=None, variables={}):
+    async def _agenerate_with_retries(self, model, genai_messages, kwargs, is_json, max_retries, hedge=False, deadline=None):
+        est_tokens = self._estimate_prompt_tokens(genai_messages, kwargs)
+        attempt = 0
+        while attempt < max_retries:
+            key_index, wait_time = self._acquire_key(model, est_tokens)
+            while key_index is None:
+                check_deadline(deadline, wait_time, f"{model} key cooldown")
+                await asyncio.sleep(wait_time)
+                key_index, wait_time = self._acquire_key(model, est_tokens)
+            if wait_time > 0:
+                self._check_reserved(deadline, wait_time, key_index, model, est_tokens, f"{model} rate-limit pacing")
+                await asyncio.sleep(wait_time)
+            self._check_reserved(deadline, 0.0, key_index, model, est_tokens, "request")
+            try:
+                if hedge:
+                    call = self._acall_api_hedged(key_index, model, genai_messages, kwargs, est_tokens)
+                else:
+                    call = self._acall_api(key_index, model, genai_messages, kwargs)
+                try:
+                    # the task is cancelled at the deadline, which also cancels the HTTP request
+                    result = await asyncio.wait_for(call, timeout=time_left(deadline))
+                except asyncio.TimeoutError:
+                    raise CallDeadlineExceeded(f"[deadline] {model} call did not finish before its deadline")
+                answered_key, response = result if hedge else (key_index, result)
+                self._key_succeeded(answered_key)
+                get_retry_budget().record_success()
+                return self._response_value(response, kwargs, is_json)
+
+            except CallDeadlineExceeded:
+                raise
+            except Exception as e:
+                attempt += 1
+                should_retry = await self._ahandle_api_exception(e, attempt, max_retries, model, key_index, deadline)
+                if not should_retry:
+                    raise e
+
+        raise Exception(f"Failed to generate content from GenAI after {max_retries} attempts.")
+
+    def _response_value(self, response, kwargs, is_json):
+        """What a successful call returns: the parsed JSON, the text, or one text per candidate for candidate_count > 1."""
+        count = kwargs.get("candidate_count", 1)
+        if count > 1:
+            # blocked / missing candidates come back as "" so the caller always gets count texts
+            texts = ["".join(part.text for part in (candidate.content.parts or []) if part.text) if candidate.content is not None else ""
+                     for candidate in (response.candidates or [])[:count]]
+            return texts + [""] * (count - len(texts))
+        if is_json:
+            # If JSON generation, return the parsed object (repairing fenced/truncated output, checked against the schema)
+            return parse_json(response.text, kwargs.get("response_schema"))
+        # Otherwise, return the raw text
+        return response.text
+
+    def _cache_extra(self, thinking_budget):
+        # only part of the cache key when set, so entries for calls without a budget stay valid
+        return {"thinking_budget": thinking_budget} if thinking_budget is not None else {}
+
+    def generate(self, messages, model="gemini-2.5-flash", max_retries=10, temperature=1.0, is_json=False, response_schema=None, max_tokens=None, stop=None, variables={}, use_cache=True, hedge=None, thinking_budget=None, deadline=None):
+        """
+        Generates content from the model with retry logic.
+        Handles both text and JSON (via is_json/response_schema) generation.
+        Responses are served from the on-disk response cache when possible; pass use_cache=False to always sample fresh.
+        response_schema may be a typed schema such as {"answer": str} (see json_schema.py) or a JSON schema.
+        hedge=None hedges slow calls automatically at temperature 0 (config["genai_hedging"]); True/False forces it on/off.
+        thinking_budget caps thinking tokens on Gemini 2.5 (0 = off, None = model default); see config["thinking_budgets"].
+        deadline is an absolute time.time() by which the call must finish (default: config["call_timeout_s"] from now);
+        raises deadlines.CallDeadlineExceeded when it can't, so the caller can re-queue the work.
+        """
+        deadline = deadline if deadline is not None else make_deadline()
+        # Format messages and extract system instructions
+        genai_messages, system_message = format_messages(messages, variables)
+        response_schema = to_json_schema(response_schema)
+
+        # Configure the request
+        kwargs = self._build_config(system_message, temperature, is_json, response_schema, max_tokens, stop, model, thinking_budget)
+
+        hedge = self._should_hedge(hedge, temperature)
+
+        if not cache_enabled(use_cache):
+            return self._generate_with_retries(model, genai_messages, kwargs, is_json, max_retries, hedge, deadline)
+
+        cache_key = ResponseCache.make_key("genai", model, {"system": system_message, "contents": genai_messages}, temperature, max_tokens=max_tokens, is_json=is_json, response_schema=response_schema, stop=stop, **self._cache_extra(thinking_budget))
+        return get_cache().get_or_compute(cache_key, lambda: self._generate_with_retries(model, genai_messages, kwargs, is_json, max_retries, hedge, deadline))
+
+    def generate_json(self, messages, model="gemini-2.5-flash", max_retries=10, temperature=1.0, is_json=True, response_schema=None, max_tokens=None, stop=None, variables={}, use_cache=True, hedge=None, thinking_budget=None, deadline=None):
         """
         Convenience wrapper for generate() to enforce JSON output and parse the result.
         """
@@ -216,13 +605,177 @@ class GeminiModel:
             is_json=True, 
             response_schema=response_schema,
             max_tokens=max_tokens,
-            variables=variables
+            stop=stop,
+            variables=variables,
+            use_cache=use_cache,
+            hedge=hedge,
+            thinking_budget=thinking_budget,
+            deadline=deadline
+        )
+
+    def generate_n(self, messages, n, model="gemini-2.5-flash", max_retries=10, temperature=1.0, max_tokens=None, stop=None, variables={}, use_cache=True, thinking_budget=None, deadline=None):
+        """
+        n independent samples for one prompt, served by candidate_count (at most config["genai_max_candidates"] per request),
+        so the prompt is sent and billed once per request instead of once per sample. Returns a list of n texts.
+        """
+        deadline = deadline if deadline is not None else make_deadline()
+        genai_messages, system_message = format_messages(messages, variables)
+        texts = []
+        while len(texts) < n:
+            count = min(n - len(texts), config["genai_max_candidates"])
+            kwargs = self._build_config(system_message, temperature, False, None, max_tokens, stop, model, thinking_budget, candidate_count=count)
+            compute = lambda: self._generate_with_retries(model, genai_messages, kwargs, False, max_retries, False, deadline)
+            if not cache_enabled(use_cache):
+                result = compute()
+            else:
+                # candidate_count / chunk only enter the key when set, so a single candidate shares generate()'s entry
+                extra = self._cache_extra(thinking_budget)
+                if count > 1:
+                    extra["candidate_count"] = count
+                if texts:
+                    extra["chunk"] = len(texts)
+                cache_key = ResponseCache.make_key("genai", model, {"system": system_message, "contents": genai_messages}, temperature, max_tokens=max_tokens, stop=stop, **extra)
+                result = get_cache().get_or_compute(cache_key, compute)
+            texts.extend(result if count > 1 else [result])
+        return texts
+
+    def stream(self, messages, model="gemini-2.5-flash", max_retries=10, temperature=1.0, max_tokens=None, stop=None, variables={}, thinking_budget=None, deadline=None):
+        """
+        Yields the response text chunk by chunk as it arrives (generate_content_stream).
+        Failures before the first chunk are retried with the usual policy; once text has been yielded, errors propagate.
+        """
+        deadline = deadline if deadline is not None else make_deadline()
+        genai_messages, system_message = format_messages(messages, variables)
+        kwargs = self._build_config(system_message, temperature, False, None, max_tokens, stop, model, thinking_budget)
+        est_tokens = self._estimate_prompt_tokens(genai_messages, kwargs)
+
+        attempt = 0
+        while True:
+            key_index, wait_time = self._acquire_key(model, est_tokens)
+            while key_index is None:
+                check_deadline(deadline, wait_time, f"{model} key cooldown")
+                time.sleep(wait_time)
+                key_index, wait_time = self._acquire_key(model, est_tokens)
+            if wait_time > 0:
+                self._check_reserved(deadline, wait_time, key_index, model, est_tokens, f"{model} rate-limit pacing")
+                time.sleep(wait_time)
+            self._check_reserved(deadline, 0.0, key_index, model, est_tokens, "request")
+
+            started = False
+            controller = get_controller("genai", model)
+            controller.acquire()
+            error = None
+            usage_metadata = None
+            start = time.perf_counter()
+            try:
+                response_stream = self.clients[key_index].models.generate_content_stream(
+                    model=model,
+                    contents=genai_messages,
+                    config=GenerateContentConfig(**self._with_timeout(kwargs, deadline)),
+                )
+                try:
+                    for chunk in response_stream:
+                        usage_metadata = chunk.usage_metadata or usage_metadata # running totals; the last chunk has the final counts
+                        if chunk.text:
+                            started = True
+                            yield chunk.text
+                finally:
+                    if hasattr(response_stream, "close"):
+                        response_stream.close() # closing early cancels the request
+            except Exception as e:
+                error = e
+            finally:
+                controller.release(overloaded=error is not None and is_overload_error(error), succeeded=error is None)
+
+            if error is None:
+                self._key_succeeded(key_index)
+                get_retry_budget().record_success()
+                self._record_usage(model, kwargs, usage_metadata, time.perf_counter() - start)
+                return
+            if started:
+                raise error
+            attempt += 1
+            if isinstance(error, CallDeadlineExceeded) or attempt >= max_retries or not self._handle_api_exception(error, attempt, max_retries, model, key_index, deadline):
+                raise error
+
+    def generate_stream(self, messages, model="gemini-2.5-flash", max_retries=10, temperature=1.0, max_tokens=None, stop=None, variables={}, stop_predicate=None, on_token=None, thinking_budget=None, deadline=None):
+        """
+        Streams a text response, stopping as soon as stop_predicate(text_so_far) is True.
+        Returns (text, metrics) with time-to-first-token and tokens/sec. Streamed calls bypass the response cache.
+        """
+        chunks = self.stream(messages, model=model, max_retries=max_retries, temperature=temperature, max_tokens=max_tokens, stop=stop, variables=variables, thinking_budget=thinking_budget, deadline=deadline)
+        return consume_stream(chunks, model, stop_predicate=stop_predicate, on_token=on_token)
+
+    async def agenerate(self, messages, model="gemini-2.5-flash", max_retries=10, temperature=1.0, is_json=False, response_schema=None, max_tokens=None, stop=None, variables={}, use_cache=True, hedge=None, thinking_budget=None, deadline=None):
+        """
+        Async version of generate() on the genai async client.
+        At most config["genai_max_concurrency"] requests are in flight at once; retries wait with asyncio.sleep.
+        """
+        deadline = deadline if deadline is not None else make_deadline()
+        genai_messages, system_message = format_messages(messages, variables)
+        response_schema = to_json_schema(response_schema)
+        kwargs = self._build_config(system_message, temperature, is_json, response_schema, max_tokens, stop, model, thinking_budget)
+
+        hedge = self._should_hedge(hedge, temperature)
+
+        if not cache_enabled(use_cache):
+            return await self._agenerate_with_retries(model, genai_messages, kwargs, is_json, max_retries, hedge, deadline)
+
+        cache_key = ResponseCache.make_key("genai", model, {"system": system_message, "contents": genai_messages}, temperature, max_tokens=max_tokens, is_json=is_json, response_schema=response_schema, stop=stop, **self._cache_extra(thinking_budget))
+        return await get_cache().aget_or_compute(cache_key, lambda: self._agenerate_with_retries(model, genai_messages, kwargs, is_json, max_retries, hedge, deadline))
+
+    async def agenerate_json(self, messages, model="gemini-2.5-flash", max_retries=10, temperature=1.0, is_json=True, response_schema=None, max_tokens=None, stop=None, variables={}, use_cache=True, hedge=None, thinking_budget=None, deadline=None):
+        """
+        Async version of generate_json().
+        """
+        return await self.agenerate(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            max_retries=max_retries,
+            is_json=True,
+            response_schema=response_schema,
+            max_tokens=max_tokens,
+            stop=stop,
+            variables=variables,
+            use_cache=use_cache,
+            hedge=hedge,
+            thinking_budget=thinking_budget,
+            deadline=deadline
         )
         
-# convenience functions
-model = GeminiModel()
-generate = model.generate
-generate_json = model.generate_json
+# convenience functions - GeminiModel is only built on first use, so importing this module needs no API keys
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = GeminiModel()
+        return _model
+
+def generate(*args, **kwargs):
+    return get_model().generate(*args, **kwargs)
+
+def generate_json(*args, **kwargs):
+    return get_model().generate_json(*args, **kwargs)
+
+def generate_stream(*args, **kwargs):
+    return get_model().generate_stream(*args, **kwargs)
+
+def generate_n(*args, **kwargs):
+    return get_model().generate_n(*args, **kwargs)
+
+async def agenerate(*args, **kwargs):
+    return await get_model().agenerate(*args, **kwargs)
+
+async def agenerate_json(*args, **kwargs):
+    return await get_model().agenerate_json(*args, **kwargs)
+
+def report_usage():
+    if _model is not None:
+        _model.report_usage()
 
 
 if __name__ == "__main__":
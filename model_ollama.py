@@ -1,54 +1,481 @@
-from ollama import Client
-import json, re, time
+from ollama import Client, AsyncClient
+import os, re, json, time
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-def format_messages(messages, variables={}):
-    last_user_msg = [msg for msg in messages if msg["role"] == "user"][-1]
+from config import config
+from model_cache import ResponseCache, get_cache, cache_enabled
+from streaming import consume_stream
+from concurrency import get_controller, is_overload_error, is_connection_error
+from prompt_template import fill_variables
+from json_schema import to_json_schema, parse_json
+from rate_limiter import estimate_tokens
+from deadlines import CallDeadlineExceeded, make_deadline, time_left, check_deadline, spend_retry, get_retry_budget
 
-    for k, v in variables.items():
-        key_string = f"[[{k}]]"
-        if key_string not in last_user_msg["content"]:
-            print(f"[prompt] Key {k} not found in prompt; effectively ignored")
-        assert isinstance(v, str), f"[prompt] Variable {k} is not a string"
-        last_user_msg["content"] = last_user_msg["content"].replace(key_string, v)
+def format_messages(messages, variables={}):
+    return fill_variables(messages, variables)
 
-    keys_still_in_prompt = re.findall(r"\[\[([^\]]+)\]\]", last_user_msg["content"])
-    if keys_still_in_prompt:
-        print(f"[prompt] The following keys were not replaced: {keys_still_in_prompt}")
+def profile_path(model):
+    """Where ollama_tune.py writes the tuned options for model."""
+    return os.path.join(config["ollama_profiles_dir"], re.sub(r"[^A-Za-z0-9_.-]", "_", model) + ".json")
 
-    return messages
+def load_profile(model):
+    """The tuned profile for model, or None if it has not been tuned (or profiles are off)."""
+    path = profile_path(model)
+    if not config["ollama_use_profiles"] or not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
 
 class OllamaModel:
-    def __init__(self, host="http://localhost:11434"):
-        self.client = Client(host=host)
+    def __init__(self, host="http://localhost:11434", name="ollama"):
+        self.host = host
+        self.name = name # concurrency-controller name; one per host when several hosts are pooled (ollama_pool.py)
+        # every request is bounded by call_timeout_s, so a hung server cannot hold a sweep worker past its deadline
+        self.client = Client(host=host, timeout=config["call_timeout_s"])
+        # the async client and semaphore are bound to an event loop, so they are created on first use in that loop
+        self.async_client = None
+        self.semaphore = None
+        self.async_loop = None
+        self.max_ctx = {} # model -> maximum context length, looked up once per model
+        self.max_ctx_lock = threading.Lock()
+        # model residency: keep_alive holds the active model in memory between calls; loads/unloads are counted and timed
+        self.keep_alive = config["ollama_keep_alive"]
+        self.residency = {} # model -> {"loads": n, "load_s": seconds spent loading, "unloads": n}
+        self.loaded = set() # models we have seen loaded on this host
+        self.preloading = set()
+        self.residency_lock = threading.Lock()
+        # load signals for routing across hosts: requests queued or running here, and smoothed request latency per model
+        self.in_flight = 0
+        self.latency = {} # model -> EWMA of request seconds, excluding model load time
+        self.stats_lock = threading.Lock()
+        self.retry_connection_errors = True # a pool (ollama_pool.py) fails over to another host instead
+        self.profiles = {} # model -> tuned profile from ollama_tune.py (or None), read once per model
+        self.profiles_lock = threading.Lock()
 
-    def generate(self, messages, model="sailor2:1b", max_retries=3, temperature=1.0, variables={}):
-        N = 0
-        messages = format_messages(messages, variables)
+    def _get_async_client(self):
+        loop = asyncio.get_running_loop()
+        if self.async_loop is not loop:
+            self.async_client = AsyncClient(host=self.host, timeout=config["call_timeout_s"])
+            self.semaphore = asyncio.Semaphore(config["ollama_max_concurrency"])
+            self.async_loop = loop
+        return self.async_client, self.semaphore
+
+    def _get_max_ctx(self, model):
+        """The model's trained context length from `ollama show` (or config["ollama_max_ctx"]); None if unknown."""
+        with self.max_ctx_lock:
+            if model not in self.max_ctx:
+                max_ctx = config["ollama_max_ctx"].get(model)
+                if max_ctx is None:
+                    try:
+                        info = self.client.show(model)
+                        model_info = getattr(info, "modelinfo", None) or info.get("model_info") or {} # older clients return a dict
+                        max_ctx = next((v for k, v in model_info.items() if k.endswith(".context_length")), None)
+                    except Exception as e:
+                        print(f"[ollama] Could not read the context length of {model}: {e}")
+                self.max_ctx[model] = max_ctx
+            return self.max_ctx[model]
+
+    def _pick_num_ctx(self, model, messages, max_tokens):
+        """Smallest num_ctx bucket that holds the prompt plus the output budget, capped at the model's maximum."""
+        prompt_tokens = sum(estimate_tokens(msg["content"]) for msg in messages) + 8 * len(messages) # + chat template tokens
+        needed = prompt_tokens + (max_tokens if max_tokens is not None else config["ollama_default_output_tokens"])
+        buckets = config["ollama_num_ctx_buckets"]
+        num_ctx = next((bucket for bucket in buckets if bucket >= needed), buckets[-1])
+
+        max_ctx = self._get_max_ctx(model)
+        if max_ctx is not None and num_ctx > max_ctx:
+            num_ctx = max_ctx
+        if needed > num_ctx:
+            print(f"[ollama] Prompt (~{prompt_tokens} tokens) + output budget needs ~{needed} tokens but {model} allows {num_ctx}; the prompt will be truncated")
+        return num_ctx
+
+    def _residency(self, model):
+        return self.residency.setdefault(model, {"loads": 0, "load_s": 0.0, "unloads": 0})
+
+    def _record_load(self, model, load_s):
+        """Counts a model load (load_s above config["ollama_load_event_s"]) and notices which models it pushed out of memory."""
+        if load_s < config["ollama_load_event_s"]:
+            return
+        print(f"[ollama] Loaded {model} in {load_s:.1f}s")
+        resident = self.resident_models()
+        with self.residency_lock:
+            stats = self._residency(model)
+            stats["loads"] += 1
+            stats["load_s"] += load_s
+            if resident is not None:
+                for other in self.loaded - resident - {model}:
+                    self._residency(other)["unloads"] += 1
+                    print(f"[ollama] {other} was unloaded")
+                self.loaded &= resident
+            self.loaded.add(model)
+
+    def _should_retry(self, e):
+        return self.retry_connection_errors or not is_connection_error(e)
 
+    def _begin_request(self):
+        with self.stats_lock:
+            self.in_flight += 1
+
+    def _end_request(self, model, start, response=None):
+        with self.stats_lock:
+            self.in_flight -= 1
+            if response is not None:
+                seconds = time.perf_counter() - start - (self._load_seconds(response) or 0.0)
+                previous = self.latency.get(model)
+                alpha = config["ollama_latency_alpha"]
+                self.latency[model] = seconds if previous is None else alpha * seconds + (1 - alpha) * previous
+
+    def _load_seconds(self, response):
+        # load_duration (ns) is only significant when the request had to load the model first
+        load_duration = response.get("load_duration") if hasattr(response, "get") else getattr(response, "load_duration", None)
+        return load_duration / 1e9 if load_duration else None
+
+    def _record_response(self, model, response):
+        load_s = self._load_seconds(response)
+        if load_s is not None:
+            self._record_load(model, load_s)
+
+    def resident_models(self):
+        """Names of the models currently loaded on the server (`ollama ps`), or None if the server can't be asked."""
+        try:
+            listing = self.client.ps()
+        except Exception as e:
+            print(f"[ollama] Could not list loaded models: {e}")
+            return None
+        models = getattr(listing, "models", None) or listing.get("models", []) # older clients return a dict
+        return {getattr(entry, "model", None) or entry.get("model") or entry.get("name") for entry in models}
+
+    def preload(self, model, wait=False):
+        """
+        Loads model into memory ahead of its first request (an empty chat request), held by keep_alive.
+        Runs in the background unless wait=True; a preload already running for the model is not repeated.
+        """
+        with self.residency_lock:
+            if model in self.preloading:
+                return
+            self.preloading.add(model)
+
+        def load():
+            try:
+                start = time.perf_counter()
+                response = self.client.chat(model=model, messages=[], keep_alive=self.keep_alive)
+                load_s = self._load_seconds(response)
+                self._record_load(model, load_s if load_s is not None else time.perf_counter() - start)
+            except Exception as e:
+                print(f"[ollama] Preloading {model} failed: {e}")
+            finally:
+                with self.residency_lock:
+                    self.preloading.discard(model)
+
+        print(f"[ollama] Preloading {model}")
+        if wait:
+            load()
+        else:
+            threading.Thread(target=load, name=f"preload-{model}", daemon=True).start()
+
+    def unload(self, model):
+        """Evicts model from memory now (keep_alive=0)."""
+        try:
+            self.client.chat(model=model, messages=[], keep_alive=0)
+        except Exception as e:
+            print(f"[ollama] Unloading {model} failed: {e}")
+            return
+        with self.residency_lock:
+            self._residency(model)["unloads"] += 1
+            self.loaded.discard(model)
+        print(f"[ollama] Unloaded {model}")
+
+    def report_residency(self):
+        with self.residency_lock:
+            residency = {model: dict(stats) for model, stats in self.residency.items()}
+        for model, stats in residency.items():
+            print(f"[ollama] {model}: {stats['loads']} loads ({stats['load_s']:.1f}s loading), {stats['unloads']} unloads")
+        resident = self.resident_models()
+        if resident is not None:
+            print(f"[ollama] Resident now: {sorted(resident) or 'none'}")
+
+    def _get_profile(self, model):
+        """
+        The model's tuned profile, read on first use. Its concurrency becomes the ceiling of the model's AIMD controller:
+        past that point the tuner measured throughput going down on this CPU.
+        """
+        with self.profiles_lock:
+            if model in self.profiles:
+                return self.profiles[model]
+            try:
+                profile = load_profile(model)
+            except Exception as e:
+                print(f"[ollama] Ignoring unreadable profile for {model}: {e}")
+                profile = None
+            self.profiles[model] = profile
+        if profile is not None:
+            controller = get_controller(self.name, model)
+            controller.max_limit = profile["concurrency"]
+            controller.limit = min(controller.limit, profile["concurrency"])
+            print(f"[ollama] {model}: using tuned profile {profile['options']} at concurrency {profile['concurrency']} (tuned {profile['tuned_at']})")
+        return profile
+
+    def _build_options(self, model, temperature, max_tokens=None, stop=None, num_ctx=None):
+        # tuned CPU options (num_thread, num_batch) first, so per-call settings win; they do not change the output, so stay out of the cache key
+        profile = self._get_profile(model)
+        options = dict(profile["options"]) if profile else {}
+        options["temperature"] = temperature
+        if max_tokens is not None:
+            options["num_predict"] = max_tokens
+        if stop:
+            options["stop"] = list(stop)
+        if num_ctx is not None:
+            options["num_ctx"] = num_ctx
+        return options
+
+    def _build_format(self, is_json, response_schema):
+        # a JSON schema turns on Ollama's grammar-constrained decoding; "json" only guarantees syntactically valid JSON
+        if response_schema is not None:
+            return response_schema
+        return "json" if is_json else None
+
+    def _call_api(self, messages, model, options, format=None):
+        # one request under the model's adaptive concurrency limit (see concurrency.py)
+        controller = get_controller(self.name, model)
+        self._begin_request()
+        controller.acquire()
+        overloaded = succeeded = False
+        response = request_start = None
+        try:
+            request_start = time.perf_counter()
+            if format is not None:
+                response = self.client.chat(model=model, messages=messages, options=options, format=format, keep_alive=self.keep_alive)
+            else:
+                response = self.client.chat(model=model, messages=messages, options=options, keep_alive=self.keep_alive)
+            self._record_response(model, response)
+            succeeded = True
+            return response
+        except Exception as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            controller.release(overloaded=overloaded, succeeded=succeeded)
+            self._end_request(model, request_start, response)
+
+    async def _acall_api(self, messages, model, options, format=None):
+        client, semaphore = self._get_async_client()
+        controller = get_controller(self.name, model)
+        self._begin_request()
+        await controller.aacquire()
+        overloaded = succeeded = False
+        response = request_start = None
+        try:
+            async with semaphore:
+                request_start = time.perf_counter()
+                if format is not None:
+                    response = await client.chat(model=model, messages=messages, options=options, format=format, keep_alive=self.keep_alive)
+                else:
+                    response = await client.chat(model=model, messages=messages, options=options, keep_alive=self.keep_alive)
+            self._record_response(model, response)
+            succeeded = True
+            return response
+        except Exception as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            controller.release(overloaded=overloaded, succeeded=succeeded)
+            self._end_request(model, request_start, response)
+
+    def _generate_with_retries(self, messages, model, max_retries, options, format=None, deadline=None):
+        # each request times out after call_timeout_s (the client's timeout); the deadline is checked before each attempt and on every backoff
+        N = 0
         while True:
+            check_deadline(deadline, 0.0, f"{model} request")
             try:
-                response = self.client.chat(model=model, messages=messages, options={"temperature": temperature})
+                response = self._call_api(messages, model, options, format)
                 response_text = response["message"]["content"]
+                get_retry_budget().record_success()
                 return response_text
             except Exception as e:
+                remaining = time_left(deadline)
+                if remaining is not None and remaining <= 0:
+                    raise CallDeadlineExceeded(f"[deadline] {model} call did not finish before its deadline") from e
                 N += 1
-                if N >= max_retries:
+                if N >= max_retries or not self._should_retry(e) or not spend_retry(deadline, 2, f"{model} retry {N}"):
                     raise e
                 time.sleep(2)
 
-    def generate_json(self, messages, model="sailor2:1b", **kwargs):
-        response_text = self.generate(messages, model=model, **kwargs)
-        try:
-            parsed = json.loads(response_text)
-        except json.JSONDecodeError:
-            raise ValueError(f"Model did not return valid JSON: {response_text}")
-        return parsed
-
-# convenience functions
-model = OllamaModel()
-generate = model.generate
-generate_json = model.generate_json
+    async def _agenerate_with_retries(self, messages, model, max_retries, options, format=None, deadline=None):
+        N = 0
+        while True:
+            check_deadline(deadline, 0.0, f"{model} request")
+            try:
+                response = await asyncio.wait_for(self._acall_api(messages, model, options, format), timeout=time_left(deadline))
+                get_retry_budget().record_success()
+                return response["message"]["content"]
+            except asyncio.TimeoutError:
+                raise CallDeadlineExceeded(f"[deadline] {model} call did not finish before its deadline")
+            except Exception as e:
+                N += 1
+                if N >= max_retries or not self._should_retry(e) or not spend_retry(deadline, 2, f"{model} retry {N}"):
+                    raise e
+                await asyncio.sleep(2)
+
+    def generate(self, messages, model="sailor2:1b", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, use_cache=True, is_json=False, response_schema=None, thinking_budget=None, deadline=None):
+        # thinking_budget is accepted for the same call contract as the Gemini backend; Ollama has no token-level thinking budget
+        deadline = deadline if deadline is not None else make_deadline()
+        messages = format_messages(messages, variables)
+        options = self._build_options(model, temperature, max_tokens, stop, self._pick_num_ctx(model, messages, max_tokens))
+        response_schema = to_json_schema(response_schema)
+        format = self._build_format(is_json, response_schema)
+
+        def compute():
+            response_text = self._generate_with_retries(messages, model, max_retries, options, format, deadline)
+            if is_json:
+                parse_json(response_text, response_schema) # raises ValueError, so JSON that fails the schema is never cached
+            return response_text
+        if not cache_enabled(use_cache):
+            return compute()
+
+        cache_key = ResponseCache.make_key("ollama", model, messages, temperature, max_tokens=max_tokens, is_json=is_json, response_schema=response_schema, stop=stop)
+        return get_cache().get_or_compute(cache_key, compute)
+
+    def generate_json(self, messages, model="sailor2:1b", response_schema=None, **kwargs):
+        """
+        JSON output via Ollama's format= (schema-constrained when response_schema is given, e.g. {"answer": str}).
+        Fenced, prefixed or truncated JSON is repaired before being checked against the schema; raises ValueError if that fails.
+        """
+        response_text = self.generate(messages, model=model, is_json=True, response_schema=response_schema, **kwargs)
+        return parse_json(response_text, response_schema)
+
+    def generate_n(self, messages, n, model="sailor2:1b", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, use_cache=True, thinking_budget=None, deadline=None):
+        """
+        n independent samples for one prompt, sent as n concurrent requests. With OLLAMA_NUM_PARALLEL > 1 the server runs
+        them in parallel slots and copies the evaluated prompt between slots rather than re-evaluating it per sample.
+        Returns a list of n texts.
+        """
+        deadline = deadline if deadline is not None else make_deadline()
+        messages = format_messages(messages, variables)
+        options = self._build_options(model, temperature, max_tokens, stop, self._pick_num_ctx(model, messages, max_tokens))
+
+        def sample(index):
+            if not cache_enabled(use_cache):
+                return self._generate_with_retries(messages, model, max_retries, options, None, deadline)
+            # candidate 0 shares generate()'s cache entry; the others are keyed by index
+            extra = {"candidate": index} if index else {}
+            cache_key = ResponseCache.make_key("ollama", model, messages, temperature, max_tokens=max_tokens, stop=stop, **extra)
+            return get_cache().get_or_compute(cache_key, lambda: self._generate_with_retries(messages, model, max_retries, options, None, deadline))
+
+        # the AIMD controller still bounds how many of these are in flight at once
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            return list(executor.map(sample, range(n)))
+
+    def stream(self, messages, model="sailor2:1b", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, thinking_budget=None, deadline=None):
+        """Yields the response text chunk by chunk; failures before the first chunk are retried."""
+        deadline = deadline if deadline is not None else make_deadline()
+        messages = format_messages(messages, variables)
+        options = self._build_options(model, temperature, max_tokens, stop, self._pick_num_ctx(model, messages, max_tokens))
+        N = 0
+        while True:
+            check_deadline(deadline, 0.0, f"{model} request")
+            started = False
+            controller = get_controller(self.name, model)
+            # counted in flight like any other request, so a pool doesn't take a host serving streams for idle
+            self._begin_request()
+            controller.acquire()
+            error = None
+            final = None
+            request_start = time.perf_counter()
+            try:
+                for chunk in self.client.chat(model=model, messages=messages, options=options, stream=True, keep_alive=self.keep_alive):
+                    if chunk.get("done"):
+                        final = chunk # the final chunk carries the timings
+                        self._record_response(model, chunk)
+                    text = chunk["message"]["content"]
+                    if text:
+                        started = True
+                        yield text
+            except Exception as e:
+                error = e
+            finally:
+                controller.release(overloaded=error is not None and is_overload_error(error), succeeded=error is None)
+                # a stream abandoned early (stop predicate) has no final chunk and leaves the latency estimate alone
+                self._end_request(model, request_start, final)
+
+            if error is None:
+                get_retry_budget().record_success()
+                return
+            N += 1
+            if started or N >= max_retries or not self._should_retry(error) or not spend_retry(deadline, 2, f"{model} retry {N}"):
+                raise error
+            time.sleep(2)
+
+    def generate_stream(self, messages, model="sailor2:1b", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, stop_predicate=None, on_token=None, thinking_budget=None, deadline=None):
+        """Streams a response, stopping once stop_predicate(text_so_far) is True. Returns (text, metrics)."""
+        chunks = self.stream(messages, model=model, max_retries=max_retries, temperature=temperature, max_tokens=max_tokens, stop=stop, variables=variables, deadline=deadline)
+        return consume_stream(chunks, model, stop_predicate=stop_predicate, on_token=on_token)
+
+    async def agenerate(self, messages, model="sailor2:1b", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, use_cache=True, is_json=False, response_schema=None, thinking_budget=None, deadline=None):
+        """Async version of generate(); at most config["ollama_max_concurrency"] requests are in flight at once. A call still running at its deadline is cancelled."""
+        deadline = deadline if deadline is not None else make_deadline()
+        messages = format_messages(messages, variables)
+        options = self._build_options(model, temperature, max_tokens, stop, self._pick_num_ctx(model, messages, max_tokens))
+        response_schema = to_json_schema(response_schema)
+        format = self._build_format(is_json, response_schema)
+
+        async def compute():
+            response_text = await self._agenerate_with_retries(messages, model, max_retries, options, format, deadline)
+            if is_json:
+                parse_json(response_text, response_schema)
+            return response_text
+        if not cache_enabled(use_cache):
+            return await compute()
+
+        cache_key = ResponseCache.make_key("ollama", model, messages, temperature, max_tokens=max_tokens, is_json=is_json, response_schema=response_schema, stop=stop)
+        return await get_cache().aget_or_compute(cache_key, compute)
+
+    async def agenerate_json(self, messages, model="sailor2:1b", response_schema=None, **kwargs):
+        response_text = await self.agenerate(messages, model=model, is_json=True, response_schema=response_schema, **kwargs)
+        return parse_json(response_text, response_schema)
+
+# convenience functions - the client is only built on first use (see model_registry.py)
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """The shared backend: an OllamaPool when config["ollama_hosts"] lists several servers, else one OllamaModel on config["ollama_host"]."""
+    global _model
+    with _model_lock:
+        if _model is None:
+            if len(config["ollama_hosts"]) > 1:
+                from ollama_pool import OllamaPool
+                _model = OllamaPool(config["ollama_hosts"])
+            else:
+                _model = OllamaModel(host=(config["ollama_hosts"] or [config["ollama_host"]])[0])
+        return _model
+
+def generate(*args, **kwargs):
+    return get_model().generate(*args, **kwargs)
+
+def generate_json(*args, **kwargs):
+    return get_model().generate_json(*args, **kwargs)
+
+def generate_stream(*args, **kwargs):
+    return get_model().generate_stream(*args, **kwargs)
+
+def generate_n(*args, **kwargs):
+    return get_model().generate_n(*args, **kwargs)
+
+async def agenerate(*args, **kwargs):
+    return await get_model().agenerate(*args, **kwargs)
+
+def preload(model, wait=False):
+    get_model().preload(model, wait=wait)
+
+def report_residency():
+    if _model is not None:
+        _model.report_residency()
+
+async def agenerate_json(*args, **kwargs):
+    return await get_model().agenerate_json(*args, **kwargs)
 
 if __name__ == "__main__":
     # messages = [
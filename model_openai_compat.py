@@ -0,0 +1,321 @@
+import json, time
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+
+from config import config
+from model_cache import ResponseCache, get_cache, cache_enabled
+from streaming import consume_stream
+from concurrency import get_controller, is_overload_error, is_connection_error
+from prompt_template import fill_variables
+from json_schema import to_json_schema, parse_json
+from deadlines import CallDeadlineExceeded, make_deadline, time_left, check_deadline, spend_retry, get_retry_budget
+
+# Backend for local servers speaking the OpenAI chat-completions API (llama.cpp's llama-server, vLLM, ...).
+# Those servers batch concurrent requests continuously, so unlike Ollama on CPU they gain throughput from having
+# many requests in flight; the connection pool and the AIMD limit (config["aimd"]["openai_compat"]) are sized for that.
+# Model names are routed here by prefix (e.g. "local/qwen2.5-7b", see config["backend_routes"]); the prefix is stripped.
+
+def format_messages(messages, variables={}):
+    return fill_variables(messages, variables)
+
+def is_retryable(e):
+    code = getattr(getattr(e, "response", None), "status_code", None)
+    return is_overload_error(e) or is_connection_error(e) or isinstance(e, httpx.TransportError) or (code is not None and code >= 500)
+
+class OpenAICompatModel:
+    def __init__(self, base_url="http://localhost:8080/v1", api_key=None):
+        self.base_url = base_url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        max_connections = config["openai_compat_max_connections"]
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.client = httpx.Client(base_url=self.base_url, headers=self.headers, limits=self.limits, timeout=None)
+        # the async client is bound to an event loop, so it is created on first use in that loop
+        self.async_client = None
+        self.async_loop = None
+        self.usage = {} # model -> calls, tokens and server-reported prefill/decode speed
+        self.usage_lock = threading.Lock()
+
+    def _get_async_client(self):
+        loop = asyncio.get_running_loop()
+        if self.async_loop is not loop:
+            self.async_client = httpx.AsyncClient(base_url=self.base_url, headers=self.headers, limits=self.limits, timeout=None)
+            self.async_loop = loop
+        return self.async_client
+
+    def _server_model(self, model):
+        prefix = config["openai_compat_prefix"]
+        return model[len(prefix):] if model.startswith(prefix) else model
+
+    def _build_body(self, messages, model, temperature, max_tokens=None, stop=None, is_json=False, response_schema=None, n=1, stream=False):
+        body = {"model": self._server_model(model), "messages": messages, "temperature": temperature}
+        if max_tokens is not None:
+            body["max_tokens"] = max_tokens
+        if stop:
+            body["stop"] = list(stop)
+        if response_schema is not None:
+            # grammar-constrained decoding on llama.cpp / vLLM
+            body["response_format"] = {"type": "json_schema", "json_schema": {"name": "response", "schema": response_schema, "strict": True}}
+        elif is_json:
+            body["response_format"] = {"type": "json_object"}
+        if n > 1:
+            body["n"] = n
+        if stream:
+            body["stream"] = True
+        return body
+
+    def _record_usage(self, model, response_json, latency):
+        usage = response_json.get("usage") or {}
+        timings = response_json.get("timings") or {} # llama.cpp only
+        with self.usage_lock:
+            stats = self.usage.setdefault(model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_s": 0.0, "prefill_tps": [], "decode_tps": []})
+            stats["calls"] += 1
+            stats["latency_s"] += latency
+            stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+            stats["completion_tokens"] += usage.get("completion_tokens") or 0
+            if timings.get("prompt_per_second"):
+                stats["prefill_tps"].append(timings["prompt_per_second"])
+            if timings.get("predicted_per_second"):
+                stats["decode_tps"].append(timings["predicted_per_second"])
+
+    def report_usage(self):
+        with self.usage_lock:
+            for model, stats in self.usage.items():
+                calls = stats["calls"]
+                prefill = sum(stats["prefill_tps"]) / len(stats["prefill_tps"]) if stats["prefill_tps"] else None
+                decode = sum(stats["decode_tps"]) / len(stats["decode_tps"]) if stats["decode_tps"] else None
+                print(f"[openai-compat] {model}: {calls} calls, avg {stats['prompt_tokens'] / calls:.0f} prompt / {stats['completion_tokens'] / calls:.0f} output tokens, "
+                      f"avg latency {stats['latency_s'] / calls:.2f}s, prefill {prefill and round(prefill, 1)} tok/s, decode {decode and round(decode, 1)} tok/s")
+
+    def _call_api(self, body, model, deadline=None):
+        # one request under the model's adaptive concurrency limit; 429/503s shrink it, successes grow it
+        controller = get_controller("openai_compat", model)
+        controller.acquire()
+        overloaded = succeeded = False
+        try:
+            start = time.perf_counter()
+            response = self.client.post("/chat/completions", json=body, timeout=time_left(deadline))
+            response.raise_for_status()
+            response_json = response.json()
+            self._record_usage(model, response_json, time.perf_counter() - start)
+            succeeded = True
+            return response_json
+        except httpx.TimeoutException:
+            raise CallDeadlineExceeded(f"[deadline] {model} call did not finish before its deadline")
+        except Exception as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            controller.release(overloaded=overloaded, succeeded=succeeded)
+
+    async def _acall_api(self, body, model, deadline=None):
+        client = self._get_async_client()
+        controller = get_controller("openai_compat", model)
+        await controller.aacquire()
+        overloaded = succeeded = False
+        try:
+            start = time.perf_counter()
+            response = await client.post("/chat/completions", json=body, timeout=time_left(deadline))
+            response.raise_for_status()
+            response_json = response.json()
+            self._record_usage(model, response_json, time.perf_counter() - start)
+            succeeded = True
+            return response_json
+        except httpx.TimeoutException:
+            raise CallDeadlineExceeded(f"[deadline] {model} call did not finish before its deadline")
+        except Exception as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            controller.release(overloaded=overloaded, succeeded=succeeded)
+
+    def _retry_wait(self, e, N, max_retries, model, deadline):
+        """Seconds to wait before retry N, or None to give up (non-retryable error, retries or retry budget spent)."""
+        wait_time = min(2 ** N, 30)
+        if N >= max_retries or not is_retryable(e) or not spend_retry(deadline, wait_time, f"{model} retry {N}"):
+            return None
+        print(f"[openai-compat] {model} attempt {N}/{max_retries} failed ({str(e)[:100]}); retrying in {wait_time}s")
+        return wait_time
+
+    def _generate_with_retries(self, body, model, max_retries, deadline=None):
+        N = 0
+        while True:
+            check_deadline(deadline, 0.0, f"{model} request")
+            try:
+                response_json = self._call_api(body, model, deadline)
+                get_retry_budget().record_success()
+                return [choice["message"]["content"] or "" for choice in response_json["choices"]]
+            except CallDeadlineExceeded:
+                raise
+            except Exception as e:
+                N += 1
+                wait_time = self._retry_wait(e, N, max_retries, model, deadline)
+                if wait_time is None:
+                    raise e
+                time.sleep(wait_time)
+
+    async def _agenerate_with_retries(self, body, model, max_retries, deadline=None):
+        N = 0
+        while True:
+            check_deadline(deadline, 0.0, f"{model} request")
+            try:
+                response_json = await self._acall_api(body, model, deadline)
+                get_retry_budget().record_success()
+                return [choice["message"]["content"] or "" for choice in response_json["choices"]]
+            except CallDeadlineExceeded:
+                raise
+            except Exception as e:
+                N += 1
+                wait_time = self._retry_wait(e, N, max_retries, model, deadline)
+                if wait_time is None:
+                    raise e
+                await asyncio.sleep(wait_time)
+
+    def generate(self, messages, model="local/default", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, use_cache=True, is_json=False, response_schema=None, thinking_budget=None, deadline=None):
+        # thinking_budget is accepted for the same call contract as the Gemini backend; these servers have no thinking budget
+        deadline = deadline if deadline is not None else make_deadline()
+        messages = format_messages(messages, variables)
+        response_schema = to_json_schema(response_schema)
+        body = self._build_body(messages, model, temperature, max_tokens, stop, is_json, response_schema)
+
+        def compute():
+            response_text = self._generate_with_retries(body, model, max_retries, deadline)[0]
+            if is_json:
+                parse_json(response_text, response_schema) # raises ValueError, so JSON that fails the schema is never cached
+            return response_text
+        if not cache_enabled(use_cache):
+            return compute()
+
+        cache_key = ResponseCache.make_key("openai_compat", model, messages, temperature, max_tokens=max_tokens, is_json=is_json, response_schema=response_schema, stop=stop)
+        return get_cache().get_or_compute(cache_key, compute)
+
+    def generate_json(self, messages, model="local/default", response_schema=None, **kwargs):
+        """
+        JSON output via response_format (schema-constrained when response_schema is given, e.g. {"answer": str}).
+        Fenced, prefixed or truncated JSON is repaired before being checked against the schema; raises ValueError if that fails.
+        """
+        response_text = self.generate(messages, model=model, is_json=True, response_schema=response_schema, **kwargs)
+        return parse_json(response_text, response_schema)
+
+    def generate_n(self, messages, n, model="local/default", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, use_cache=True, thinking_budget=None, deadline=None):
+        """
+        n samples for one prompt in a single request (the API's n). Servers that return fewer choices (llama.cpp serves one)
+        are topped up with concurrent requests, which the server batches together. Returns a list of n texts.
+        """
+        deadline = deadline if deadline is not None else make_deadline()
+        messages = format_messages(messages, variables)
+
+        def compute():
+            texts = self._generate_with_retries(self._build_body(messages, model, temperature, max_tokens, stop, n=n), model, max_retries, deadline)
+            missing = n - len(texts)
+            if missing > 0:
+                body = self._build_body(messages, model, temperature, max_tokens, stop)
+                with ThreadPoolExecutor(max_workers=missing) as executor:
+                    texts += executor.map(lambda _: self._generate_with_retries(body, model, max_retries, deadline)[0], range(missing))
+            return texts[:n]
+
+        if not cache_enabled(use_cache):
+            return compute()
+        cache_key = ResponseCache.make_key("openai_compat", model, messages, temperature, max_tokens=max_tokens, stop=stop, n=n)
+        return get_cache().get_or_compute(cache_key, compute)
+
+    def stream(self, messages, model="local/default", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, thinking_budget=None, deadline=None):
+        """Yields the response text chunk by chunk (server-sent events); failures before the first chunk are retried."""
+        deadline = deadline if deadline is not None else make_deadline()
+        messages = format_messages(messages, variables)
+        body = self._build_body(messages, model, temperature, max_tokens, stop, stream=True)
+        N = 0
+        while True:
+            check_deadline(deadline, 0.0, f"{model} request")
+            started = False
+            controller = get_controller("openai_compat", model)
+            controller.acquire()
+            error = None
+            try:
+                with self.client.stream("POST", "/chat/completions", json=body, timeout=time_left(deadline)) as response:
+                    response.raise_for_status()
+                    for line in response.iter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+                        choices = json.loads(data).get("choices") or []
+                        text = choices[0].get("delta", {}).get("content") if choices else None
+                        if text:
+                            started = True
+                            yield text
+            except Exception as e:
+                error = e
+            finally:
+                controller.release(overloaded=error is not None and is_overload_error(error), succeeded=error is None)
+
+            if error is None:
+                get_retry_budget().record_success()
+                return
+            N += 1
+            wait_time = None if started else self._retry_wait(error, N, max_retries, model, deadline)
+            if wait_time is None:
+                raise error
+            time.sleep(wait_time)
+
+    def generate_stream(self, messages, model="local/default", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, stop_predicate=None, on_token=None, thinking_budget=None, deadline=None):
+        """Streams a response, stopping once stop_predicate(text_so_far) is True. Returns (text, metrics)."""
+        chunks = self.stream(messages, model=model, max_retries=max_retries, temperature=temperature, max_tokens=max_tokens, stop=stop, variables=variables, deadline=deadline)
+        return consume_stream(chunks, model, stop_predicate=stop_predicate, on_token=on_token)
+
+    async def agenerate(self, messages, model="local/default", max_retries=3, temperature=1.0, max_tokens=None, stop=None, variables={}, use_cache=True, is_json=False, response_schema=None, thinking_budget=None, deadline=None):
+        """Async version of generate(); in-flight requests are bounded only by the AIMD limit and the connection pool."""
+        deadline = deadline if deadline is not None else make_deadline()
+        messages = format_messages(messages, variables)
+        response_schema = to_json_schema(response_schema)
+        body = self._build_body(messages, model, temperature, max_tokens, stop, is_json, response_schema)
+
+        async def compute():
+            response_text = (await self._agenerate_with_retries(body, model, max_retries, deadline))[0]
+            if is_json:
+                parse_json(response_text, response_schema)
+            return response_text
+        if not cache_enabled(use_cache):
+            return await compute()
+
+        cache_key = ResponseCache.make_key("openai_compat", model, messages, temperature, max_tokens=max_tokens, is_json=is_json, response_schema=response_schema, stop=stop)
+        return await get_cache().aget_or_compute(cache_key, compute)
+
+    async def agenerate_json(self, messages, model="local/default", response_schema=None, **kwargs):
+        response_text = await self.agenerate(messages, model=model, is_json=True, response_schema=response_schema, **kwargs)
+        return parse_json(response_text, response_schema)
+
+# convenience functions - the client is only built on first use (see model_registry.py)
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = OpenAICompatModel(base_url=config["openai_compat_base_url"], api_key=config["openai_compat_api_key"])
+        return _model
+
+def generate(*args, **kwargs):
+    return get_model().generate(*args, **kwargs)
+
+def generate_json(*args, **kwargs):
+    return get_model().generate_json(*args, **kwargs)
+
+def generate_n(*args, **kwargs):
+    return get_model().generate_n(*args, **kwargs)
+
+def generate_stream(*args, **kwargs):
+    return get_model().generate_stream(*args, **kwargs)
+
+async def agenerate(*args, **kwargs):
+    return await get_model().agenerate(*args, **kwargs)
+
+async def agenerate_json(*args, **kwargs):
+    return await get_model().agenerate_json(*args, **kwargs)
+
+def report_usage():
+    if _model is not None:
+        _model.report_usage()
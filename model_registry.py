@@ -0,0 +1,68 @@
+import importlib
+import threading
+
+from config import config
+
+# Routes each call to a backend module by model name, e.g. "gemini-2.5-flash" -> model_genai, "sailor2:1b" -> model_ollama,
+# "local/qwen2.5-7b" -> model_openai_compat.
+# Backend modules are imported on first use, so an Ollama-only run never imports google-genai or needs API keys.
+
+BACKEND_MODULES = {
+    "genai": "model_genai",
+    "ollama": "model_ollama",
+    "openai_compat": "model_openai_compat", # llama.cpp server / vLLM via the OpenAI chat API
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend_name(model):
+    for prefix, backend_name in config["backend_routes"]:
+        if model.startswith(prefix):
+            return backend_name
+    return config["default_backend"]
+
+def get_backend(model):
+    """Returns the backend module serving this model, importing it on first use."""
+    backend_name = get_backend_name(model)
+    with _backends_lock:
+        if backend_name not in _backends:
+            if backend_name not in BACKEND_MODULES:
+                raise ValueError(f"Unknown backend {backend_name} for model {model}")
+            _backends[backend_name] = importlib.import_module(BACKEND_MODULES[backend_name])
+        return _backends[backend_name]
+
+def generate(messages, model, **kwargs):
+    return get_backend(model).generate(messages, model=model, **kwargs)
+
+def generate_json(messages, model, **kwargs):
+    return get_backend(model).generate_json(messages, model=model, **kwargs)
+
+def generate_stream(messages, model, **kwargs):
+    return get_backend(model).generate_stream(messages, model=model, **kwargs)
+
+def generate_n(messages, n, model, **kwargs):
+    """n samples for one prompt in as few requests as the backend allows (Gemini candidate_count, concurrent Ollama requests)."""
+    return get_backend(model).generate_n(messages, n, model=model, **kwargs)
+
+async def agenerate(messages, model, **kwargs):
+    return await get_backend(model).agenerate(messages, model=model, **kwargs)
+
+async def agenerate_json(messages, model, **kwargs):
+    return await get_backend(model).agenerate_json(messages, model=model, **kwargs)
+
+def preload(model):
+    """Starts loading model ahead of its first call on backends that load models on demand (Ollama); a no-op elsewhere."""
+    backend = get_backend(model)
+    if hasattr(backend, "preload"):
+        backend.preload(model)
+
+def report_usage():
+    """Prints per-model usage for every backend loaded so far: tokens (incl. thinking) on Gemini, model loads/unloads on Ollama."""
+    with _backends_lock:
+        backends = list(_backends.values())
+    for backend in backends:
+        if hasattr(backend, "report_usage"):
+            backend.report_usage()
+        if hasattr(backend, "report_residency"):
+            backend.report_residency()
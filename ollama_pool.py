@@ -0,0 +1,186 @@
+import time
+import threading
+
+from ollama import Client
+
+from config import config
+from concurrency import is_connection_error
+from deadlines import CallDeadlineExceeded, make_deadline
+
+# Several Ollama servers behind one backend. Each call goes to the host expected to answer it first, judged by
+# whether the model is already loaded there, how many requests it has queued and its measured latency for the model.
+# Hosts that keep failing to connect are ejected and re-admitted once a background health check reaches them again.
+
+class PooledHost:
+    """One Ollama server in the pool: its backend (an OllamaModel bound to the host) and its health."""
+    def __init__(self, host):
+        from model_ollama import OllamaModel
+        self.host = host
+        self.backend = OllamaModel(host=host, name=f"ollama@{host}")
+        self.backend.retry_connection_errors = False # the pool moves the call to another host instead
+        self.backend.loaded = self.backend.resident_models() or set() # what is already in memory counts for routing
+        self.healthy = True
+        self.failures = 0 # consecutive connection errors
+        self.requests = 0
+        self.ejections = 0
+
+    def score(self, model):
+        """Expected seconds until a new request for model finishes here (lower is better)."""
+        backend = self.backend
+        with backend.stats_lock:
+            queued = backend.in_flight
+            latency = backend.latency.get(model)
+        if latency is None:
+            latency = config["ollama_pool"]["default_latency_s"] # untried model on this host
+        with backend.residency_lock:
+            resident = model in backend.loaded
+            stats = backend.residency.get(model)
+        load_s = 0.0
+        if not resident:
+            load_s = stats["load_s"] / stats["loads"] if stats and stats["loads"] else config["ollama_pool"]["default_load_s"]
+        return (queued + 1) * latency + load_s
+
+class OllamaPool:
+    """
+    Routes Ollama calls across hosts (config["ollama_hosts"]), with the same interface as OllamaModel.
+    A call that fails with a connection error is retried on another host; any other error is the host's own retry policy's business.
+    """
+    def __init__(self, hosts):
+        self.hosts = [PooledHost(host) for host in hosts]
+        self.lock = threading.Lock()
+        self.health_thread = None
+
+    def _pick_host(self, model, exclude=()):
+        with self.lock:
+            candidates = [host for host in self.hosts if host.healthy and host not in exclude]
+            if not candidates:
+                candidates = [host for host in self.hosts if host not in exclude] or self.hosts # everything is down: try anyway
+            host = min(candidates, key=lambda host: host.score(model))
+            host.requests += 1
+            return host
+
+    def _host_succeeded(self, host):
+        with self.lock:
+            host.failures = 0
+
+    def _host_failed(self, host, e):
+        if not is_connection_error(e):
+            return
+        with self.lock:
+            host.failures += 1
+            if not host.healthy or host.failures < config["ollama_pool"]["eject_after"]:
+                return
+            host.healthy = False
+            host.ejections += 1
+            print(f"[ollama-pool] Ejecting {host.host} after {host.failures} connection errors: {str(e)[:100]}")
+            if self.health_thread is None or not self.health_thread.is_alive():
+                self.health_thread = threading.Thread(target=self._health_loop, name="ollama-pool-health", daemon=True)
+                self.health_thread.start()
+
+    def _health_loop(self):
+        """Checks ejected hosts every health_interval_s (`ollama ps`) and re-admits the ones that answer; exits when none are ejected."""
+        settings = config["ollama_pool"]
+        while True:
+            time.sleep(settings["health_interval_s"])
+            with self.lock:
+                ejected = [host for host in self.hosts if not host.healthy]
+            if not ejected:
+                return
+            for host in ejected:
+                try:
+                    listing = Client(host=host.host, timeout=settings["health_timeout_s"]).ps()
+                except Exception:
+                    continue
+                # a restarted server has nothing loaded; take residency from the server rather than from before the outage
+                resident = {getattr(entry, "model", None) or entry.get("model") for entry in (getattr(listing, "models", None) or listing.get("models", []))}
+                with host.backend.residency_lock:
+                    host.backend.loaded = resident
+                with self.lock:
+                    host.healthy = True
+                    host.failures = 0
+                print(f"[ollama-pool] {host.host} passed its health check; re-admitted")
+
+    def _with_deadline(self, kwargs):
+        # one deadline for the whole call, so failing over to another host does not start a fresh call_timeout_s
+        if kwargs.get("deadline") is None:
+            kwargs["deadline"] = make_deadline()
+        return kwargs
+
+    def _route(self, model, call, max_retries=None):
+        """Runs call(backend) on the best host, moving to the next best host on connection errors."""
+        max_retries = len(self.hosts) if max_retries is None else max_retries
+        tried = []
+        while True:
+            host = self._pick_host(model, exclude=tried)
+            try:
+                result = call(host.backend)
+                self._host_succeeded(host)
+                return result
+            except CallDeadlineExceeded:
+                raise
+            except Exception as e:
+                self._host_failed(host, e)
+                tried.append(host)
+                if not is_connection_error(e) or len(tried) >= max_retries:
+                    raise
+                print(f"[ollama-pool] {host.host} failed for {model}; trying another host")
+
+    async def _aroute(self, model, call, max_retries=None):
+        max_retries = len(self.hosts) if max_retries is None else max_retries
+        tried = []
+        while True:
+            host = self._pick_host(model, exclude=tried)
+            try:
+                result = await call(host.backend)
+                self._host_succeeded(host)
+                return result
+            except CallDeadlineExceeded:
+                raise
+            except Exception as e:
+                self._host_failed(host, e)
+                tried.append(host)
+                if not is_connection_error(e) or len(tried) >= max_retries:
+                    raise
+                print(f"[ollama-pool] {host.host} failed for {model}; trying another host")
+
+    def generate(self, messages, model="sailor2:1b", **kwargs):
+        kwargs = self._with_deadline(kwargs)
+        return self._route(model, lambda backend: backend.generate(messages, model=model, **kwargs))
+
+    def generate_json(self, messages, model="sailor2:1b", **kwargs):
+        kwargs = self._with_deadline(kwargs)
+        return self._route(model, lambda backend: backend.generate_json(messages, model=model, **kwargs))
+
+    def generate_n(self, messages, n, model="sailor2:1b", **kwargs):
+        # all candidates on one host, so they share its prompt cache
+        kwargs = self._with_deadline(kwargs)
+        return self._route(model, lambda backend: backend.generate_n(messages, n, model=model, **kwargs))
+
+    def generate_stream(self, messages, model="sailor2:1b", **kwargs):
+        # no failover: tokens may already have been handed to on_token
+        return self._route(model, lambda backend: backend.generate_stream(messages, model=model, **kwargs), max_retries=1)
+
+    def stream(self, messages, model="sailor2:1b", **kwargs):
+        # a stream is bound to the host it started on; no failover once chunks have been yielded
+        yield from self._pick_host(model).backend.stream(messages, model=model, **kwargs)
+
+    async def agenerate(self, messages, model="sailor2:1b", **kwargs):
+        kwargs = self._with_deadline(kwargs)
+        return await self._aroute(model, lambda backend: backend.agenerate(messages, model=model, **kwargs))
+
+    async def agenerate_json(self, messages, model="sailor2:1b", **kwargs):
+        kwargs = self._with_deadline(kwargs)
+        return await self._aroute(model, lambda backend: backend.agenerate_json(messages, model=model, **kwargs))
+
+    def preload(self, model, wait=False):
+        """Preloads model on the host its next request would go to."""
+        with self.lock:
+            candidates = [host for host in self.hosts if host.healthy] or self.hosts
+            host = min(candidates, key=lambda host: host.score(model))
+        host.backend.preload(model, wait=wait)
+
+    def report_residency(self):
+        for host in self.hosts:
+            status = "ok" if host.healthy else "ejected"
+            print(f"[ollama-pool] {host.host}: {host.requests} requests routed, {host.ejections} ejections ({status})")
+            host.backend.report_residency()
@@ -0,0 +1,118 @@
+import json, time, random
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal stand-in for an Ollama server (/api/chat, /api/ps, /api/show, /api/version) so multi-host routing
+# (ollama_pool.py) can be exercised locally without models, e.g. three hosts:
+#   python ollama_standin.py --port 11435 & python ollama_standin.py --port 11436 --latency_s 2 & python ollama_standin.py --port 11437
+# then set config["ollama_hosts"] to the three URLs. Killing one exercises ejection; restarting it, re-admission.
+# Like a CPU box, it holds one model at a time; switching models costs --load_s.
+
+class StandinState:
+    def __init__(self, latency_s=0.5, load_s=3.0, fail_rate=0.0, reply="Sagot: A"):
+        self.latency_s = latency_s
+        self.load_s = load_s
+        self.fail_rate = fail_rate
+        self.reply = reply
+        self.resident = None
+        self.lock = threading.Lock()
+
+    def load(self, model):
+        """Makes model resident; returns the (simulated) seconds spent loading it."""
+        with self.lock:
+            if self.resident == model:
+                return 0.0
+            time.sleep(self.load_s)
+            self.resident = model
+            return self.load_s
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if self.path == "/api/version":
+                return self._send(200, {"version": "0.0.0-standin"})
+            if self.path == "/api/ps":
+                models = [{"name": state.resident, "model": state.resident, "size": 0, "size_vram": 0, "digest": ""}] if state.resident else []
+                return self._send(200, {"models": models})
+            self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            request = self._read()
+            if self.path == "/api/show":
+                return self._send(200, {"model_info": {"standin.context_length": 8192}})
+            if self.path != "/api/chat":
+                return self._send(404, {"error": "not found"})
+
+            model = request.get("model")
+            if request.get("keep_alive") == 0:
+                with state.lock:
+                    if state.resident == model:
+                        state.resident = None
+                return self._send(200, {"model": model, "created_at": _now(), "message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "unload"})
+
+            load_s = state.load(model)
+            if not request.get("messages"):
+                return self._send(200, {"model": model, "created_at": _now(), "message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "load", "load_duration": int(load_s * 1e9)})
+            if random.random() < state.fail_rate:
+                return self._send(503, {"error": "server busy, please try again"})
+
+            time.sleep(state.latency_s)
+            content = json.dumps({"answer": "A", "response_type": "answer_attempt"}) if request.get("format") else state.reply
+            response = {"model": model, "created_at": _now(), "message": {"role": "assistant", "content": content}, "done": True, "done_reason": "stop",
+                        "load_duration": int(load_s * 1e9), "total_duration": int((load_s + state.latency_s) * 1e9), "eval_count": len(content.split()),
+                        # split the request time evenly between prefill and decode so ollama_tune.py has numbers to work with
+                        "prompt_eval_count": sum(len(str(message.get("content", "")).split()) for message in request["messages"]),
+                        "prompt_eval_duration": int(state.latency_s * 0.5e9), "eval_duration": int(state.latency_s * 0.5e9)}
+            if request.get("stream"):
+                # one content chunk, then the final chunk with the timings (newline-delimited JSON like Ollama)
+                chunks = [dict(response, done=False, done_reason=None), dict(response, message={"role": "assistant", "content": ""})]
+                data = "".join(json.dumps(chunk) + "\n" for chunk in chunks).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            self._send(200, response)
+
+        def log_message(self, format, *args):
+            pass # keep the console for the pool's own logging
+
+    return Handler
+
+def serve(port, host="127.0.0.1", **settings):
+    """Starts a stand-in server in a background thread and returns it (call .shutdown() to stop it)."""
+    server = ThreadingHTTPServer((host, port), make_handler(StandinState(**settings)))
+    threading.Thread(target=server.serve_forever, name=f"ollama-standin-{port}", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency_s", type=float, default=0.5, help="Seconds per chat request")
+    parser.add_argument("--load_s", type=float, default=3.0, help="Seconds to switch the resident model")
+    parser.add_argument("--fail_rate", type=float, default=0.0, help="Fraction of chat requests answered with a 503")
+    parser.add_argument("--reply", type=str, default="Sagot: A")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(StandinState(args.latency_s, args.load_s, args.fail_rate, args.reply)))
+    print(f"[standin] Ollama stand-in on http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,136 @@
+import os, json, time, random, itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
+from tasks import get_task
+from model_ollama import profile_path
+
+# CPU throughput autotuner for Ollama: replays a short workload of real assistant prompts from the sharded dataset
+# against a local server for every combination of num_thread, num_batch and client concurrency, measures prefill and
+# decode speed plus latency percentiles, and writes the best setting as a per-model profile that OllamaModel
+# picks up automatically (config["ollama_profiles_dir"]).
+# Note: requests beyond the server's OLLAMA_NUM_PARALLEL queue on the server, so set it to at least the largest concurrency.
+
+def build_workload(dataset_fn, model, num_prompts=24, seed=0):
+    """
+    Real assistant prompts, spread evenly over the tasks in the dataset and over the full / concat conversation types,
+    with each task's output budget and stop sequences. Returns a list of (messages, max_tokens, stop).
+    """
+    with open(dataset_fn, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    rng = random.Random(seed)
+    by_task = {}
+    for sample in data:
+        by_task.setdefault(sample["task"], []).append(sample)
+
+    tasks = {task_name: get_task(task_name) for task_name in by_task}
+    task_cycle = itertools.cycle(sorted(by_task))
+    workload = []
+    for i in range(num_prompts):
+        task_name = next(task_cycle)
+        task = tasks[task_name]
+        sample = rng.choice(by_task[task_name])
+        prompt = task.populate_fully_specific_prompt(sample) if i % 2 == 0 else task.populate_concat_prompt(sample)
+        prompt = prompt.replace("[[fewshot_examples]]", "")
+        workload.append(([{"role": "user", "content": prompt}], task.get_max_output_tokens(model), task.get_stop_sequences()))
+    return workload
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def run_trial(client, model, workload, options, concurrency):
+    """Runs the workload with these options at this concurrency; returns throughput and latency measurements."""
+    def one(item):
+        messages, max_tokens, stop = item
+        request_options = dict(options, temperature=0.0, num_predict=max_tokens)
+        if stop:
+            request_options["stop"] = list(stop)
+        start = time.perf_counter()
+        response = client.chat(model=model, messages=messages, options=request_options, keep_alive=config["ollama_keep_alive"])
+        return time.perf_counter() - start, response
+
+    # the first request with new num_thread / num_batch reloads the model; keep that out of the measurement
+    one(workload[0])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, workload))
+    wall = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    prompt_tokens = sum(response.get("prompt_eval_count") or 0 for _, response in results)
+    prompt_s = sum(response.get("prompt_eval_duration") or 0 for _, response in results) / 1e9
+    output_tokens = sum(response.get("eval_count") or 0 for _, response in results)
+    output_s = sum(response.get("eval_duration") or 0 for _, response in results) / 1e9
+    return {
+        "options": options,
+        "concurrency": concurrency,
+        "prefill_tps": round(prompt_tokens / prompt_s, 2) if prompt_s else None, # per request, as the server reports it
+        "decode_tps": round(output_tokens / output_s, 2) if output_s else None,
+        "throughput_tps": round((prompt_tokens + output_tokens) / wall, 2), # aggregate, all requests together
+        "output_tps": round(output_tokens / wall, 2),
+        "latency_p50_s": round(_percentile(latencies, 0.5), 3),
+        "latency_p95_s": round(_percentile(latencies, 0.95), 3),
+        "wall_s": round(wall, 2),
+    }
+
+def tune(model, dataset_fn="data/sharded_instructions.json", num_threads=None, num_batches=(128, 256, 512), concurrencies=(1, 2, 4),
+         num_prompts=24, objective="output_tps", host=None):
+    """Sweeps the option grid on one model and writes its profile. Returns the profile."""
+    from ollama import Client
+    client = Client(host=host or config["ollama_host"])
+    cores = os.cpu_count() or 4
+    num_threads = num_threads or sorted({max(1, cores // 4), max(1, cores // 2), cores})
+    workload = build_workload(dataset_fn, model, num_prompts=num_prompts)
+    print(f"[tune] {model}: {len(workload)} prompts, num_thread {list(num_threads)} x num_batch {list(num_batches)} x concurrency {list(concurrencies)}")
+
+    trials = []
+    for num_thread, num_batch, concurrency in itertools.product(num_threads, num_batches, concurrencies):
+        options = {"num_thread": num_thread, "num_batch": num_batch}
+        try:
+            trial = run_trial(client, model, workload, options, concurrency)
+        except Exception as e:
+            print(f"[tune] {options} x{concurrency} failed: {e}")
+            continue
+        trials.append(trial)
+        print(f"[tune] num_thread={num_thread} num_batch={num_batch} concurrency={concurrency}: prefill {trial['prefill_tps']} tok/s, "
+              f"decode {trial['decode_tps']} tok/s, output {trial['output_tps']} tok/s overall, p50 {trial['latency_p50_s']}s, p95 {trial['latency_p95_s']}s")
+    if not trials:
+        raise RuntimeError(f"[tune] Every trial failed for {model}")
+
+    # latency objectives are minimized, throughput objectives maximized
+    minimize = objective.startswith("latency")
+    best = (min if minimize else max)(trials, key=lambda trial: trial[objective] if trial[objective] is not None else (float("inf") if minimize else 0))
+    profile = {
+        "model": model,
+        "options": best["options"],
+        "concurrency": best["concurrency"],
+        "objective": objective,
+        "best": best,
+        "trials": trials,
+        "cpu_count": cores,
+        "tuned_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    os.makedirs(os.path.dirname(profile_path(model)), exist_ok=True)
+    with open(profile_path(model), "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    print(f"[tune] Best for {model} by {objective}: {best['options']} at concurrency {best['concurrency']} -> {profile_path(model)}")
+    return profile
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, nargs="+", required=True)
+    parser.add_argument("--dataset_fn", type=str, default="data/sharded_instructions.json")
+    parser.add_argument("--host", type=str, default=None, help="Ollama server to tune (default config['ollama_host'])")
+    parser.add_argument("--num_thread", type=int, nargs="+", default=None, help="Default: a quarter, half and all of the CPU cores")
+    parser.add_argument("--num_batch", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--num_prompts", type=int, default=24)
+    parser.add_argument("--objective", type=str, default="output_tps", choices=["output_tps", "throughput_tps", "latency_p50_s", "latency_p95_s"])
+    args = parser.parse_args()
+
+    for model in args.model:
+        tune(model, dataset_fn=args.dataset_fn, num_threads=args.num_thread, num_batches=args.num_batch, concurrencies=args.concurrency,
+             num_prompts=args.num_prompts, objective=args.objective, host=args.host)
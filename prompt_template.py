@@ -0,0 +1,71 @@
+import re
+import threading
+from functools import lru_cache
+
+# [[var]] prompt templates, parsed once into literal text and variable slots so rendering is a single join
+# instead of one str.replace pass per variable.
+
+_PLACEHOLDER_RE = re.compile(r"\[\[([^\[\]]+)\]\]")
+
+class PromptTemplate:
+    """
+    A parsed [[var]] template.
+    If variables is given (the names callers will supply), placeholders with no variable and variables the text
+    never uses are reported once here, at compile time, rather than on every render.
+    """
+    def __init__(self, text, name="<prompt>", variables=None):
+        self.text = text
+        self.name = name
+        parts = _PLACEHOLDER_RE.split(text)
+        self.literals = parts[0::2]
+        self.slots = parts[1::2]
+        self.variables = set(self.slots)
+
+        if variables is not None:
+            missing = sorted(self.variables - set(variables))
+            extra = sorted(set(variables) - self.variables)
+            if missing:
+                print(f"[prompt] {name}: placeholders with no variable: {missing}")
+            if extra:
+                print(f"[prompt] {name}: variables not used in the template: {extra}")
+
+    def render(self, values):
+        """
+        Fills every placeholder in one pass. values may hold extra keys (e.g. a whole sample dict);
+        placeholders without a value stay as [[var]] so they can be filled later (e.g. [[fewshot_examples]]).
+        """
+        out = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            out.append(str(values[slot]) if slot in values else f"[[{slot}]]")
+            out.append(literal)
+        return "".join(out)
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+def load_template(path, variables=None):
+    """Reads and compiles a template file once per process; later calls return the same PromptTemplate."""
+    key = (path, tuple(variables) if variables is not None else None)
+    with _templates_lock:
+        if key not in _templates:
+            with open(path, "r", encoding="utf-8") as f:
+                _templates[key] = PromptTemplate(f.read(), name=path, variables=variables)
+        return _templates[key]
+
+@lru_cache(maxsize=256)
+def compile_template(text, variables=None):
+    """Compiles an in-memory prompt (e.g. a message passed to generate(variables=...)), cached by text and variable names."""
+    return PromptTemplate(text, variables=variables)
+
+def fill_variables(messages, variables):
+    """
+    Renders variables into the last user message. The caller's messages are left untouched; only the filled message is copied.
+    Missing or unused keys are reported when a prompt text is first compiled, not on every call.
+    """
+    if not variables:
+        return messages
+    last_user_index = max(i for i, msg in enumerate(messages) if msg["role"] == "user")
+    last_user_msg = messages[last_user_index]
+    template = compile_template(last_user_msg["content"], tuple(sorted(variables)))
+    filled = dict(last_user_msg, content=template.render(variables))
+    return messages[:last_user_index] + [filled] + messages[last_user_index + 1:]
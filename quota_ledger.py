@@ -0,0 +1,117 @@
+import os, time, hashlib, sqlite3
+import atexit
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+from config import config
+from rate_limiter import QUOTA_TZ
+
+class QuotaLedger:
+    """
+    On-disk record (SQLite) of per-key, per-model daily usage: requests sent this quota day and whether the key hit its
+    daily limit. Lets a restarted process skip keys that are already exhausted instead of relearning that from 429s.
+    Keys are stored as a short hash, never in the clear. Rows from an earlier quota day are ignored.
+    Request counts are buffered and written every refresh_s seconds; exhaustion is written immediately.
+    """
+    def __init__(self, path=None, refresh_s=None):
+        self.path = path or config["quota_ledger_path"]
+        self.refresh_s = refresh_s if refresh_s is not None else config["quota_ledger_refresh_s"]
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS key_quota (key_id TEXT NOT NULL, model TEXT NOT NULL, day_reset REAL NOT NULL, "
+                          "requests INTEGER NOT NULL, exhausted_until REAL NOT NULL, PRIMARY KEY (key_id, model))")
+
+        self.pending = defaultdict(int) # (key_id, model, day_reset) -> requests not written yet
+        self.snapshot = {} # (key_id, model) -> (requests, exhausted_until), as of the last refresh (all processes)
+        self.refreshed = 0.0
+
+    @staticmethod
+    def key_id(api_key):
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+    def _flush(self):
+        # a new quota day replaces the old row instead of adding to it
+        for (key_id, model, day_reset), requests in self.pending.items():
+            if requests == 0:
+                continue
+            self.conn.execute(
+                "INSERT INTO key_quota (key_id, model, day_reset, requests, exhausted_until) VALUES (?, ?, ?, MAX(0, ?), 0) "
+                "ON CONFLICT (key_id, model) DO UPDATE SET "
+                "requests = MAX(0, CASE WHEN day_reset = excluded.day_reset THEN requests + excluded.requests ELSE excluded.requests END), "
+                "exhausted_until = CASE WHEN day_reset = excluded.day_reset THEN exhausted_until ELSE 0 END, "
+                "day_reset = excluded.day_reset",
+                (key_id, model, day_reset, requests))
+        self.pending.clear()
+
+    def _refresh(self, force=False):
+        now = time.time()
+        if not force and now - self.refreshed < self.refresh_s:
+            return
+        self._flush()
+        rows = self.conn.execute("SELECT key_id, model, requests, exhausted_until FROM key_quota WHERE day_reset > ?", (now,)).fetchall()
+        self.snapshot = {(key_id, model): (requests, exhausted_until) for key_id, model, requests, exhausted_until in rows}
+        self.refreshed = now
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def lookup(self, key_id, model):
+        """(requests this quota day, exhausted until) for a key, as recorded by this or any other process."""
+        with self.lock:
+            self._refresh()
+            return self.snapshot.get((key_id, model), (0, 0.0))
+
+    def record_request(self, key_id, model, day_reset):
+        with self.lock:
+            self.pending[(key_id, model, day_reset)] += 1
+            self._refresh()
+
+    def unrecord_request(self, key_id, model, day_reset):
+        """Takes back a recorded request that was never sent."""
+        with self.lock:
+            self.pending[(key_id, model, day_reset)] -= 1
+
+    def mark_exhausted(self, key_id, model, day_reset):
+        """The key hit its daily limit for model; it stays exhausted until day_reset."""
+        with self.lock:
+            self._flush()
+            self.conn.execute(
+                "INSERT INTO key_quota (key_id, model, day_reset, requests, exhausted_until) VALUES (?, ?, ?, 0, ?) "
+                "ON CONFLICT (key_id, model) DO UPDATE SET "
+                "requests = CASE WHEN day_reset = excluded.day_reset THEN requests ELSE 0 END, "
+                "exhausted_until = excluded.exhausted_until, day_reset = excluded.day_reset",
+                (key_id, model, day_reset, day_reset))
+            self._refresh(force=True)
+
+    def report(self, key_ids):
+        """Prints today's recorded usage for the given keys (key index = position in key_ids)."""
+        with self.lock:
+            self._refresh(force=True)
+            snapshot = dict(self.snapshot)
+        index_of = {key_id: i for i, key_id in enumerate(key_ids)}
+        for (key_id, model), (requests, exhausted_until) in sorted(snapshot.items(), key=lambda item: (item[0][1], index_of.get(item[0][0], -1))):
+            if key_id not in index_of:
+                continue
+            status = "ok"
+            if exhausted_until > time.time():
+                status = f"exhausted until {datetime.fromtimestamp(exhausted_until, QUOTA_TZ):%Y-%m-%d %H:%M %Z}"
+            print(f"[quota] key index {index_of[key_id]} / {model}: {requests} requests today ({status})")
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+def get_ledger():
+    """Returns the shared ledger, or None when config["quota_ledger_enabled"] is off."""
+    global _ledger
+    if not config["quota_ledger_enabled"]:
+        return None
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = QuotaLedger()
+            atexit.register(_ledger.flush)
+        return _ledger
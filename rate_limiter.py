@@ -0,0 +1,153 @@
+import time, math
+import threading
+from datetime import datetime, timedelta, timezone
+
+from config import config
+
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TZ = ZoneInfo("America/Los_Angeles") # Gemini daily quotas reset at midnight Pacific
+except Exception:
+    QUOTA_TZ = timezone(timedelta(hours=-8)) # no tz database (e.g. Windows without tzdata)
+
+def next_daily_reset(now=None):
+    """Returns the unix timestamp of the next midnight in the quota timezone."""
+    now = datetime.now(QUOTA_TZ) if now is None else datetime.fromtimestamp(now, QUOTA_TZ)
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return tomorrow.timestamp()
+
+def estimate_tokens(text):
+    """Cheap local token estimate (no API call); errs on the high side for Filipino text."""
+    return max(1, math.ceil(len(text) / config["chars_per_token"]))
+
+class TokenBucket:
+    """
+    Token bucket that refills continuously up to capacity.
+    reserve() always takes the tokens (the balance may go negative) and returns how long the caller must wait,
+    so concurrent callers queue up behind each other instead of all waking at the same time.
+    """
+    def __init__(self, capacity, refill_per_sec):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_sec)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity) # a single oversized request shouldn't wait forever
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.refill_per_sec
+
+    def refund(self, amount, now):
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + min(amount, self.capacity))
+
+    def drain(self, now):
+        self._refill(now)
+        self.tokens = min(self.tokens, 0)
+
+    def headroom(self, now):
+        self._refill(now)
+        return max(self.tokens, 0) / self.capacity
+
+class KeyRateLimiter:
+    """
+    Pre-emptive limiter for one API key and model: requests per minute, tokens per minute and requests per day.
+    A limit set to None is not enforced.
+    """
+    def __init__(self, rpm=None, tpm=None, rpd=None):
+        self.lock = threading.Lock()
+        self.requests = TokenBucket(rpm, rpm / 60.0) if rpm else None
+        self.tokens = TokenBucket(tpm, tpm / 60.0) if tpm else None
+        self.rpd = rpd
+        self.day_count = 0
+        self.day_reset = next_daily_reset()
+        self.exhausted_until = 0.0
+
+    def _roll_day(self):
+        if time.time() >= self.day_reset:
+            self.day_count = 0
+            self.day_reset = next_daily_reset()
+
+    def _is_exhausted(self):
+        self._roll_day()
+        return time.time() < self.exhausted_until or (self.rpd is not None and self.day_count >= self.rpd)
+
+    def is_exhausted(self):
+        with self.lock:
+            return self._is_exhausted()
+
+    def reserve(self, est_tokens):
+        """
+        Reserves one request of est_tokens prompt tokens.
+        Returns the seconds to wait before sending, or None if the daily quota for this key is used up.
+        """
+        with self.lock:
+            if self._is_exhausted():
+                return None
+            self.day_count += 1
+
+            now = time.monotonic()
+            wait = 0.0
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(est_tokens, now))
+            return wait
+
+    def refund(self, est_tokens, day_reset):
+        """Gives back a reservation that was never sent (e.g. the call's deadline ran out while it waited)."""
+        with self.lock:
+            if day_reset == self.day_reset and self.day_count > 0:
+                self.day_count -= 1
+            now = time.monotonic()
+            if self.requests is not None:
+                self.requests.refund(1, now)
+            if self.tokens is not None:
+                self.tokens.refund(est_tokens, now)
+
+    def headroom(self):
+        """Fraction (0-1) of the tightest limit still available right now."""
+        with self.lock:
+            if self._is_exhausted():
+                return 0.0
+            now = time.monotonic()
+            fractions = [1.0]
+            if self.requests is not None:
+                fractions.append(self.requests.headroom(now))
+            if self.tokens is not None:
+                fractions.append(self.tokens.headroom(now))
+            if self.rpd is not None:
+                fractions.append(max(self.rpd - self.day_count, 0) / self.rpd)
+            return min(fractions)
+
+    def penalize(self):
+        """Called after a per-minute 429: the server disagrees with our estimate, so start the minute over."""
+        with self.lock:
+            now = time.monotonic()
+            if self.requests is not None:
+                self.requests.drain(now)
+            if self.tokens is not None:
+                self.tokens.drain(now)
+
+    def mark_exhausted(self):
+        """Called after a per-day 429: no more requests on this key until the daily reset."""
+        with self.lock:
+            self._roll_day()
+            self.exhausted_until = self.day_reset
+
+    def restore(self, day_count=0, exhausted_until=0.0):
+        """Adopts usage recorded outside this process (the quota ledger): requests already sent today and daily exhaustion."""
+        with self.lock:
+            self._roll_day()
+            self.day_count = max(self.day_count, day_count)
+            self.exhausted_until = max(self.exhausted_until, exhausted_until)
+
+def get_rate_limits(model):
+    limits = config["gemini_rate_limits"]
+    return limits.get(model, limits["default"])
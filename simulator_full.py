@@ -1,10 +1,13 @@
 import random
 
 from utils_log import log_conversation
-from system_agent import SystemAgent
-from model_genai import generate
+from system_agent import SystemAgent, report_cascade_stats
+from model_registry import generate, generate_stream, generate_n, report_usage
+from model_cache import get_cache
+from streaming import report_stream_stats
 from tasks import get_task
 from utils import date_str
+from config import config
 import copy # not in orig
 
 # TO DO: add parameter is_base_model and if True will add 5-shot examples
@@ -12,7 +15,7 @@ import copy # not in orig
 
 class ConversationSimulatorFull:
     def __init__(self, sample, assistant_model, system_model, is_base_model=False, run_concat=False, 
-                 run_shuffle_concat=False, temperature=1.0, dataset_fn=None, log_folder=None):
+                 run_shuffle_concat=False, temperature=1.0, dataset_fn=None, log_folder=None, use_cache=None, stream=False):
         self.task_name = sample["task"]
         self.task = get_task(self.task_name)
         # print("Active extraction strategy:", self.task.answer_extraction_strategy)
@@ -23,13 +26,23 @@ class ConversationSimulatorFull:
         self.is_base_model = is_base_model
         self.run_concat = run_concat
         self.run_shuffle_concat = run_shuffle_concat
+        self.sharded_examples = is_base_model and (run_concat or run_shuffle_concat) # 5-shot sharded examples in the prompt
         self.log_folder = log_folder
         self.run_custom_temperature = temperature != 1.0
         self.temperature = temperature
+        # None = cache the assistant call only at T=0: at T>0 a cached (or coalesced in-flight) response would hand every
+        # repeated run of the same prompt the same sample
+        self.use_cache = use_cache if use_cache is not None else temperature == 0
+        self.stream = stream # stream the assistant call and stop once the task's answer has appeared
+        self.thinking_budget = self.task.get_thinking_budget("assistant")
         
         self.system_agent = SystemAgent(self.task_name, self.system_model, self.sample)
 
-    def run(self, verbose=False, save_log=True):  
+    def build_prompt(self, verbose=False):
+        """
+        Builds the single assistant prompt for this conversation type.
+        Returns (conv_type, input_prompt, max_tokens, stop) - everything needed to make (or batch) the assistant call.
+        """
         if self.run_shuffle_concat and self.run_concat:
             raise ValueError("Cannot set both run_concat and run_shuffle_concat to True")
 
@@ -83,16 +96,31 @@ class ConversationSimulatorFull:
         if self.run_custom_temperature:
             conv_type = f"{conv_type}-t{self.temperature}"
 
-        is_reasoning_model = "o1" in self.assistant_model or "o3" in self.assistant_model or "deepseek-r1" in self.assistant_model or "gemini-2.5" in self.assistant_model
-      
-        max_tokens = 16000 if is_reasoning_model else 1000
-        assistant_response = generate([{"role": "user", "content": input_prompt}], model=self.assistant_model, temperature=self.temperature, max_tokens=max_tokens)
+        # budget and stop sequences come from the task's answer format (Task.max_output_tokens / get_stop_sequences)
+        max_tokens = self.task.get_max_output_tokens(self.assistant_model)
+        return conv_type, input_prompt, max_tokens, self.task.get_stop_sequences()
+
+    def make_trace(self, input_prompt, assistant_response):
+        if self.sharded_examples:
+            # no stop sequence marks the end of a sharded example, so the run-on is cut here, before extraction sees it
+            assistant_response = self.task.trim_sharded_continuation(assistant_response)
+        return [{"role": "user", "content": input_prompt}, {"role": "assistant", "content": assistant_response, "cost_usd": 0.0}]
+
+    def finish(self, conv_type, input_prompt, assistant_response, verbose=False, save_log=True, stream_metrics=None, extracted_answer=None):
+        """
+        Extracts, evaluates and logs an assistant response to the prompt from build_prompt().
+        Split out of run() so responses obtained elsewhere (e.g. the batch runner) go through the same path.
+        extracted_answer skips the extraction call when the answer was already extracted (e.g. in a batch, system_agent.extract_answers_batch).
+        """
         if verbose:
             print(f"\033[91m[assistant] {assistant_response}\033[0m")
         
-        trace = [{"role": "user", "content": input_prompt}, {"role": "assistant", "content": assistant_response, "cost_usd": 0.0}]
+        trace = self.make_trace(input_prompt, assistant_response)
+        if stream_metrics is not None:
+            trace[-1]["stream_metrics"] = stream_metrics
 
-        extracted_answer = self.system_agent.extract_answer(trace)
+        if extracted_answer is None:
+            extracted_answer = self.system_agent.extract_answer(trace)
         # print("DEBUG: Extracted answer from system_agent.extract_answer():\n", repr(extracted_answer))
 
         evaluation_return = self.task.evaluator_function(extracted_answer, self.sample)
@@ -112,6 +140,25 @@ class ConversationSimulatorFull:
             log_conversation(conv_type, self.task_name, self.sample["task_id"], self.dataset_fn, assistant_model=self.assistant_model, system_model="NA", user_model="NA", trace=trace, is_correct=is_correct, score=score, log_folder=self.log_folder)
         return is_correct, score
 
+    def run(self, verbose=False, save_log=True):  
+        conv_type, input_prompt, max_tokens, stop = self.build_prompt(verbose=verbose)
+        if self.stream:
+            assistant_response, stream_metrics = generate_stream([{"role": "user", "content": input_prompt}], model=self.assistant_model, temperature=self.temperature, max_tokens=max_tokens, stop=stop, stop_predicate=self.task.should_stop_generation, thinking_budget=self.thinking_budget)
+            return self.finish(conv_type, input_prompt, assistant_response, verbose=verbose, save_log=save_log, stream_metrics=stream_metrics)
+
+        assistant_response = generate([{"role": "user", "content": input_prompt}], model=self.assistant_model, temperature=self.temperature, max_tokens=max_tokens, stop=stop, use_cache=self.use_cache, thinking_budget=self.thinking_budget)
+        return self.finish(conv_type, input_prompt, assistant_response, verbose=verbose, save_log=save_log)
+
+    def run_candidates(self, num_candidates, verbose=False, save_log=True):
+        """
+        num_candidates runs of this conversation from one multi-candidate request (generate_n) instead of num_candidates round-trips.
+        Each candidate is extracted, evaluated and logged as its own run; returns one (is_correct, score) per candidate.
+        Note that shuffle-concat candidates share a single shuffled shard order.
+        """
+        conv_type, input_prompt, max_tokens, stop = self.build_prompt(verbose=verbose)
+        assistant_responses = generate_n([{"role": "user", "content": input_prompt}], num_candidates, model=self.assistant_model, temperature=self.temperature, max_tokens=max_tokens, stop=stop, use_cache=self.use_cache, thinking_budget=self.thinking_budget)
+        return [self.finish(conv_type, input_prompt, assistant_response, verbose=verbose, save_log=save_log) for assistant_response in assistant_responses]
+
 if __name__ == "__main__":
     import json, argparse
     import time
@@ -125,10 +172,17 @@ if __name__ == "__main__":
     parser.add_argument("--run_shuffle_concat", action="store_true")
     parser.add_argument("--verbose", action="store_true")
     parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--system_cascade_model", type=str, default=None, help="Local model tried before the system model (overrides config['system_cascade_model'])")
+    parser.add_argument("--no_cache", action="store_true", help="Bypass the response cache for the assistant call")
+    parser.add_argument("--cache", action="store_true", help="Cache the assistant call even at T>0 (default: only at T=0, so every run samples fresh)")
+    parser.add_argument("--stream", action="store_true", help="Stream the assistant call and stop as soon as a valid answer appears")
+    parser.add_argument("--num_candidates", type=int, default=1, help="Runs served by one multi-candidate request, each logged as its own run")
     args = parser.parse_args()
 
     if args.run_concat and args.run_shuffle_concat:
         raise ValueError("Cannot set both run_concat and run_shuffle_concat to True")
+    if args.system_cascade_model:
+        config["system_cascade_model"] = args.system_cascade_model
 
     with open("data/sharded_mt.json", "r", encoding='utf-8') as f:
         data = json.load(f)
@@ -147,8 +201,19 @@ if __name__ == "__main__":
         run_shuffle_concat=args.run_shuffle_concat,
         temperature=args.temperature,
         dataset_fn="data/sharded_mt.json",  
-        log_folder="logs"  # ADD THIS
+        log_folder="logs",  # ADD THIS
+        use_cache=False if args.no_cache else (True if args.cache else None),
+        stream=args.stream
     )
     
-    for _ in range(1):
-        conversation_simulator.run(verbose=args.verbose, save_log=True)
\ No newline at end of file
+    if args.num_candidates > 1:
+        conversation_simulator.run_candidates(args.num_candidates, verbose=args.verbose, save_log=True)
+    else:
+        for _ in range(1):
+            conversation_simulator.run(verbose=args.verbose, save_log=True)
+
+    get_cache().report()
+    report_usage()
+    report_cascade_stats()
+    if args.stream:
+        report_stream_stats()
\ No newline at end of file
@@ -0,0 +1,70 @@
+import time
+import threading
+from collections import defaultdict
+
+from rate_limiter import estimate_tokens
+
+# latency numbers for every streamed call, per model: time to first token, total time and decode speed
+_stream_stats = defaultdict(list)
+_stats_lock = threading.Lock()
+
+def consume_stream(chunks, model, stop_predicate=None, on_token=None):
+    """
+    Reads a stream of text chunks until it ends or stop_predicate(text_so_far) returns True.
+    Stopping closes the stream, which cancels the request on the server side.
+    Returns (text, metrics) and records the metrics under the model name.
+    """
+    start = time.perf_counter()
+    first_token_time = None
+    parts = []
+    stopped_early = False
+    try:
+        for chunk in chunks:
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+            parts.append(chunk)
+            if on_token is not None:
+                on_token(chunk)
+            if stop_predicate is not None and stop_predicate("".join(parts)):
+                stopped_early = True
+                break
+    finally:
+        chunks.close()
+    end = time.perf_counter()
+
+    text = "".join(parts)
+    output_tokens = estimate_tokens(text) if text else 0
+    decode_time = end - first_token_time if first_token_time is not None else 0.0
+    metrics = {
+        "ttft_s": round(first_token_time - start, 4) if first_token_time is not None else None,
+        "total_s": round(end - start, 4),
+        "output_tokens_est": output_tokens,
+        "tokens_per_s": round(output_tokens / decode_time, 2) if decode_time > 0 else None,
+        "stopped_early": stopped_early,
+    }
+    with _stats_lock:
+        _stream_stats[model].append(metrics)
+    return text, metrics
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def stream_stats_summary():
+    with _stats_lock:
+        summary = {}
+        for model, records in _stream_stats.items():
+            ttfts = [r["ttft_s"] for r in records if r["ttft_s"] is not None]
+            speeds = [r["tokens_per_s"] for r in records if r["tokens_per_s"] is not None]
+            summary[model] = {
+                "calls": len(records),
+                "stopped_early": sum(r["stopped_early"] for r in records),
+                "ttft_p50_s": _percentile(ttfts, 0.5) if ttfts else None,
+                "ttft_p95_s": _percentile(ttfts, 0.95) if ttfts else None,
+                "tokens_per_s_p50": _percentile(speeds, 0.5) if speeds else None,
+            }
+        return summary
+
+def report_stream_stats():
+    for model, s in stream_stats_summary().items():
+        print(f"[stream] {model}: calls={s['calls']} stopped_early={s['stopped_early']} ttft_p50={s['ttft_p50_s']}s ttft_p95={s['ttft_p95_s']}s tok/s_p50={s['tokens_per_s_p50']}")
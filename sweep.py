@@ -0,0 +1,239 @@
+import json
+import itertools
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from simulator_full import ConversationSimulatorFull
+from model_registry import generate, generate_n, preload, get_backend_name, report_usage
+from model_cache import get_cache
+from concurrency import report_controllers
+from hedging import get_latency_tracker
+from system_agent import report_cascade_stats, extract_answers_batch
+from config import config
+from deadlines import CallDeadlineExceeded, get_retry_budget
+
+# Online sweep runner: builds every (sample, conversation type, run) job up front, orders the jobs so requests that
+# share a prompt prefix go out back to back, then runs them on a thread pool.
+
+CONV_TYPES = ["full", "concat", "shuffle-concat"]
+
+def build_jobs(samples, assistant_model, system_model, conv_types=CONV_TYPES, num_runs=1, is_base_model=False, temperature=1.0,
+               dataset_fn=None, log_folder="logs", use_cache=None, candidates=False):
+    """
+    Builds the assistant prompt for every (sample, conversation type, run) without calling any model.
+    With candidates=True the num_runs runs of a (sample, conversation type) become one job served by a single
+    multi-candidate request (generate_n); each candidate is still evaluated and logged as its own run.
+    use_cache=None caches assistant calls only at temperature 0, so the num_runs runs are independent samples.
+    """
+    jobs = []
+    for sample in samples:
+        for conv_type in conv_types:
+            for run_index in range(1 if candidates else num_runs):
+                simulator = ConversationSimulatorFull(sample, assistant_model, system_model, is_base_model=is_base_model,
+                                                      run_concat=conv_type == "concat", run_shuffle_concat=conv_type == "shuffle-concat",
+                                                      temperature=temperature, dataset_fn=dataset_fn, log_folder=log_folder, use_cache=use_cache)
+                log_conv_type, input_prompt, max_tokens, stop = simulator.build_prompt()
+                jobs.append({"simulator": simulator, "conv_type": log_conv_type, "input_prompt": input_prompt, "max_tokens": max_tokens, "stop": stop, "run_index": run_index,
+                             "num_candidates": num_runs if candidates else 1})
+    return jobs
+
+def _common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+def order_by_prefix(jobs):
+    """
+    Orders jobs so consecutive requests to the same model share as much prompt prefix as possible.
+    Sorting prompts lexicographically puts the strings with the longest common prefixes next to each other,
+    which groups by task system prompt, then by few-shot block, then by sample - the order Ollama's KV-cache
+    reuse and Gemini's implicit prompt caching both need.
+    """
+    ordered = sorted(jobs, key=lambda job: (job["simulator"].assistant_model, job["input_prompt"]))
+
+    total_chars = sum(len(job["input_prompt"]) for job in ordered)
+    shared_chars = sum(_common_prefix_len(prev["input_prompt"], job["input_prompt"])
+                       for prev, job in zip(ordered, ordered[1:]) if prev["simulator"].assistant_model == job["simulator"].assistant_model)
+    if total_chars:
+        print(f"[sweep] {len(ordered)} jobs; {shared_chars / total_chars:.1%} of prompt chars shared with the previous request")
+    return ordered
+
+def generate_job(job):
+    """The assistant call(s) for one job: one response, or one per candidate for multi-candidate jobs."""
+    simulator = job["simulator"]
+    messages = [{"role": "user", "content": job["input_prompt"]}]
+    settings = {"temperature": simulator.temperature, "max_tokens": job["max_tokens"], "stop": job["stop"], "use_cache": simulator.use_cache,
+                "thinking_budget": simulator.thinking_budget}
+    if job["num_candidates"] > 1:
+        return generate_n(messages, job["num_candidates"], model=simulator.assistant_model, **settings)
+    return [generate(messages, model=simulator.assistant_model, **settings)]
+
+def finish_job(job, assistant_responses, verbose=False, extracted_answers=None):
+    """
+    Extracts, evaluates and logs each response (system-model calls); returns a (task_id, conv_type, is_correct, score) per run.
+    extracted_answers holds answers already extracted in a batch (None where extraction still has to run).
+    """
+    simulator = job["simulator"]
+    extracted_answers = extracted_answers or [None] * len(assistant_responses)
+    results = []
+    for assistant_response, extracted_answer in zip(assistant_responses, extracted_answers):
+        is_correct, score = simulator.finish(job["conv_type"], job["input_prompt"], assistant_response, verbose=verbose, extracted_answer=extracted_answer)
+        results.append((simulator.sample["task_id"], job["conv_type"], is_correct, score))
+    return results
+
+def run_job(job, verbose=False):
+    """Runs one job; returns a (task_id, conv_type, is_correct, score) per run (one per candidate for multi-candidate jobs)."""
+    return finish_job(job, generate_job(job), verbose=verbose)
+
+def _run_phase(executor, jobs, fn, workers, max_requeues, on_drain=None):
+    """
+    Runs fn(job) for every job on the pool and returns the results in job order (None for jobs given up on).
+    A job whose call runs out of time (deadlines.CallDeadlineExceeded) goes to the back of the queue so the workers keep
+    moving, up to max_requeues times. Any other error is reported and the job given up on, so one bad job (e.g. a
+    non-retryable API error or every key out of daily quota) doesn't discard the rest of the sweep.
+    on_drain() is called once the queue is empty and only the last in-flight jobs remain.
+    """
+    results = [None] * len(jobs)
+    pending = {executor.submit(fn, job): (index, 0) for index, job in enumerate(jobs)}
+    drained = False
+    while pending:
+        if on_drain is not None and not drained and len(pending) <= workers:
+            on_drain()
+            drained = True
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, requeues = pending.pop(future)
+            try:
+                results[index] = future.result()
+            except CallDeadlineExceeded as e:
+                job = jobs[index]
+                if requeues < max_requeues:
+                    print(f"[sweep] {job['simulator'].sample['task_id']} ({job['conv_type']}) ran out of time, re-queueing: {e}")
+                    pending[executor.submit(fn, job)] = (index, requeues + 1)
+                else:
+                    print(f"[sweep] Giving up on {job['simulator'].sample['task_id']} ({job['conv_type']}) after {requeues} re-queues")
+            except Exception as e:
+                job = jobs[index]
+                print(f"[sweep] {job['simulator'].sample['task_id']} ({job['conv_type']}) failed: {e.__class__.__name__}: {str(e)[:200]}")
+    if on_drain is not None and not drained:
+        on_drain()
+    return results
+
+def _unfinished(job):
+    return [(job["simulator"].sample["task_id"], job["conv_type"], None, None)] * job["num_candidates"]
+
+def _system_models(jobs):
+    # every model finish() may call: the system model and, in cascade mode, the local first stage
+    simulator = jobs[0]["simulator"]
+    return [model for model in (simulator.system_agent.cascade_model, simulator.system_model) if model]
+
+def _extract_phase(jobs, workers):
+    """Batched answer extraction for every response of the finished jobs; returns the answers per job (None = not extracted yet)."""
+    requests = [(job["simulator"].system_agent, job["simulator"].make_trace(job["input_prompt"], assistant_response))
+                for job in jobs for assistant_response in job["responses"]]
+    # items failing the batch come back as None and are retried one by one in the finish phase, where re-queueing applies
+    answers = iter(extract_answers_batch(requests, workers=workers, retry_failed=False))
+    return [[next(answers) for _ in job["responses"]] for job in jobs]
+
+def run_sweep(jobs, workers=4, verbose=False, max_requeues=None, group_by_model=None, batch_extraction=None):
+    """
+    Runs jobs in prefix order; the pool picks them up FIFO so prefix groups stay together. Returns (task_id, conv_type, is_correct, score) per run.
+    Jobs that keep running out of time are given up after max_requeues (default config["sweep_max_requeues"]) with is_correct=None,
+    as are jobs that fail with any other error.
+
+    group_by_model (default: on when any model involved is served by Ollama) avoids model-load thrashing on a shared
+    Ollama host: all assistant calls run first, one assistant model at a time, and the system-model calls (extraction)
+    run afterwards. While a group drains, the next group's model is preloaded.
+
+    batch_extraction (default: on when config["system_extraction_batch_size"] > 1) also runs all assistant calls first,
+    then extracts the answers many per system-model call (system_agent.extract_answers_batch) before evaluating.
+    """
+    jobs = order_by_prefix(jobs)
+    if not jobs:
+        return []
+    max_requeues = config["sweep_max_requeues"] if max_requeues is None else max_requeues
+    if group_by_model is None:
+        models = {job["simulator"].assistant_model for job in jobs} | set(_system_models(jobs))
+        group_by_model = any(get_backend_name(model) == "ollama" for model in models)
+    if batch_extraction is None:
+        batch_extraction = config["system_extraction_batch_size"] > 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if not group_by_model and not batch_extraction:
+            results = _run_phase(executor, jobs, lambda job: run_job(job, verbose=verbose), workers, max_requeues)
+            return [result for job, job_results in zip(jobs, results) for result in (job_results or _unfinished(job))]
+
+        if group_by_model:
+            # order_by_prefix already sorts by assistant model, so each model's jobs are contiguous
+            groups = [list(group) for _, group in itertools.groupby(jobs, key=lambda job: job["simulator"].assistant_model)]
+            next_models = [[groups[i + 1][0]["simulator"].assistant_model] for i in range(len(groups) - 1)] + [_system_models(jobs)]
+        else:
+            groups, next_models = [jobs], [None]
+        responses = []
+        for group, upcoming in zip(groups, next_models):
+            model = group[0]["simulator"].assistant_model
+            print(f"[sweep] Assistant calls for {model}: {len(group)} jobs")
+            if upcoming is None:
+                responses += _run_phase(executor, group, generate_job, workers, max_requeues)
+                continue
+            preload(model)
+            responses += _run_phase(executor, group, generate_job, workers, max_requeues,
+                                    on_drain=lambda upcoming=upcoming: [preload(next_model) for next_model in upcoming])
+
+        print(f"[sweep] System-model calls for {len(jobs)} jobs")
+        finished = [dict(job, responses=job_responses) for job, job_responses in zip(jobs, responses) if job_responses is not None]
+        if batch_extraction:
+            for job, extracted in zip(finished, _extract_phase(finished, workers)):
+                job["extracted"] = extracted
+        results = _run_phase(executor, finished, lambda job: finish_job(job, job["responses"], verbose=verbose, extracted_answers=job.get("extracted")), workers, max_requeues)
+        results = iter(results)
+        return [result for job, job_responses in zip(jobs, responses)
+                for result in ((next(results) or _unfinished(job)) if job_responses is not None else _unfinished(job))]
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_fn", type=str, default="data/sharded_instructions.json")
+    parser.add_argument("--task", type=str, default="all")
+    parser.add_argument("--assistant_model", type=str, default="gemini-2.5-flash")
+    parser.add_argument("--system_model", type=str, default="gemini-2.5-flash")
+    parser.add_argument("--conv_types", type=str, nargs="+", default=CONV_TYPES, choices=CONV_TYPES)
+    parser.add_argument("--num_runs", type=int, default=1)
+    parser.add_argument("--candidates", action="store_true", help="Serve the --num_runs runs of each sample and conversation type from one multi-candidate request")
+    parser.add_argument("--is_base_model", action="store_true")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--workers", type=int, default=32, help="Upper bound on threads; actual in-flight requests adapt per model (config['aimd'])")
+    parser.add_argument("--log_folder", type=str, default="logs")
+    parser.add_argument("--no_group_by_model", action="store_true", help="Interleave assistant and system calls even when Ollama models are involved")
+    parser.add_argument("--system_cascade_model", type=str, default=None, help="Local model tried before the system model (overrides config['system_cascade_model'])")
+    parser.add_argument("--extraction_batch_size", type=int, default=None, help="Answer extractions per system-model call (overrides config['system_extraction_batch_size']; 1 = no batching)")
+    parser.add_argument("--no_cache", action="store_true", help="Bypass the response cache for the assistant call")
+    parser.add_argument("--cache", action="store_true", help="Cache the assistant call even at T>0 (repeated runs then share one sample)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.system_cascade_model:
+        config["system_cascade_model"] = args.system_cascade_model
+    if args.extraction_batch_size:
+        config["system_extraction_batch_size"] = args.extraction_batch_size
+
+    with open(args.dataset_fn, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data = [d for d in data if (d["task"] == args.task or args.task == "all")]
+
+    jobs = build_jobs(data, args.assistant_model, args.system_model, conv_types=args.conv_types, num_runs=args.num_runs,
+                      is_base_model=args.is_base_model, temperature=args.temperature, dataset_fn=args.dataset_fn,
+                      log_folder=args.log_folder, use_cache=False if args.no_cache else (True if args.cache else None), candidates=args.candidates)
+    results = run_sweep(jobs, workers=args.workers, verbose=args.verbose, group_by_model=False if args.no_group_by_model else None)
+
+    num_correct = sum(1 for _, _, is_correct, _ in results if is_correct)
+    num_unfinished = sum(1 for _, _, is_correct, _ in results if is_correct is None)
+    print(f"[sweep] {num_correct}/{len(results)} correct ({num_unfinished} failed or timed out)")
+    get_cache().report()
+    report_controllers()
+    get_latency_tracker().report()
+    report_usage()
+    report_cascade_stats()
+    get_retry_budget().report()
@@ -1,29 +1,74 @@
 import json
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
 from utils import extract_conversation
-from model_genai import generate_json #what model do we use for system agent? - gemini free api might be too limity
+from model_registry import generate_json # routed by model name, e.g. gemini-* -> genai, sailor2:* -> ollama
 from tasks import get_task
+from prompt_template import load_template
 
 #note: removed return_metadata in generate_json calls (maybe temporarily) since not implemented (yet?)
 # might remove preffix-suffix strat later (no need for our tasks)
 
+# output schemas for the system-model calls - constrained decoding on both backends (see json_schema.py)
+VERIFICATION_SCHEMA = {"response_type": str}
+ANSWER_EXTRACTION_SCHEMA = {"answer": str}
+ANSWER_BATCH_SCHEMA = {"answers": [{"id": int, "answer": str}]}
+
+# cascade mode: a local model answers first and the (remote) system model only sees what it couldn't handle.
+# (call kind, stage) -> {"hit": n, "miss": n}, where stage is "local" or "remote"
+_cascade_stats = defaultdict(lambda: {"hit": 0, "miss": 0})
+_cascade_lock = threading.Lock()
+
+def _record_stage(kind, stage, hit):
+    with _cascade_lock:
+        _cascade_stats[(kind, stage)]["hit" if hit else "miss"] += 1
+
+# rule-based fast path for closed-label tasks (Task.rule_extract_answer): task -> {"rule": n, "fallback": n}
+_rule_stats = defaultdict(lambda: {"rule": 0, "fallback": 0})
+
+def _record_rule(task_name, hit):
+    with _cascade_lock:
+        _rule_stats[task_name]["rule" if hit else "fallback"] += 1
+
+def report_cascade_stats():
+    with _cascade_lock:
+        stats = dict(_cascade_stats)
+        rule_stats = dict(_rule_stats)
+    for task_name, counts in sorted(rule_stats.items()):
+        total = counts["rule"] + counts["fallback"]
+        print(f"[rules] {task_name}: {counts['rule']}/{total} answers extracted by rules, {counts['fallback'] / total:.1%} fell back to the LLM extractor")
+    for (kind, stage), counts in sorted(stats.items()):
+        total = counts["hit"] + counts["miss"]
+        print(f"[cascade] {kind} / {stage}: {counts['hit']}/{total} hits ({counts['hit'] / total:.1%})")
+    for kind in sorted({kind for kind, _ in stats}):
+        local = stats.get((kind, "local"), {"hit": 0, "miss": 0})
+        handled = local["hit"] + local["miss"]
+        if handled:
+            print(f"[cascade] {kind}: {local['hit']}/{handled} calls kept off the remote system model")
+
 class SystemAgent:
-    def __init__(self, task_name, system_model, sample):
+    def __init__(self, task_name, system_model, sample, cascade_model=None):
         self.system_model = system_model
+        # local first stage (e.g. an Ollama model); None = config["system_cascade_model"], which is off by default
+        self.cascade_model = cascade_model or config["system_cascade_model"]
         self.task_name = task_name
         self.task = get_task(task_name)
         self.answer_extraction_strategy = self.task.answer_extraction_strategy
         self.sample = sample
         self.answer_description = self.task.get_answer_description()
         self.max_extraction_attempts = 3
+        self.rule_checked = set() # responses already counted in the rule stats (a batch fallback comes back through extract_answer)
 
         assert self.answer_extraction_strategy in ["full_response", "prefix_suffix", "gen", "task_specific"], f"Answer extraction strategy {self.answer_extraction_strategy} not supported"
 
-        with open("prompts/system_turn_categorization.txt", "r", encoding="utf-8") as f:
-            self.system_verification_prompt = f.read()
-        with open("prompts/system_answer_extraction_gen.txt", "r", encoding="utf-8") as f:
-            self.answer_extraction_prompt_gen = f.read()
-        with open("prompts/system_answer_extraction_prefix_suffix.txt", "r", encoding="utf-8") as f:
-            self.answer_extraction_prompt_prefix_suffix = f.read()
+        self.system_verification_template = load_template("prompts/system_turn_categorization.txt", variables=["CONVERSATION_SO_FAR", "INITIAL_SHARD", "SHARDS", "ANSWER_DESCRIPTION"])
+        # filled per call through generate_json(variables=...), which compiles each prompt text once
+        self.answer_extraction_prompt_gen = load_template("prompts/system_answer_extraction_gen.txt", variables=["ASSISTANT_RESPONSE", "ANSWER_DESCRIPTION"]).text
+        self.answer_extraction_prompt_prefix_suffix = load_template("prompts/system_answer_extraction_prefix_suffix.txt", variables=["ASSISTANT_RESPONSE", "ANSWER_DESCRIPTION"]).text
+        self.answer_extraction_batch_template = load_template("prompts/system_answer_extraction_gen_batch.txt", variables=["ITEMS"])
 
 
     def verify_system_response(self, conversation_so_far):
@@ -39,8 +84,21 @@ class SystemAgent:
         # print("--------------------- TURN CLASSIFICATION ---------------------")
         # print(last_turn_text)
 
-        system_verification_prompt_populated = self.system_verification_prompt.replace("[[CONVERSATION_SO_FAR]]", last_turn_text).replace("[[INITIAL_SHARD]]", initial_query).replace("[[SHARDS]]", json.dumps(shards)).replace("[[ANSWER_DESCRIPTION]]", self.answer_description)
-        system_verification_response_obj = generate_json([{"role": "user", "content": system_verification_prompt_populated}], model=self.system_model, temperature=0.0)
+        system_verification_prompt_populated = self.system_verification_template.render({"CONVERSATION_SO_FAR": last_turn_text, "INITIAL_SHARD": initial_query, "SHARDS": json.dumps(shards), "ANSWER_DESCRIPTION": self.answer_description})
+        messages = [{"role": "user", "content": system_verification_prompt_populated}]
+        thinking_budget = self.task.get_thinking_budget("turn_categorization")
+        system_verification_response_obj = None
+        if self.cascade_model:
+            # schema validation is the local stage's acceptance check here
+            try:
+                system_verification_response_obj = generate_json(messages, model=self.cascade_model, temperature=0.0, response_schema=VERIFICATION_SCHEMA, thinking_budget=thinking_budget)
+            except Exception as e:
+                print(f"[cascade] Local turn categorization failed, escalating: {str(e)[:100]}")
+            _record_stage("turn_categorization", "local", system_verification_response_obj is not None)
+        if system_verification_response_obj is None:
+            system_verification_response_obj = generate_json(messages, model=self.system_model, temperature=0.0, response_schema=VERIFICATION_SCHEMA, thinking_budget=thinking_budget)
+            if self.cascade_model:
+                _record_stage("turn_categorization", "remote", True)
         system_verification_response = system_verification_response_obj
 
         # print(system_verification_response)
@@ -61,37 +119,176 @@ class SystemAgent:
             return self.task.extract_answer(assistant_response)
         else:
             # print("DEBUG: Entering gen/prefix_suffix extraction block")
+            extracted_answer = self._rule_extract(assistant_response)
+            if extracted_answer is not None:
+                return extracted_answer
             prompt = self.answer_extraction_prompt_gen if self.answer_extraction_strategy == "gen" else self.answer_extraction_prompt_prefix_suffix
             last_assistant_turn_text = extract_conversation(conversation_so_far, to_str=True, only_last_turn=True)
             extracted_answer = None
             extraction_attempts = 0
+
+            # cascade: one attempt on the local model, escalating to the system model if it fails the schema or extractive check
+            if self.cascade_model:
+                extracted_answer = self._extract_once(self.cascade_model, prompt, last_assistant_turn_text, assistant_response, extraction_attempts + 1)
+                _record_stage("answer_extraction", "local", extracted_answer is not None)
+
             # print("DEBUG: Entering extraction loop")
             while extracted_answer is None and extraction_attempts < self.max_extraction_attempts:
                 extraction_attempts += 1
-                answer_extraction_response_obj = generate_json([{"role": "user", "content": prompt}], model=self.system_model, variables={"ASSISTANT_RESPONSE": last_assistant_turn_text, "ANSWER_DESCRIPTION": self.answer_description}, temperature=0.0)
-                answer_extraction_response = answer_extraction_response_obj
-                # print("DEBUG: Raw extractor LLM JSON output:")
-                # print(answer_extraction_response_obj)
-                if self.answer_extraction_strategy == "gen":
-                    extracted_answer = answer_extraction_response["answer"]
-
-                else:
-                    extractor_response = answer_extraction_response["answer"]
-                    if "[...]" in extractor_response and extractor_response.count("[...]") == 1 :
-                        prefix, suffix = extractor_response.split("[...]")
-                        prefix, suffix = prefix.strip(), suffix.strip()
-
-                        start_idx = assistant_response.find(prefix)
-                        end_idx = assistant_response.rfind(suffix)
-                        extracted_answer = assistant_response[start_idx:(end_idx+len(suffix))]
-                    else:
-                        extracted_answer = extractor_response
-                
-                if extracted_answer is not None and extracted_answer not in assistant_response:
-                    extracted_answer = None # will need to try again, this ensures the process is extractive
+                extracted_answer = self._extract_once(self.system_model, prompt, last_assistant_turn_text, assistant_response, extraction_attempts)
+                if self.cascade_model and (extracted_answer is not None or extraction_attempts == self.max_extraction_attempts):
+                    _record_stage("answer_extraction", "remote", extracted_answer is not None)
 
         # print("DEBUG: Final extracted_answer before return:", repr(extracted_answer))
         if extracted_answer is None:
             print(f"Failed to extract answer after {extraction_attempts} attempts")
             extracted_answer = "" # defaulting to empty string
-        return extracted_answer
\ No newline at end of file
+        return extracted_answer
+
+    def _rule_extract(self, assistant_response):
+        """The rule-based answer for "gen" extraction on closed-label tasks if it is confident enough, else None (use the LLM)."""
+        if self.answer_extraction_strategy != "gen" or self.task.answer_pattern is None or not config["rule_extraction_enabled"]:
+            return None
+        answer, confidence = self.task.rule_extract_answer(assistant_response)
+        hit = answer is not None and confidence >= config["rule_extraction_min_confidence"]
+        if assistant_response not in self.rule_checked:
+            self.rule_checked.add(assistant_response)
+            _record_rule(self.task_name, hit)
+        return answer if hit else None
+
+    def _extract_once(self, model, prompt, last_assistant_turn_text, assistant_response, attempt):
+        """One extraction call on model; returns the extracted answer, or None if it is unusable or not verbatim in the response."""
+        try:
+            # a retry sends the identical request, so only the first attempt may be answered from the response cache
+            answer_extraction_response_obj = generate_json([{"role": "user", "content": prompt}], model=model, variables={"ASSISTANT_RESPONSE": last_assistant_turn_text, "ANSWER_DESCRIPTION": self.answer_description}, temperature=0.0, response_schema=ANSWER_EXTRACTION_SCHEMA, thinking_budget=self.task.get_thinking_budget("answer_extraction"), use_cache=attempt == 1)
+        except ValueError as e:
+            # unrepairable JSON - counts as a failed attempt instead of ending the conversation
+            print(f"[system] Answer extraction attempt {attempt} on {model} returned unusable JSON: {str(e)[:100]}")
+            return None
+        except Exception as e:
+            if model == self.system_model:
+                raise
+            print(f"[cascade] Local extraction on {model} failed, escalating: {str(e)[:100]}")
+            return None
+        answer_extraction_response = answer_extraction_response_obj
+        # print("DEBUG: Raw extractor LLM JSON output:")
+        # print(answer_extraction_response_obj)
+        if self.answer_extraction_strategy == "gen":
+            extracted_answer = answer_extraction_response["answer"]
+
+        else:
+            extractor_response = answer_extraction_response["answer"]
+            if "[...]" in extractor_response and extractor_response.count("[...]") == 1 :
+                prefix, suffix = extractor_response.split("[...]")
+                prefix, suffix = prefix.strip(), suffix.strip()
+
+                start_idx = assistant_response.find(prefix)
+                end_idx = assistant_response.rfind(suffix)
+                extracted_answer = assistant_response[start_idx:(end_idx+len(suffix))]
+            else:
+                extracted_answer = extractor_response
+
+        if extracted_answer not in assistant_response:
+            return None # will need to try again, this ensures the process is extractive
+        return extracted_answer
+
+def _extraction_batches(items, model_of, batch_size, batch_chars):
+    """Splits (index, agent, turn text, assistant response) items into batches of at most batch_size items and about batch_chars of response text, per model."""
+    by_model = defaultdict(list)
+    for item in items:
+        by_model[model_of(item[1])].append(item)
+    batches = []
+    for model, model_items in by_model.items():
+        batch, chars = [], 0
+        for item in model_items:
+            if batch and (len(batch) >= batch_size or chars + len(item[2]) > batch_chars):
+                batches.append((model, batch))
+                batch, chars = [], 0
+            batch.append(item)
+            chars += len(item[2])
+        if batch:
+            batches.append((model, batch))
+    return batches
+
+def _extract_batch(model, batch):
+    """
+    One call on model for a batch of "gen" extractions. Returns {index: answer} for the items whose answer came back
+    and is verbatim in their response; the other items are left out (for the next stage or an individual retry).
+    """
+    agent = batch[0][1]
+    payload = [{"id": i, "answer_description": item_agent.answer_description, "response": text} for i, (_, item_agent, text, _) in enumerate(batch)]
+    prompt = agent.answer_extraction_batch_template.render({"ITEMS": json.dumps(payload, ensure_ascii=False, indent=1)})
+    thinking_budgets = [item_agent.task.get_thinking_budget("answer_extraction") for _, item_agent, _, _ in batch]
+    thinking_budget = None if None in thinking_budgets else max(thinking_budgets)
+    try:
+        response_obj = generate_json([{"role": "user", "content": prompt}], model=model, temperature=0.0, response_schema=ANSWER_BATCH_SCHEMA, thinking_budget=thinking_budget)
+    except ValueError as e:
+        print(f"[system] Batched extraction of {len(batch)} items on {model} returned unusable JSON: {str(e)[:100]}")
+        return {}
+    except Exception as e:
+        # a failed batch (timeout, API error) costs nothing but the call: its items still get their individual extraction,
+        # where errors surface per conversation
+        print(f"[system] Batched extraction of {len(batch)} items on {model} failed: {e.__class__.__name__}: {str(e)[:100]}")
+        return {}
+
+    answers = {}
+    for entry in response_obj.get("answers") or []:
+        if not isinstance(entry, dict) or not isinstance(entry.get("id"), int) or not isinstance(entry.get("answer"), str):
+            continue
+        if 0 <= entry["id"] < len(batch) and entry["id"] not in answers:
+            answers[entry["id"]] = entry["answer"]
+    extracted = {}
+    for i, (index, _, _, assistant_response) in enumerate(batch):
+        # same extractive check as a single call, against the item's own assistant response
+        answer = answers.get(i)
+        if answer is not None and answer in assistant_response:
+            extracted[index] = answer
+    return extracted
+
+def extract_answers_batch(requests, batch_size=None, batch_chars=None, workers=4, retry_failed=True):
+    """
+    extract_answer() for many conversations: requests is a list of (SystemAgent, conversation_so_far); returns one answer per request.
+    "gen" extractions are packed batch_size at a time (config["system_extraction_batch_size"]) into one call with a per-item
+    JSON array response, and each item is checked to be verbatim in its own response. As with single extractions, the batches
+    go to the cascade model first when one is set and what it misses goes to the system model. Items that still fail are
+    retried individually through extract_answer() - or, with retry_failed=False, returned as None for the caller to retry.
+    Other strategies go through extract_answer() directly.
+    """
+    batch_size = batch_size or config["system_extraction_batch_size"]
+    batch_chars = batch_chars or config["system_extraction_batch_chars"]
+    answers = [None] * len(requests)
+    items = []
+    for index, (agent, conversation_so_far) in enumerate(requests):
+        if agent.answer_extraction_strategy != "gen":
+            answers[index] = agent.extract_answer(conversation_so_far)
+            continue
+        assistant_response = [msg["content"] for msg in conversation_so_far if msg["role"] == "assistant"][-1]
+        answers[index] = agent._rule_extract(assistant_response)
+        if answers[index] is not None:
+            continue
+        # the batch prompt carries the same text a single call would get
+        items.append((index, agent, extract_conversation(conversation_so_far, to_str=True, only_last_turn=True), assistant_response))
+
+    num_calls = 0
+    remaining = items
+    for stage, model_of in (("local", lambda agent: agent.cascade_model), ("remote", lambda agent: agent.system_model)):
+        stage_items = [item for item in remaining if model_of(item[1])]
+        if not stage_items:
+            continue
+        batches = _extraction_batches(stage_items, model_of, batch_size, batch_chars)
+        num_calls += len(batches)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for extracted in executor.map(lambda batch: _extract_batch(*batch), batches):
+                for index, answer in extracted.items():
+                    answers[index] = answer
+        for index, agent, _, _ in stage_items:
+            _record_stage("batched_extraction", stage, answers[index] is not None)
+        remaining = [item for item in remaining if answers[item[0]] is None]
+
+    failed = [index for index, _, _, _ in remaining]
+    print(f"[system] Batched extraction: {len(items)} items in {num_calls} calls, {len(failed)} to retry individually")
+    if retry_failed:
+        for index in failed:
+            agent, conversation_so_far = requests[index]
+            answers[index] = agent.extract_answer(conversation_so_far)
+    return answers
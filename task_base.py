@@ -1,10 +1,24 @@
 from abc import ABC, abstractmethod
 from typing import Dict, Any, Optional, Union, List
-import json
+import json, re
+
+from config import config
+from prompt_template import load_template
+
+# rendered few-shot blocks, keyed by (task name, "full"/"sharded", num_examples); tasks are rebuilt per conversation,
+# so this lives at module level rather than on the instance
+_fewshot_cache = {}
 
 class Task(ABC):
     """Base class for all tasks"""
 
+    # regex for a valid answer (closed-label tasks only); None for free-form tasks like asu/mt
+    answer_pattern: Optional[str] = None
+
+    # output budget and stop sequences for the assistant call, sized to the task's answer format
+    max_output_tokens: int = 1000
+    stop_sequences: List[str] = []
+
     def __init__(self, version: str):
         self.version: str = version
         self.task_name: str = self._get_task_name()
@@ -68,6 +82,97 @@ class Task(ABC):
         """Generate few-shot examples for sharded/concat prompts."""
         pass
 
+    def get_max_output_tokens(self, model: str) -> int:
+        """Output budget for the assistant call; reasoning models also spend output tokens on thinking, so they get an allowance on top."""
+        if any(name in model for name in config["reasoning_models"]):
+            thinking_budget = self.get_thinking_budget("assistant")
+            allowance = thinking_budget if thinking_budget is not None and thinking_budget >= 0 else config["reasoning_output_allowance"]
+            return self.max_output_tokens + allowance
+        return self.max_output_tokens
+
+    def get_stop_sequences(self) -> List[str]:
+        """Stop sequences for the assistant call: the header of the next full few-shot example, where base models run on."""
+        return list(self.stop_sequences)
+
+    def trim_sharded_continuation(self, response: str) -> str:
+        """
+        Cuts a base model's response where it runs on into another sharded few-shot example (prompts/sharded_example.txt, used for
+        concat / shuffle-concat). Those examples have no header, only a blank line after the previous "Sagot: ..." line, and a bare
+        "\n\n" stop would also fire on the blank line base models often open with - so leading whitespace is dropped first, then
+        everything from the first blank line on.
+        """
+        response = response.lstrip()
+        end = response.find("\n\n")
+        return response if end < 0 else response[:end]
+
+    def get_thinking_budget(self, role: str) -> Optional[int]:
+        """Thinking budget for a call role ("assistant", "answer_extraction", "turn_categorization"); per-task entries win over the role default."""
+        budgets = config["thinking_budgets"]
+        task_budgets = budgets["tasks"].get(self.get_task_name(), {})
+        return task_budgets[role] if role in task_budgets else budgets.get(role)
+
+    def render_full_examples(self, num_examples: int = 5) -> str:
+        """Renders the first num_examples examples with self.full_example_template (built once, then cached)."""
+        return self._render_examples("full", self.full_example_template, num_examples, lambda example: example)
+
+    def render_sharded_examples(self, num_examples: int = 5) -> str:
+        """Renders the first num_examples examples as concatenated shards + label (built once, then cached)."""
+        template = load_template("prompts/sharded_example.txt", variables=["shards", "label"])
+        return self._render_examples("sharded", template, num_examples,
+                                     lambda example: {"shards": "\n".join(shard["shard"] for shard in example["shards"]), "label": example["label"]})
+
+    def _render_examples(self, kind, template, num_examples, to_values):
+        key = (self.get_task_name(), kind, num_examples)
+        if key not in _fewshot_cache:
+            try:
+                _fewshot_cache[key] = "\n".join(template.render(to_values(example)) for example in self.examples[:num_examples])
+            except Exception as e:
+                print(f"Warning: Could not format examples: {e}")
+                return ""
+        return _fewshot_cache[key]
+
+    def rule_extract_answer(self, response: str):
+        """
+        Deterministic answer extraction for closed-label tasks, tried before the LLM extractor (SystemAgent).
+        Returns (answer, confidence) with answer verbatim from response, or (None, 0.0) when the rules can't decide.
+        Rules, strongest first: an explicit marker ("Sagot: B", "Ang sagot ay B"), a response that is only the label ("**B**."),
+        a Filipino/English option phrase ("titik B", "opsyon B"), and for label-word tasks a single label word ("Positibo ang ...").
+        A rule that finds different labels, or a negated one ("hindi positibo"), makes the response ambiguous.
+        """
+        if self.answer_pattern is None:
+            return None, 0.0
+        label = self.answer_pattern
+        rules = [
+            (r"\b(?:sagot|answer)\s*(?:ay|is)?\s*[:=\-]?\s*(?:titik|letra)?\s*[*(\[\"']*\s*" + label + r"(?!\w)", 1.0),
+            (r"^\W*" + label + r"\W*$", 0.95), # the whole response
+            (r"(?:titik|letra|opsyon|option|pagpipilian|piliin ang|choice)\s*[*(\[\"']*\s*" + label + r"(?!\w)", 0.85),
+        ]
+        # a single letter in running text is too weak a signal; label words (positibo, mapoot) are not
+        letter_labels = re.fullmatch(label, "a", re.IGNORECASE) is not None
+        if not letter_labels:
+            rules.append((label, 0.8))
+
+        for rule, confidence in rules:
+            matches = list(re.finditer(rule, response, re.IGNORECASE))
+            if letter_labels and confidence != 0.95:
+                # in running text only a capital counts ("the answer is a bit..." is not option A)
+                matches = [match for match in matches if match.group(1).isupper()]
+            if not matches:
+                continue
+            negated = any(re.search(r"\b(?:hindi|not)\s+(?:\w+\s+)?$", response[:match.start()], re.IGNORECASE) for match in matches)
+            if negated or len({match.group(1).lower() for match in matches}) > 1:
+                return None, 0.0
+            return matches[-1].group(1), confidence
+        return None, 0.0
+
+    def should_stop_generation(self, partial_response: str) -> bool:
+        """Stop predicate for streamed assistant responses: True once a complete "Sagot: <answer>" line has appeared.
+        Free-form tasks (no answer_pattern) never stop early."""
+        if self.answer_pattern is None:
+            return False
+        # the lookahead waits for the character after the answer, so "Sagot: A" doesn't fire on "Sagot: Ang..."
+        return re.search(r"Sagot\s*:\s*[*(\[]*\s*" + self.answer_pattern + r"(?=\W)", partial_response, re.IGNORECASE) is not None
+
     def save_samples(self, samples: List[Dict[str, Any]]):
         dataset_fn = self.get_dataset_file()
         with open(dataset_fn, "w") as f:
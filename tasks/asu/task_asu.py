@@ -1,5 +1,6 @@
 from typing import List, Dict, Any
 from task_base import Task
+from prompt_template import load_template
 import json, random, re 
 import torch
 from rouge_score import rouge_scorer
@@ -10,8 +11,9 @@ import time
 
 class TaskAS(Task):
     def __init__(self):
-        with open("prompts/asu/asu_full_prompt.txt", "r") as f:
-            self.fully_specified_prompt = f.read()
+        self.fully_specified_template = load_template("prompts/asu/asu_full_prompt.txt", variables=["text", "fewshot_examples"])
+        self.fully_specified_prompt = self.fully_specified_template.text
+        self.full_example_template = load_template("prompts/asu/asu_full_example.txt", variables=["text", "label"])
         with open("prompts/asu/asu_system_prompt.txt", "r") as f:
             self.system_prompt = f.read()
 
@@ -29,6 +31,8 @@ class TaskAS(Task):
         random.seed(self.seed)
 
         self.answer_extraction_strategy = "full_response"
+        self.max_output_tokens = 256 # a one- or two-sentence "Buod:"
+        self.stop_sequences = ["\nArtikulo:"] # start of the next few-shot example; base models run on into it
 
     def get_task_name(self) -> str:
         return "asu"
@@ -173,10 +177,8 @@ class TaskAS(Task):
             }
 
     def populate_fully_specific_prompt(self, sample: Dict[str, Any]) -> str:
-        return (
-            self.fully_specified_prompt
-            .replace("[[text]]", sample["text"])
-        )
+        # fills the sample's fields; [[fewshot_examples]] is left in place for the simulator
+        return self.fully_specified_template.render(sample)
 
     def populate_concat_prompt(self, sample: Dict[str, Any]) -> str:
         """
@@ -205,59 +207,11 @@ class TaskAS(Task):
 
     def populate_full_examples(self, num_examples: int = 5) -> str:
         """Generate few-shot examples for full prompts."""
-        try:
-            # Use pre-loaded examples
-            examples = self.examples[:num_examples]
-            
-            # Load template
-            with open(f"prompts/{self.get_task_name()}/{self.get_task_name()}_full_example.txt", "r", encoding='utf-8') as f:
-                template = f.read()
-            
-            # Format each example
-            formatted_examples = []
-            for example in examples:
-                # Use text and label fields directly
-                example_data = {
-                    "text": example["text"],
-                    "label": example["label"]
-                }
-                formatted_example = template
-                for key, value in example_data.items():
-                    formatted_example = formatted_example.replace(f"[[{key}]]", str(value))
-                formatted_examples.append(formatted_example)
-            
-            return "\n".join(formatted_examples)
-        
-        except Exception as e:
-            print(f"Warning: Could not format examples: {e}")
-            return ""
+        return self.render_full_examples(num_examples)
 
     def populate_sharded_examples(self, num_examples: int = 5) -> str:
         """Generate few-shot examples for sharded/concat prompts."""
-        try:
-            # Use pre-loaded examples
-            examples = self.examples[:num_examples]
-            
-            # Load template
-            with open("prompts/sharded_example.txt", "r", encoding='utf-8') as f:
-                template = f.read()
-            
-            # Format each example
-            formatted_examples = []
-            for example in examples:
-                # Concatenate all shards
-                shards_text = "\n".join([shard["shard"] for shard in example["shards"]])
-                
-                # Replace placeholders
-                formatted_example = template.replace("[[shards]]", shards_text)
-                formatted_example = formatted_example.replace("[[label]]", example["label"])
-                formatted_examples.append(formatted_example)
-            
-            return "\n".join(formatted_examples)
-        
-        except Exception as e:
-            print(f"Warning: Could not format examples: {e}")
-            return ""
+        return self.render_sharded_examples(num_examples)
 
     def process_original_sample(self, sample: Dict[str, Any]) -> Dict[str, Any]:
         """Given a sample in the dataset file, return a dictionary with all the information from the original sample; helpful for displaying the sample in the annotation UI"""
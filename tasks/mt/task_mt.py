@@ -1,14 +1,16 @@
 from typing import List, Dict, Any
 from task_base import Task
+from prompt_template import load_template
 import json, random, re 
 from sacrebleu.metrics import CHRF
 
 class TaskMT(Task):
     def __init__(self):
-        with open("prompts/mt/mt_full_prompt.txt", "r") as f:
-            self.fully_specified_prompt = f.read()
-        with open("prompts/mt/mt_system_prompt.txt", "r") as f:
-            self.system_prompt = f.read()
+        self.fully_specified_template = load_template("prompts/mt/mt_full_prompt.txt", variables=["language", "text", "fewshot_examples"])
+        self.fully_specified_prompt = self.fully_specified_template.text
+        self.full_example_template = load_template("prompts/mt/mt_full_example.txt", variables=["text", "label"])
+        self.system_template = load_template("prompts/mt/mt_system_prompt.txt", variables=["language", "fewshot_examples"])
+        self.system_prompt = self.system_template.text
 
         # Load sharded examples once
         try:
@@ -24,6 +26,8 @@ class TaskMT(Task):
         random.seed(self.seed)
 
         self.answer_extraction_strategy = "full_response"
+        self.max_output_tokens = 384 # one translated passage after "Salin:"
+        self.stop_sequences = ["\nTeksto:"] # start of the next few-shot example; base models run on into it
 
     def get_task_name(self) -> str:
         return "mt"
@@ -69,11 +73,8 @@ class TaskMT(Task):
             }
 
     def populate_fully_specific_prompt(self, sample: Dict[str, Any]) -> str:
-        return (
-            self.fully_specified_prompt
-            .replace("[[language]]", sample["language"])
-            .replace("[[text]]", sample["text"])
-        )
+        # fills the sample's fields; [[fewshot_examples]] is left in place for the simulator
+        return self.fully_specified_template.render(sample)
 
     def populate_concat_prompt(self, sample: Dict[str, Any]) -> str:
         """
@@ -81,11 +82,8 @@ class TaskMT(Task):
         [[fewshot_examples]] is ignored here (handled elsewhere).
         """
         concatenated_shards = "\n".join(shard["shard"] for shard in sample["shards"])
-        prompt = f"{self.system_prompt.strip()}\n\n{concatenated_shards.strip()}"
-        return (
-            prompt
-            .replace("[[language]]", sample["language"])
-        )
+        system_prompt = self.system_template.render({"language": sample["language"]})
+        return f"{system_prompt.strip()}\n\n{concatenated_shards.strip()}"
 
     def populate_sharded_prompt(self, sample, turn_index):
         shards = sample["shards"]
@@ -106,59 +104,11 @@ class TaskMT(Task):
 
     def populate_full_examples(self, num_examples: int = 5) -> str:
         """Generate few-shot examples for full prompts."""
-        try:
-            # Use pre-loaded examples
-            examples = self.examples[:num_examples]
-            
-            # Load template
-            with open(f"prompts/{self.get_task_name()}/{self.get_task_name()}_full_example.txt", "r", encoding='utf-8') as f:
-                template = f.read()
-            
-            # Format each example
-            formatted_examples = []
-            for example in examples:
-                # Use text and label fields directly
-                example_data = {
-                    "text": example["text"],
-                    "label": example["label"]
-                }
-                formatted_example = template
-                for key, value in example_data.items():
-                    formatted_example = formatted_example.replace(f"[[{key}]]", str(value))
-                formatted_examples.append(formatted_example)
-            
-            return "\n".join(formatted_examples)
-        
-        except Exception as e:
-            print(f"Warning: Could not format examples: {e}")
-            return ""
+        return self.render_full_examples(num_examples)
 
     def populate_sharded_examples(self, num_examples: int = 5) -> str:
         """Generate few-shot examples for sharded/concat prompts."""
-        try:
-            # Use pre-loaded examples
-            examples = self.examples[:num_examples]
-            
-            # Load template
-            with open("prompts/sharded_example.txt", "r", encoding='utf-8') as f:
-                template = f.read()
-            
-            # Format each example
-            formatted_examples = []
-            for example in examples:
-                # Concatenate all shards
-                shards_text = "\n".join([shard["shard"] for shard in example["shards"]])
-                
-                # Replace placeholders
-                formatted_example = template.replace("[[shards]]", shards_text)
-                formatted_example = formatted_example.replace("[[label]]", example["label"])
-                formatted_examples.append(formatted_example)
-            
-            return "\n".join(formatted_examples)
-        
-        except Exception as e:
-            print(f"Warning: Could not format examples: {e}")
-            return ""
+        return self.render_sharded_examples(num_examples)
 
     def process_original_sample(self, sample: Dict[str, Any]) -> Dict[str, Any]:
         """Given a sample in the dataset file, return a dictionary with all the information from the original sample; helpful for displaying the sample in the annotation UI"""
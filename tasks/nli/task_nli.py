@@ -1,11 +1,13 @@
 from typing import List, Dict, Any
 from task_base import Task
+from prompt_template import load_template
 import json, random, re # not sure
 
 class TaskNLI(Task):
     def __init__(self):
-        with open("prompts/nli/nli_full_prompt.txt", "r") as f:
-            self.fully_specified_prompt = f.read()
+        self.fully_specified_template = load_template("prompts/nli/nli_full_prompt.txt", variables=["sentence1", "sentence2", "fewshot_examples"])
+        self.fully_specified_prompt = self.fully_specified_template.text
+        self.full_example_template = load_template("prompts/nli/nli_full_example.txt", variables=["sentence1", "sentence2", "label"])
         with open("prompts/nli/nli_system_prompt.txt", "r") as f:
             self.system_prompt = f.read()
 
@@ -23,6 +25,9 @@ class TaskNLI(Task):
         random.seed(self.seed)
 
         self.answer_extraction_strategy = "gen"
+        self.answer_pattern = r"\b([AaBbCc])\b" # shared by evaluator_function and the streaming stop predicate
+        self.max_output_tokens = 128 # "Sagot: C" plus room for a short justification
+        self.stop_sequences = ["\nSENTENCE_1:"] # start of the next few-shot example; base models run on into it
 
     def get_task_name(self) -> str:
         return "nli"
@@ -47,7 +52,7 @@ class TaskNLI(Task):
         try:
             # Extract only the first valid 'A', 'B', or 'C' from the model output
             # e.g., "The correct answer is A." -> "A"
-            match = re.search(r"\b([AaBbCc])\b", extracted_answer)
+            match = re.search(self.answer_pattern, extracted_answer)
             if not match:
                 return {"score": 0.0, "error": f"No valid answer found in: {repr(extracted_answer)}"}
             extracted = match.group(1).upper()
@@ -59,11 +64,8 @@ class TaskNLI(Task):
         return {"score": score}
 
     def populate_fully_specific_prompt(self, sample: Dict[str, Any]) -> str:
-        return (
-            self.fully_specified_prompt
-            .replace("[[sentence1]]", sample["sentence1"])
-            .replace("[[sentence2]]", sample["sentence2"])
-        )
+        # fills the sample's fields; [[fewshot_examples]] is left in place for the simulator
+        return self.fully_specified_template.render(sample)
 
     def populate_concat_prompt(self, sample: Dict[str, Any]) -> str:
         """
@@ -75,59 +77,11 @@ class TaskNLI(Task):
 
     def populate_full_examples(self, num_examples: int = 5) -> str:
         """Generate few-shot examples for full prompts."""
-        try:
-            # Use pre-loaded examples
-            examples = self.examples[:num_examples]
-            
-            # Load template
-            with open(f"prompts/{self.get_task_name()}/{self.get_task_name()}_full_example.txt", "r", encoding='utf-8') as f:
-                template = f.read()
-            
-            # Format each example
-            formatted_examples = []
-            for example in examples:
-                example_data = {
-                    "sentence1": example["sentence1"],
-                    "sentence2": example["sentence2"],
-                    "label": example["label"]
-                }
-                formatted_example = template
-                for key, value in example_data.items():
-                    formatted_example = formatted_example.replace(f"[[{key}]]", str(value))
-                formatted_examples.append(formatted_example)
-            
-            return "\n".join(formatted_examples)
-        
-        except Exception as e:
-            print(f"Warning: Could not format examples: {e}")
-            return ""
+        return self.render_full_examples(num_examples)
 
     def populate_sharded_examples(self, num_examples: int = 5) -> str:
         """Generate few-shot examples for sharded/concat prompts."""
-        try:
-            # Use pre-loaded examples
-            examples = self.examples[:num_examples]
-            
-            # Load template
-            with open("prompts/sharded_example.txt", "r", encoding='utf-8') as f:
-                template = f.read()
-            
-            # Format each example
-            formatted_examples = []
-            for example in examples:
-                # Concatenate all shards
-                shards_text = "\n".join([shard["shard"] for shard in example["shards"]])
-                
-                # Replace placeholders
-                formatted_example = template.replace("[[shards]]", shards_text)
-                formatted_example = formatted_example.replace("[[label]]", example["label"])
-                formatted_examples.append(formatted_example)
-            
-            return "\n".join(formatted_examples)
-        
-        except Exception as e:
-            print(f"Warning: Could not format examples: {e}")
-            return ""
+        return self.render_sharded_examples(num_examples)
 
     def process_original_sample(self, sample: Dict[str, Any]) -> Dict[str, Any]:
         """Given a sample in the dataset file, return a dictionary with all the information from the original sample; helpful for displaying the sample in the annotation UI"""
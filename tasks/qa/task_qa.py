@@ -1,11 +1,13 @@
 from typing import List, Dict, Any
 from task_base import Task
+from prompt_template import load_template
 import json, random, re
 
 class TaskQA(Task):
     def __init__(self):
-        with open("prompts/qa/qa_full_prompt.txt", "r") as f:
-            self.fully_specified_prompt = f.read()
+        self.fully_specified_template = load_template("prompts/qa/qa_full_prompt.txt", variables=["text", "question", "choice1", "choice2", "choice3", "choice4", "fewshot_examples"])
+        self.fully_specified_prompt = self.fully_specified_template.text
+        self.full_example_template = load_template("prompts/qa/qa_full_example.txt", variables=["text", "question", "choice1", "choice2", "choice3", "choice4", "label"])
         with open("prompts/qa/qa_system_prompt.txt", "r") as f:
             self.system_prompt = f.read()
 
@@ -23,6 +25,9 @@ class TaskQA(Task):
         random.seed(self.seed)
 
         self.answer_extraction_strategy = "gen"
+        self.answer_pattern = r"\b([AaBbCcDd])\b" # shared by evaluator_function and the streaming stop predicate
+        self.max_output_tokens = 128 # "Sagot: B" plus room for a short justification
+        self.stop_sequences = ["\nTalata:"] # start of the next few-shot example; base models run on into it
 
     def get_dataset_file(self) -> str:
         return "data/qa/sharded_qa.json"
@@ -48,7 +53,7 @@ class TaskQA(Task):
         try:
             # Extract only the first valid 'A', 'B', etc. from the model output
             # e.g., "The correct answer is A." -> "A"
-            match = re.search(r"\b([AaBbCcDd])\b", extracted_answer)
+            match = re.search(self.answer_pattern, extracted_answer)
             if not match:
                 return {"score": 0.0, "error": f"No valid answer found in: {repr(extracted_answer)}"}
             extracted = match.group(1).upper()
@@ -60,16 +65,8 @@ class TaskQA(Task):
         return {"score": score}
 
     def populate_fully_specific_prompt(self, sample: Dict[str, Any]) -> str:
-        #replace varibles except for fewshot examples
-        return (
-            self.fully_specified_prompt
-            .replace("[[text]]", sample["text"])
-            .replace("[[question]]", sample["question"])
-            .replace("[[choice1]]", sample["choice1"])
-            .replace("[[choice2]]", sample["choice2"])
-            .replace("[[choice3]]", sample["choice3"])
-            .replace("[[choice4]]", sample["choice4"])
-        )
+        # fills the sample's fields; [[fewshot_examples]] is left in place for the simulator
+        return self.fully_specified_template.render(sample)
 
     def populate_concat_prompt(self, sample: Dict[str, Any]) -> str:
         # Combine all shards into a newline-separated string
@@ -80,63 +77,11 @@ class TaskQA(Task):
 
     def populate_full_examples(self, num_examples: int = 5) -> str:
         """Generate few-shot examples for full prompts."""
-        try:
-            # Use pre-loaded examples
-            examples = self.examples[:num_examples]
-            
-            # Load template
-            with open(f"prompts/{self.get_task_name()}/{self.get_task_name()}_full_example.txt", "r", encoding='utf-8') as f:
-                template = f.read()
-            
-            # Format each example
-            formatted_examples = []
-            for example in examples:
-                example_data = {
-                    "text": example["text"],
-                    "question": example["question"],
-                    "choice1": example["choice1"],
-                    "choice2": example["choice2"],
-                    "choice3": example["choice3"],
-                    "choice4": example["choice4"],
-                    "label": example["label"]
-                }
-                formatted_example = template
-                for key, value in example_data.items():
-                    formatted_example = formatted_example.replace(f"[[{key}]]", str(value))
-                formatted_examples.append(formatted_example)
-            
-            return "\n".join(formatted_examples)
-        
-        except Exception as e:
-            print(f"Warning: Could not format examples: {e}")
-            return ""
+        return self.render_full_examples(num_examples)
 
     def populate_sharded_examples(self, num_examples: int = 5) -> str:
         """Generate few-shot examples for sharded/concat prompts."""
-        try:
-            # Use pre-loaded examples
-            examples = self.examples[:num_examples]
-            
-            # Load template
-            with open("prompts/sharded_example.txt", "r", encoding='utf-8') as f:
-                template = f.read()
-            
-            # Format each example
-            formatted_examples = []
-            for example in examples:
-                # Concatenate all shards
-                shards_text = "\n".join([shard["shard"] for shard in example["shards"]])
-                
-                # Replace placeholders
-                formatted_example = template.replace("[[shards]]", shards_text)
-                formatted_example = formatted_example.replace("[[label]]", example["label"])
-                formatted_examples.append(formatted_example)
-            
-            return "\n".join(formatted_examples)
-        
-        except Exception as e:
-            print(f"Warning: Could not format examples: {e}")
-            return ""
+        return self.render_sharded_examples(num_examples)
 
     def extract_fully_specific_response(self, response: str, sample: Dict[str, Any]) -> str:
         # im not sure what this does